@@ -3,7 +3,11 @@ Compatibility module for deployment.
 Imports the main Flask app from the restructured package.
 """
 
-from src.neojambu.app import app, get_session
+from src.neojambu.app import app, get_session, init_app
+
+# gunicorn --preload imports this module in its master process, so the in-memory
+# indexes are loaded once there and shared by the workers it forks
+init_app()
 
 # Expose for compatibility
 __all__ = ["app", "get_session"]
\ No newline at end of file
@@ -4,5 +4,6 @@ Main entry point for the NeoJambu linguistics webapp.
 """
 
 if __name__ == "__main__":
-    from src.neojambu.app import app
+    from src.neojambu.app import app, init_app
+    init_app()
     app.run(threaded=True, port=2222)
\ No newline at end of file
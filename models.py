@@ -6,4 +6,4 @@ Imports database models from the restructured package.
 from src.neojambu.models import *
 
 # Re-export everything for compatibility
-__all__ = ["Language", "Lemma", "Concept", "Reference", "LemmaConcept", "LemmaReference", "Base"]
\ No newline at end of file
+__all__ = ["Language", "Lemma", "Concept", "Reference", "LemmaConcept", "LemmaReference", "BuildHash", "BuildInfo", "Base"]
\ No newline at end of file
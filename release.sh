@@ -48,4 +48,8 @@ else
     echo "Running in local environment - skipping Heroku-specific setup"
 fi
 
+# Precompress static assets so they are served gzip/brotli-encoded without per-request work
+echo "Precompressing static assets..."
+uv run python scripts/precompress_static.py
+
 echo "=== Release process completed successfully ==="
\ No newline at end of file
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Engine profile benchmark for the neojambu webapp.
+Runs the same request-shaped workload (a session per request, as app.py does)
+against data.db through each engine profile in src/neojambu/db.py and reports
+throughput and latency per profile.
+"""
+import argparse
+import statistics
+import sys
+import threading
+import time
+from sqlalchemy import func, text
+from sqlalchemy.orm import joinedload, selectinload, sessionmaker
+from src.neojambu.db import DB_PATH, default_engine, serving_engine
+from src.neojambu.models import Language, Lemma
+
+PROFILES = {
+    "default": default_engine,
+    "serving": serving_engine,
+}
+
+
+def sample_ids(engine):
+    """a spread of languages and etyma to look up"""
+    with engine.connect() as conn:
+        languages = [row[0] for row in conn.execute(text("SELECT id FROM languages ORDER BY lemma_count DESC LIMIT 20"))]
+        entries = [row[0] for row in conn.execute(text(
+            "SELECT origin_lemma_id FROM lemmas WHERE origin_lemma_id IS NOT NULL "
+            "GROUP BY origin_lemma_id ORDER BY COUNT(*) DESC LIMIT 20"
+        ))]
+    return languages, entries
+
+
+def workload(Session, languages, entries):
+    """one request's worth of queries for each of a language page, an entry page and a listing"""
+    requests = []
+    for i in range(len(languages)):
+        requests.append(lambda session, lang=languages[i]: (
+            session.query(Lemma).filter(Lemma.language_id == lang)
+            .options(joinedload(Lemma.origin_lemma)).order_by(Lemma.order).limit(50).all(),
+            session.query(func.count(Lemma.id)).filter(Lemma.language_id == lang).scalar(),
+        ))
+        requests.append(lambda session, entry=entries[i % len(entries)]: (
+            session.query(Lemma).filter(Lemma.origin_lemma_id == entry)
+            .options(joinedload(Lemma.language), selectinload(Lemma.references)).all()
+        ))
+        requests.append(lambda session, offset=i * 50: (
+            session.query(Lemma).join(Lemma.language)
+            .order_by(Lemma.order, Lemma.id).offset(offset).limit(50).all(),
+            session.query(Language).order_by(Language.order, Language.name).all(),
+        ))
+
+    def run(request):
+        session = Session()
+        try:
+            start = time.perf_counter()
+            request(session)
+            return time.perf_counter() - start
+        finally:
+            session.close()
+
+    return requests, run
+
+
+def benchmark(profile, rounds, threads):
+    engine = PROFILES[profile](DB_PATH)
+    Session = sessionmaker(bind=engine)
+    requests, run = workload(Session, *sample_ids(engine))
+    for request in requests:  # warm the page cache and the pool
+        run(request)
+
+    timings = []
+    lock = threading.Lock()
+
+    def worker():
+        local = [run(request) for _ in range(rounds) for request in requests]
+        with lock:
+            timings.extend(local)
+
+    start = time.perf_counter()
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    engine.dispose()
+
+    timings.sort()
+    return {
+        "requests": len(timings),
+        "per_second": len(timings) / elapsed,
+        "median_ms": statistics.median(timings) * 1000,
+        "p95_ms": timings[int(len(timings) * 0.95)] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=5, help="passes over the workload per thread")
+    parser.add_argument("--threads", type=int, default=4, help="concurrent request threads, as in a gunicorn worker")
+    parser.add_argument("--profile", choices=list(PROFILES), action="append", help="profiles to run (default: all)")
+    args = parser.parse_args()
+
+    print(f"⏱️  Benchmarking engine profiles on {DB_PATH} ({args.threads} threads x {args.rounds} rounds)")
+    results = {}
+    for profile in args.profile or list(PROFILES):
+        results[profile] = result = benchmark(profile, args.rounds, args.threads)
+        print(
+            f"   {profile:<8} {result['requests']:>6} requests  {result['per_second']:8.1f}/s  "
+            f"median {result['median_ms']:7.2f} ms  p95 {result['p95_ms']:7.2f} ms"
+        )
+    if "default" in results and "serving" in results:
+        print(f"📈 serving / default throughput: {results['serving']['per_second'] / results['default']['per_second']:.2f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Query plan regression check for the neojambu webapp.
+Requests every route in app.py, captures the SQL each one runs and fails if
+SQLite's EXPLAIN QUERY PLAN falls back to scanning a large table.
+"""
+import re
+import sys
+from flask import request
+from sqlalchemy import event, text
+from src.neojambu.app import app, engine, init_app
+from src.neojambu.models import Base, fuzzy_metadata
+from src.neojambu.search import encode_cursor
+
+# tables that are small enough to be listed in full
+SMALL_TABLES = {"languages", "references", "concepts", "build_info"}
+
+SCAN = re.compile(r"^SCAN (\w+)")
+
+
+def sample_routes(conn):
+    """routes to exercise, filled in with ids that exist in this database; (route, body) pairs are POSTed"""
+    entry = conn.execute(text("SELECT origin_lemma_id FROM lemmas WHERE origin_lemma_id IS NOT NULL LIMIT 1")).scalar()
+    reflex = conn.execute(text("SELECT id FROM lemmas WHERE origin_lemma_id IS NOT NULL LIMIT 1")).scalar()
+    language = conn.execute(text("SELECT id FROM languages ORDER BY lemma_count DESC LIMIT 1")).scalar()
+    reference = conn.execute(text('SELECT id FROM "references" LIMIT 1')).scalar()
+    other = conn.execute(text("SELECT id FROM languages WHERE id != :id ORDER BY lemma_count DESC LIMIT 1"), {"id": language}).scalar()
+    word = conn.execute(text("SELECT word FROM lemmas WHERE length(word) > 3 LIMIT 1")).scalar()
+    middle = conn.execute(text('SELECT "order", id FROM lemmas ORDER BY "order" LIMIT 1 OFFSET (SELECT COUNT(*) / 2 FROM lemmas)')).first()
+    with app.test_request_context("/"):
+        after, before = (encode_cursor(request, direction, list(middle)) for direction in ("next", "prev"))
+    return [
+        f"/entries?page=2&cursor={after}",
+        f"/reflexes?page=2&cursor={after}",
+        f"/reflexes?page=2&cursor={before}",
+        f"/query?type=reflexes&cursor={after}",
+        f"/query?type=reflexes&cursor={before}",
+        "/entries",
+        "/entries?page=2",
+        f"/entries/{entry}",
+        "/reflexes",
+        "/reflexes?page=2",
+        f"/reflexes?word={word}&fuzzy=2",
+        f"/entries?word={word}&fuzzy=1",
+        f"/languages/{language}?word={word}&fuzzy=2",
+        f"/query?type=reflexes&word={word}&fuzzy=2",
+        "/reflexes?pattern=^k.*t",
+        f"/languages/{language}?pattern=a&pattern_field=phonemic",
+        "/query?type=reflexes&pattern=a&clade=a",
+        f"/reflexes/{reflex}",
+        "/languages",
+        f"/languages/{language}",
+        f"/languages/{language}/{other}",
+        f"/languages/{language}/{language}?page=2&cursor={after}",
+        "/references",
+        f"/references/{reference}",
+        f"/query?type=reflex&reflex={reflex}",
+        "/query?type=reflexes",
+        f"/query?type=language&language={language}",
+        "/query?type=languages",
+        f"/query?type=entry&entry={entry}",
+        "/query?type=entries",
+        f"/query?type=reference&reference={reference}",
+        "/query?type=references",
+        f"/export/languages/{language}",
+        f"/export/entries/{entry}",
+        f"/export/references/{reference}",
+        ("/query/batch", {"reflex": [reflex], "entry": [entry], "language": [language]}),
+    ]
+
+
+def capture_statements(routes):
+    """requests each route and records the (statement, parameters) it sends to SQLite"""
+    captured = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        captured.append((route, statement, parameters))
+
+    app.config['TESTING'] = True
+    # the in-memory indexes read whole tables, once per build, as the deployment does at startup
+    init_app()
+    # cached pages would not reach the database at all
+    use_cache, app.config['RESPONSE_CACHE'] = app.config['RESPONSE_CACHE'], False
+    client = app.test_client()
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        for route in routes:
+            if isinstance(route, tuple):
+                route, body = route
+                response = client.post(route, json=body)
+            else:
+                response = client.get(route)
+            if response.status_code != 200:
+                print(f"⚠️  {route}: HTTP {response.status_code}")
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+        app.config['RESPONSE_CACHE'] = use_cache
+    return captured
+
+
+def scans(conn, statement, parameters):
+    """plan steps that read a large table without an index"""
+    tables = (set(Base.metadata.tables) | set(fuzzy_metadata.tables)) - SMALL_TABLES
+    bad = []
+    for row in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters):
+        detail = row[-1]
+        match = SCAN.match(detail)
+        if match and re.sub(r"_\d+$", "", match.group(1)) in tables and "INDEX" not in detail:
+            bad.append(detail)
+        elif "AUTOMATIC" in detail:
+            bad.append(detail)
+    return bad
+
+
+def check_query_plans():
+    """returns a list of (route, statement, bad plan steps) for every offending query"""
+    with engine.connect() as conn:
+        routes = sample_routes(conn)
+    failures = []
+    with engine.connect() as conn:
+        for route, statement, parameters in capture_statements(routes):
+            bad = scans(conn, statement, parameters)
+            if bad:
+                failures.append((route, statement, bad))
+    return failures
+
+
+def main():
+    print("🔍 Checking query plans...")
+    failures = check_query_plans()
+    for route, statement, bad in failures:
+        print(f"❌ {route}: {'; '.join(bad)}")
+        print(f"   {' '.join(statement.split())[:200]}")
+    if failures:
+        print(f"⚠️  {len(failures)} queries fall back to a table scan")
+        return 1
+    print("✅ No route query scans a large table")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,25 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from src.neojambu.models import Language, Lemma, Reference, Concept, Base
-from typing import List
+from sqlalchemy import Table, create_engine, event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.schema import CreateTable
+from src.neojambu.fuzzy import form_key, grams
+from src.neojambu.models import Base, fuzzy_forms, fuzzy_grams, fuzzy_lemmas, fuzzy_metadata, lemmas_fts
+from src.neojambu.search import fold
+from typing import Callable, Iterable, Iterator, List, Optional, Sequence
 import pybtex.database
 import pybtex.bibtex
 
 import os
 import csv
+import time
+import uuid
+import json
+import hashlib
+import argparse
 from tqdm import tqdm
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
 
 colors = {
     "OIA": "E2DFD2",
@@ -51,6 +62,34 @@ colors = {
 }
 order = list(colors.keys())
 
+DATA_DIR = "../data/cldf"
+DB_PATH = "data.db"
+
+# rows per executemany call
+BATCH_SIZE = 10000
+# rows per task handed to a worker process
+CHUNK_SIZE = 5000
+# ids per `IN (...)` clause, well below SQLite's bound parameter limit
+IN_CHUNK_SIZE = 500
+
+# formatted sources, keyed by the hash of their bibtex; lives next to the database
+BIB_CACHE = "sources_cache.json"
+_bib_engine = None
+
+# prefixes on a form's Parameter_ID marking borrowings and semi-tatsamas
+RELATIONS = {">": "b", "~": "s"}
+
+# the database is rebuilt from scratch, so durability is irrelevant while loading
+BUILD_PRAGMAS = {
+    "journal_mode": "OFF",
+    "synchronous": "OFF",
+    "cache_size": -512000,  # in KiB, i.e. 500 MB
+    "temp_store": "MEMORY",
+    "locking_mode": "EXCLUSIVE",
+}
+# an incremental build edits the previous database in place, so keep the rollback journal
+INCREMENTAL_PRAGMAS = {**BUILD_PRAGMAS, "journal_mode": "DELETE"}
+
 
 def parse_ref(ref: str) -> List[str]:
     """parses references of the forms 'ref1:page1;ref2:page2' with pages being optional"""
@@ -77,167 +116,703 @@ def create_short_ref(entry):
         return "?"
 
 
-def main():
-    # create engine and session
-    if os.path.exists("data.db"):
-        os.remove("data.db")
-    engine = create_engine("sqlite:///data.db")
-    Session = sessionmaker(bind=engine)
-    session = Session()
+def format_source(bibtex: str) -> str:
+    """formats a single bibtex entry as markdown in pybtex's plain style"""
+    global _bib_engine
+    if _bib_engine is None:
+        _bib_engine = pybtex.PybtexEngine()
+    try:
+        formatted = _bib_engine.format_from_string(bibtex, "plain", output_backend="markdown")
+        return formatted[3:].strip()
+    except Exception as e:
+        print(e)
+        return ""
 
-    # create all tables
-    Base.metadata.create_all(engine)
 
-    # format sources into html
-    sources = pybtex.database.parse_file("../data/cldf/sources.bib")
-    engine = pybtex.PybtexEngine()
-    used_short = set()
-    refs = {}
-    for source in tqdm(sources.entries):
-        try:
-            formatted = engine.format_from_string(
-                sources.entries[source].to_string("bibtex"),
-                "plain",
-                output_backend="markdown",
-            )
-            formatted = formatted[3:].strip()
-        except Exception as e:
-            print(e)
-            formatted = ""
+def format_sources(entries, cache_path: str, workers: int = 0) -> dict:
+    """formats every entry, reusing the markdown cached under the hash of its bibtex
 
-        short = create_short_ref(sources.entries[source])
+    Only cache misses are formatted, optionally across a process pool. The cache is
+    rewritten with just this build's entries so it cannot grow without bound."""
+    bibtex = {key: entry.to_string("bibtex") for key, entry in entries.items()}
+    digests = {key: hashlib.sha1(text.encode()).hexdigest() for key, text in bibtex.items()}
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
 
+    missing = {digests[key]: text for key, text in bibtex.items() if digests[key] not in cache}
+    if missing:
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                formatted = list(pool.map(format_source, missing.values(), chunksize=16))
+        else:
+            formatted = [format_source(bibtex) for bibtex in tqdm(missing.values(), unit=" sources")]
+        cache.update(zip(missing, formatted))
+    print(f"sources: {len(digests) - len(missing)} cached, {len(missing)} formatted")
+
+    cache = {digest: cache[digest] for digest in digests.values()}
+    with open(cache_path + ".tmp", "w") as f:
+        json.dump(cache, f)
+    os.replace(cache_path + ".tmp", cache_path)
+    return {key: cache[digest] for key, digest in digests.items()}
+
+
+def short_refs(entries) -> dict:
+    """short labels like T1966 for every entry, disambiguated with letters in file order"""
+    used_short = set()
+    shorts = {}
+    for source, entry in entries.items():
+        short = create_short_ref(entry)
         while short in used_short and short != "?":
             if short[-1].isdigit() or short[-1] == "?":
                 short += "a"
             else:
                 short = short[:-1] + chr(ord(short[-1]) + 1)
         used_short.add(short)
-        reference = Reference(
-            id=source,
-            short=short,
-            source=formatted,
-            progress=sources.entries[source].fields.get("included", "No"),
+        shorts[source] = short
+    return shorts
+
+
+def default_bib_cache(db_path: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), BIB_CACHE)
+
+
+@contextmanager
+def stage(name: str, unit: str = "rows"):
+    """times a build stage; the body records how many rows it wrote in `counter`"""
+    counter = {"rows": 0}
+    start = time.perf_counter()
+    yield counter
+    elapsed = time.perf_counter() - start
+    rate = counter["rows"] / elapsed if elapsed else 0.0
+    print(f"{name}: {counter['rows']} {unit} in {elapsed:.2f}s ({rate:,.0f} {unit}/s)")
+
+
+def batched(rows: Iterable, size: int = BATCH_SIZE) -> Iterator[list]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def insert_rows(conn, table: Table, rows: Iterable[tuple], prefix: str = "") -> int:
+    """executemany plain tuples (in table column order) into `table`, one batch at a time"""
+    quote = conn.dialect.identifier_preparer.quote
+    columns = ", ".join(quote(column.name) for column in table.columns)
+    params = ", ".join("?" for _ in table.columns)
+    sql = f"INSERT {prefix}INTO {quote(table.name)} ({columns}) VALUES ({params})"
+    count = 0
+    for batch in batched(rows):
+        conn.exec_driver_sql(sql, batch)
+        count += len(batch)
+    return count
+
+
+def read_rows(path: str) -> Iterator[dict]:
+    """streams a CLDF table one row at a time"""
+    with open(path, "r", newline="") as f:
+        yield from csv.DictReader(f)
+
+
+def parse_relation(row: dict) -> dict:
+    """splits the borrowing (>) / semi-tatsama (~) marker off a form's Parameter_ID"""
+    relation = RELATIONS.get(row["Parameter_ID"][:1])
+    if relation:
+        row["Parameter_ID"] = row["Parameter_ID"][1:]
+    row["Relation"] = relation or "i"
+    return row
+
+
+def parse_refs(row: dict) -> dict:
+    row["Refs"] = parse_ref(row["Source"])
+    return row
+
+
+def fold_keys(row: dict) -> dict:
+    """precomputes the folded search keys of a form's word, gloss and native script"""
+    row["Keys"] = (fold(row["Form"]), fold(row["Gloss"]), fold(row["Native"]))
+    return row
+
+
+def _apply(funcs: Sequence[Callable[[dict], dict]], chunk: List[dict]) -> List[dict]:
+    for func in funcs:
+        chunk = [func(row) for row in chunk]
+    return chunk
+
+
+def transform(
+    rows: Iterable[dict], funcs: Sequence[Callable[[dict], dict]], workers: int = 0
+) -> Iterator[dict]:
+    """applies `funcs` in turn to every row, optionally in chunks across a process pool
+
+    At most two chunks per worker are in flight, so memory stays bounded however
+    long the input is, and rows come out in their original order."""
+    if workers <= 1:
+        for row in rows:
+            for func in funcs:
+                row = func(row)
+            yield row
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for chunk in batched(rows, CHUNK_SIZE):
+            pending.append(pool.submit(_apply, funcs, chunk))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def make_engine(path: str, pragmas: dict):
+    engine = create_engine(f"sqlite:///{path}")
+
+    @event.listens_for(engine, "connect")
+    def set_build_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in pragmas.items():
+            cursor.execute(f"PRAGMA {pragma} = {value}")
+        cursor.close()
+
+    return engine
+
+
+def map_marker(row: dict) -> str:
+    if row["Clade"] in ["MIA", "OIA"] or "Old" in row["Name"] or "Proto" in row["Name"]:
+        return f"""<svg viewBox="0 0 30 30" xmlns="http://www.w3.org/2000/svg"><polygon points="0,15 15,0 30,15 15,30" fill="#{colors[row['Clade']]}" stroke="black" stroke-width="2"/></svg>"""
+    return f"""<svg viewBox="-2 -2 32 32" xmlns="http://www.w3.org/2000/svg"><circle cx="14" cy="14" r="13" fill="#{colors[row['Clade']]}" stroke="black" stroke-width="2"/></svg>"""
+
+
+def row_hash(row: tuple) -> str:
+    return hashlib.blake2b(repr(row).encode(), digest_size=8).hexdigest()
+
+
+class Differ:
+    """compares rows of one kind against the content hashes stored by the last build
+
+    Only an incremental build remembers the ids it has seen, to find the rows that were
+    deleted; a full build starts from an empty database and keeps memory flat."""
+
+    def __init__(self, conn, kind: str, full: bool):
+        self.kind = kind
+        self.full = full
+        self.stored = {} if full else dict(
+            conn.exec_driver_sql("SELECT id, hash FROM build_hashes WHERE kind = ?", (kind,)).fetchall()
         )
-        refs[source] = reference
-        session.add(reference)
-
-    # languages
-    clades = {}
-    langs = {}
-    with open("../data/cldf/languages.csv", "r") as f:
-        lines = f.readlines()
-        reader = csv.DictReader(lines)
-        for row in tqdm(reader, total=len(lines)):
-            language, dialect = row["Name"].split(": ") if ": " in row["Name"] else (row["Name"], "")
-            marker = ""
-            if row["Clade"] in ["MIA", "OIA"] or "Old" in row["Name"] or "Proto" in row["Name"]:
-                marker = f"""<svg viewBox="0 0 30 30" xmlns="http://www.w3.org/2000/svg"><polygon points="0,15 15,0 30,15 15,30" fill="#{colors[row['Clade']]}" stroke="black" stroke-width="2"/></svg>"""
-            else:
-                marker = f"""<svg viewBox="-2 -2 32 32" xmlns="http://www.w3.org/2000/svg"><circle cx="14" cy="14" r="13" fill="#{colors[row['Clade']]}" stroke="black" stroke-width="2"/></svg>"""
-            language = Language(
-                id=row["ID"],
-                name=row["Name"],
-                language=language,
-                dialect=dialect,
-                glottocode=row["Glottocode"],
-                long=row["Longitude"],
-                lat=row["Latitude"],
-                clade=row["Clade"],
-                color=colors[row["Clade"]],
-                order=order.index(row["Clade"]),
-                map_marker=marker,
-            )
-            clades[row["ID"]] = row["Clade"]
-            langs[row["ID"]] = language
-            session.add(language)
-
-    # parameters
-    lemma_cts = defaultdict(int)
-    params = {}
-    ordering = 0
-    with open("../data/cldf/parameters.csv", "r") as f:
-        lines = f.readlines()
-        reader = csv.DictReader(lines)
-        for i, row in enumerate(tqdm(reader, total=len(lines))):
-            iden = row["ID"]
-            parameter = Lemma(
-                id=iden,
-                word=row["Name"],
-                gloss=row["Description"],
-                language_id=row["Language_ID"],
-                notes=row["Etyma"],
-                order=ordering * 1000,
+        self.seen = set()
+        self.pending = []
+
+    def changed(self, iden: str, content: tuple) -> bool:
+        digest = row_hash(content)
+        if not self.full:
+            self.seen.add(iden)
+        if self.stored.get(iden) == digest:
+            return False
+        self.pending.append((self.kind, iden, digest))
+        return True
+
+    def flush(self, conn):
+        insert_rows(conn, Base.metadata.tables["build_hashes"], self.pending, prefix="OR REPLACE ")
+        self.pending = []
+
+    def deleted(self) -> List[str]:
+        if self.full:
+            return []
+        return sorted(self.stored.keys() - self.seen)
+
+
+def select_in(conn, sql: str, ids: Iterable[str]) -> Iterator[tuple]:
+    """runs `sql` (containing a single `{ids}` placeholder) over `ids` in chunks"""
+    for chunk in batched(ids, IN_CHUNK_SIZE):
+        yield from conn.exec_driver_sql(sql.format(ids=", ".join("?" * len(chunk))), tuple(chunk))
+
+
+def delete_in(conn, table: str, column: str, ids: Iterable[str]):
+    for chunk in batched(ids, IN_CHUNK_SIZE):
+        conn.exec_driver_sql(
+            f'DELETE FROM "{table}" WHERE {column} IN ({", ".join("?" * len(chunk))})', tuple(chunk)
+        )
+
+
+def sync_rows(conn, differ: Differ, table: Table, rows: Iterable[tuple], on_change=None) -> int:
+    """upserts the rows whose hash changed, in batches; `on_change` sees each changed batch first
+
+    Fields past the table's own columns are hashed along with the row but not stored."""
+    width = len(table.columns)
+    count = 0
+    for batch in batched(rows):
+        changed = [row for row in batch if differ.changed(row[0], row)]
+        if changed:
+            if on_change:
+                on_change(changed)
+            count += insert_rows(conn, table, (row[:width] for row in changed), prefix="OR REPLACE ")
+            differ.flush(conn)
+    return count
+
+
+def delete_rows(conn, differ: Differ, table: str, on_delete=None) -> List[str]:
+    """deletes the rows that disappeared from the CLDF data, along with their hashes"""
+    deleted = differ.deleted()
+    if deleted:
+        if on_delete:
+            on_delete(deleted)
+        delete_in(conn, table, "id", deleted)
+        for chunk in batched(deleted, IN_CHUNK_SIZE):
+            conn.exec_driver_sql(
+                f"DELETE FROM build_hashes WHERE kind = ? AND id IN ({', '.join('?' * len(chunk))})",
+                (differ.kind, *chunk),
             )
-            ordering += 1
-            params[iden] = parameter
-            session.add(parameter)
+    return deleted
+
 
-            # language ct
-            lemma_cts[row["Language_ID"]] += 1
+def update_derived(conn, langs: Optional[set] = None, params: Optional[set] = None) -> int:
+    """recomputes Language.lemma_count and the clades of parameters; None means all of them"""
+    if langs is None:
+        counts = dict(
+            conn.exec_driver_sql("SELECT language_id, COUNT(*) FROM lemmas GROUP BY language_id").fetchall()
+        )
+        langs = counts.keys()
+    else:
+        counts = dict.fromkeys(langs, 0)
+        counts.update(select_in(
+            conn, "SELECT language_id, COUNT(*) FROM lemmas WHERE language_id IN ({ids}) GROUP BY language_id", langs
+        ))
+    if counts:
+        conn.exec_driver_sql(
+            "UPDATE languages SET lemma_count = ? WHERE id = ?",
+            [(counts[language_id], language_id) for language_id in langs],
+        )
 
-    # lemmata
+    sql = """SELECT lemmas.origin_lemma_id, languages.clade FROM lemmas
+        JOIN languages ON languages.id = lemmas.language_id
+        WHERE lemmas.origin_lemma_id {where} GROUP BY 1, 2"""
     param_clades = defaultdict(set)
-    param_cts = defaultdict(int)
-    with open("../data/cldf/forms.csv", "r") as f:
-        lines = f.readlines()
-        reader = csv.DictReader(lines)
-        for i, row in enumerate(tqdm(reader, total=len(lines))):
-            # parse borrowing/semi-tatsama in parameter
-            relation = "i"
-            if row["Parameter_ID"][0] == ">":
-                row["Parameter_ID"] = row["Parameter_ID"][1:]
-                relation = "b"
-            elif row["Parameter_ID"][0] == "~":
-                row["Parameter_ID"] = row["Parameter_ID"][1:]
-                relation = "s"
-
-            # make lemma
-            param_cts[row["Parameter_ID"]] += 1
-            lemma = Lemma(
-                id=row["ID"],
-                word=row["Form"],
-                gloss=row["Gloss"],
-                native=row["Native"],
-                phonemic=row["Phonemic"],
-                original=row["Original"],
-                notes=row["Description"],
-                language_id=row["Language_ID"],
-                origin_lemma_id=row["Parameter_ID"],
-                cognateset=row["Cognateset"],
-                relation=relation,
-                order=params[row["Parameter_ID"]].order + param_cts[row["Parameter_ID"]],
+    if params is None:
+        rows = conn.exec_driver_sql(sql.format(where="IS NOT NULL"))
+    else:
+        param_clades.update((param, set()) for param in params)
+        rows = select_in(conn, sql.format(where="IN ({ids})"), params)
+    for param, clade in rows:
+        param_clades[param].add(clade)
+    if param_clades:
+        conn.exec_driver_sql(
+            "UPDATE lemmas SET clades = ? WHERE id = ?",
+            [
+                (",".join(sorted(clades, key=order.index)) or None, param)
+                for param, clades in param_clades.items()
+            ],
+        )
+    return len(counts) + len(param_clades)
+
+
+def schema_matches(db_path: str) -> bool:
+    """whether the tables in an existing database have the columns the models declare"""
+    engine = create_engine(f"sqlite:///{db_path}")
+    try:
+        with engine.connect() as conn:
+            return all(
+                [row[1] for row in conn.exec_driver_sql(f'PRAGMA table_info("{table.name}")')]
+                == [column.name for column in table.columns]
+                for table in Base.metadata.sorted_tables
             )
+    finally:
+        engine.dispose()
+
+
+def build_fts(conn) -> int:
+    """(re)builds the lemmas_fts trigram index from the lemmas table; returns the rows indexed"""
+    columns = ", ".join(
+        f"{column.name} UNINDEXED" if column.name == "id" else column.name for column in lemmas_fts.columns
+    )
+    conn.exec_driver_sql(f"DROP TABLE IF EXISTS {lemmas_fts.name}")
+    try:
+        conn.exec_driver_sql(
+            f"CREATE VIRTUAL TABLE {lemmas_fts.name} USING fts5("
+            f"{columns}, content='lemmas', tokenize='trigram')"
+        )
+    except OperationalError as error:
+        # the app falls back to plain LIKE filters when the table is missing
+        print(f"skipping full-text index: {error}")
+        return 0
+    conn.exec_driver_sql(f"INSERT INTO {lemmas_fts.name}({lemmas_fts.name}) VALUES ('rebuild')")
+    return conn.exec_driver_sql("SELECT COUNT(*) FROM lemmas").scalar()
+
 
-            # language ct
-            lemma_cts[row["Language_ID"]] += 1
+def build_fuzzy(conn) -> int:
+    """(re)builds the fuzzy search tables from the lemmas table; returns the forms indexed"""
+    fuzzy_metadata.drop_all(conn)
+    fuzzy_metadata.create_all(conn)
+    forms = {}
 
-            # clade
-            param_clades[row["Parameter_ID"]].add(clades[row["Language_ID"]])
+    def links():
+        # streamed from the cursor; only the distinct forms are held in memory
+        for lemma_id, word, phonemic in conn.exec_driver_sql("SELECT id, word, phonemic FROM lemmas"):
+            for form in {form_key(word), form_key(phonemic)} - {None}:
+                yield (forms.setdefault(form, len(forms) + 1), lemma_id)
 
-            # add refs
-            for ref in parse_ref(row["Source"]):
-                reference = refs.get(ref, None)
-                if reference is None:
-                    reference = Reference(id=ref)
-                    session.add(reference)
-                lemma.references.append(reference)
+    insert_rows(conn, fuzzy_lemmas, links())
+    insert_rows(conn, fuzzy_forms, ((form_id, form) for form, form_id in forms.items()))
+    insert_rows(conn, fuzzy_grams, (
+        (gram, len(form), form_id) for form, form_id in forms.items() for gram in grams(form)
+    ))
+    return len(forms)
 
-            session.add(lemma)
 
-    # update language lemma counts
-    for language_id, ct in tqdm(lemma_cts.items()):
-        language = langs[language_id]
-        if language:
-            language.lemma_count = ct
+def table_exists(conn, name: str) -> bool:
+    return conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = ?", (name,)).first() is not None
 
-    for param_id, clades in tqdm(param_clades.items()):
-        lemma = params[param_id]
-        lemma.clades = ",".join(list(clades))
 
-    session.commit()
+class LemmaIndexes:
+    """keeps lemmas_fts and the fuzzy search tables in step with the lemmas an incremental build writes
+
+    `remove` takes the stored versions of lemmas out of both before they are overwritten or
+    deleted; `add` indexes the current versions of every lemma removed so far, once all of
+    them are written. A table missing from the database is left for a full (re)build."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.fts = table_exists(conn, lemmas_fts.name)
+        self.fuzzy = table_exists(conn, fuzzy_grams.name)
+        if self.fuzzy:
+            # databases built before forms were looked up by text lack the index
+            for index in fuzzy_forms.indexes:
+                index.create(conn, checkfirst=True)
+        self.touched = set()
+        self.dropped_forms = set()
+        columns = ", ".join(column.name for column in lemmas_fts.columns)
+        self.fts_delete = (
+            f"INSERT INTO {lemmas_fts.name}({lemmas_fts.name}, rowid, {columns}) "
+            f"SELECT 'delete', rowid, {columns} FROM lemmas WHERE id IN ({{ids}})"
+        )
+        self.fts_insert = (
+            f"INSERT INTO {lemmas_fts.name}(rowid, {columns}) "
+            f"SELECT rowid, {columns} FROM lemmas WHERE id IN ({{ids}})"
+        )
+
+    def run_in(self, sql: str, ids: Iterable[str]):
+        for chunk in batched(ids, IN_CHUNK_SIZE):
+            self.conn.exec_driver_sql(sql.format(ids=", ".join("?" * len(chunk))), tuple(chunk))
+
+    def links(self, ids: Iterable[str]) -> List[tuple]:
+        """(form, lemma id) of the stored lemmas among `ids`"""
+        return [
+            (form, lemma_id)
+            for lemma_id, word, phonemic in select_in(
+                self.conn, "SELECT id, word, phonemic FROM lemmas WHERE id IN ({ids})", ids
+            )
+            for form in {form_key(word), form_key(phonemic)} - {None}
+        ]
+
+    def form_ids(self, forms: Iterable[str]) -> dict:
+        return dict(select_in(self.conn, "SELECT form, id FROM fuzzy_forms WHERE form IN ({ids})", set(forms)))
+
+    def remove(self, ids: Iterable[str]):
+        # a lemma is taken out once, so that the FTS 'delete' always sees what was indexed
+        ids = [iden for iden in ids if iden not in self.touched]
+        self.touched.update(ids)
+        if self.fts:
+            self.run_in(self.fts_delete, ids)
+        if self.fuzzy:
+            links = self.links(ids)
+            found = self.form_ids(form for form, _ in links)
+            if links:
+                self.conn.exec_driver_sql(
+                    f"DELETE FROM {fuzzy_lemmas.name} WHERE form_id = ? AND lemma_id = ?",
+                    [(found[form], lemma_id) for form, lemma_id in links if form in found],
+                )
+            self.dropped_forms.update(found.values())
+
+    def add(self) -> int:
+        """indexes the current versions of the removed lemmas; returns how many were removed"""
+        ids = sorted(self.touched)
+        if self.fts:
+            self.run_in(self.fts_insert, ids)
+        if self.fuzzy:
+            self.add_forms(ids)
+        return len(ids)
+
+    def add_forms(self, ids: List[str]):
+        links = self.links(ids)
+        found = self.form_ids(form for form, _ in links)
+        new = sorted({form for form, _ in links} - found.keys())
+        if new:
+            first = self.conn.exec_driver_sql(f"SELECT COALESCE(MAX(id), 0) + 1 FROM {fuzzy_forms.name}").scalar()
+            found.update((form, first + i) for i, form in enumerate(new))
+            insert_rows(self.conn, fuzzy_forms, ((found[form], form) for form in new))
+            insert_rows(self.conn, fuzzy_grams, (
+                (gram, len(form), found[form]) for form in new for gram in grams(form)
+            ))
+        insert_rows(
+            self.conn, fuzzy_lemmas, ((found[form], lemma_id) for form, lemma_id in links), prefix="OR IGNORE "
+        )
+
+        # forms no lemma has any more
+        dropped = list(select_in(
+            self.conn, "SELECT id, form FROM fuzzy_forms WHERE id IN ({ids})", self.dropped_forms - set(found.values())
+        ))
+        orphans = [
+            (form_id, form)
+            for form_id, form in dropped
+            if self.conn.exec_driver_sql(
+                f"SELECT 1 FROM {fuzzy_lemmas.name} WHERE form_id = ? LIMIT 1", (form_id,)
+            ).first() is None
+        ]
+        if orphans:
+            self.conn.exec_driver_sql(
+                f"DELETE FROM {fuzzy_grams.name} WHERE gram = ? AND length = ? AND form_id = ?",
+                [(gram, len(form), form_id) for form_id, form in orphans for gram in grams(form)],
+            )
+            delete_in(self.conn, fuzzy_forms.name, "id", [form_id for form_id, _ in orphans])
+
+
+def main(
+    data_dir: str = DATA_DIR,
+    db_path: str = DB_PATH,
+    workers: int = 0,
+    incremental: bool = False,
+    bib_cache: Optional[str] = None,
+):
+    # create engine and tables; an incremental build only touches rows whose content changed
+    full = not (incremental and os.path.exists(db_path))
+    if not full and not schema_matches(db_path):
+        print("schema changed since the last build; rebuilding from scratch")
+        full = True
+    if full and os.path.exists(db_path):
+        os.remove(db_path)
+    engine = make_engine(db_path, BUILD_PRAGMAS if full else INCREMENTAL_PRAGMAS)
+    if full:
+        # a fresh database gets its indexes after loading, which beats maintaining them per row
+        with engine.begin() as conn:
+            for table in Base.metadata.sorted_tables:
+                conn.execute(CreateTable(table))
+    else:
+        Base.metadata.create_all(engine)
+    tables = Base.metadata.tables
+
+    # languages and parameters whose derived fields need recomputing (None = all)
+    affected_langs = None if full else set()
+    affected_params = None if full else set()
+
+    def previous_lemmas(ids: Iterable[str]):
+        """marks the languages and parameters of the stored versions of `ids` as affected,
+        and takes those versions out of the search indexes"""
+        if full:
+            return
+        indexes.remove(ids)
+        for language_id, origin_lemma_id in select_in(
+            conn, "SELECT language_id, origin_lemma_id FROM lemmas WHERE id IN ({ids})", ids
+        ):
+            affected_langs.add(language_id)
+            if origin_lemma_id:
+                affected_params.add(origin_lemma_id)
+
+    with engine.begin() as conn:
+        # the search indexes derived from lemmas follow each lemma an incremental build writes
+        indexes = None if full else LemmaIndexes(conn)
+
+        # languages
+        differ = Differ(conn, "languages", full)
+
+        def language_rows():
+            for row in tqdm(read_rows(os.path.join(data_dir, "languages.csv")), unit=" languages"):
+                language, dialect = row["Name"].split(": ") if ": " in row["Name"] else (row["Name"], "")
+                yield (
+                    row["ID"],
+                    row["Name"],
+                    language,
+                    dialect,
+                    row["Glottocode"],
+                    row["Longitude"],
+                    row["Latitude"],
+                    row["Clade"],
+                    colors[row["Clade"]],
+                    0,
+                    order.index(row["Clade"]),
+                    map_marker(row),
+                )
+
+        def languages_changed(rows):
+            if not full:
+                ids = [row[0] for row in rows]
+                affected_langs.update(ids)
+                affected_params.update(
+                    param for param, in select_in(
+                        conn, "SELECT DISTINCT origin_lemma_id FROM lemmas WHERE language_id IN ({ids})", ids
+                    ) if param
+                )
+
+        with stage("languages") as counter:
+            counter["rows"] = sync_rows(conn, differ, tables["languages"], language_rows(), languages_changed)
+            counter["rows"] += len(delete_rows(conn, differ, "languages"))
+        written = counter["rows"]
+
+        # parameters
+        param_orders = {}
+        differ = Differ(conn, "parameters", full)
+
+        def parameter_rows():
+            rows = read_rows(os.path.join(data_dir, "parameters.csv"))
+            for ordering, row in enumerate(tqdm(rows, unit=" parameters")):
+                param_orders[row["ID"]] = ordering * 1000
+                yield (
+                    row["ID"],
+                    row["Name"],
+                    row["Description"],
+                    None,
+                    None,
+                    None,
+                    row["Etyma"],
+                    None,
+                    None,
+                    ordering * 1000,
+                    row["Language_ID"],
+                    None,
+                    fold(row["Name"]),
+                    fold(row["Description"]),
+                    None,
+                )
+
+        def parameters_changed(rows):
+            previous_lemmas([row[0] for row in rows])
+            if not full:
+                affected_langs.update(row[10] for row in rows)
+                affected_params.update(row[0] for row in rows)
+
+        with stage("parameters") as counter:
+            counter["rows"] = sync_rows(conn, differ, tables["lemmas"], parameter_rows(), parameters_changed)
+            counter["rows"] += len(delete_rows(conn, differ, "lemmas", previous_lemmas))
+        written += counter["rows"]
+
+        # lemmata: read -> parse relation prefix -> parse refs -> write batches
+        param_cts = defaultdict(int)
+        cited_refs = set()
+        differ = Differ(conn, "forms", full)
+
+        def form_rows():
+            rows = read_rows(os.path.join(data_dir, "forms.csv"))
+            rows = transform(rows, (parse_relation, parse_refs, fold_keys), workers)
+            for row in tqdm(rows, unit=" forms"):
+                param = row["Parameter_ID"]
+                param_cts[param] += 1
+                cited_refs.update(row["Refs"])
+                # the refs ride along at the end of the tuple so that they are hashed too
+                yield (
+                    row["ID"],
+                    row["Form"],
+                    row["Gloss"],
+                    row["Native"],
+                    row["Phonemic"],
+                    row["Original"],
+                    row["Description"],
+                    None,
+                    row["Cognateset"],
+                    param_orders[param] + param_cts[param],
+                    row["Language_ID"],
+                    param,
+                    *row["Keys"],
+                    tuple(sorted(row["Refs"])),
+                )
+
+        def forms_changed(rows):
+            ids = [row[0] for row in rows]
+            previous_lemmas(ids)
+            if not full:
+                affected_langs.update(row[10] for row in rows)
+                affected_params.update(row[11] for row in rows)
+                delete_in(conn, "lemma_reference", "lemma_id", ids)
+            insert_rows(conn, tables["lemma_reference"], ((row[0], ref) for row in rows for ref in row[15]))
+
+        def forms_deleted(ids):
+            previous_lemmas(ids)
+            delete_in(conn, "lemma_reference", "lemma_id", ids)
+
+        with stage("forms") as counter:
+            counter["rows"] = sync_rows(conn, differ, tables["lemmas"], form_rows(), forms_changed)
+            counter["rows"] += len(delete_rows(conn, differ, "lemmas", forms_deleted))
+        written += counter["rows"]
+
+        # format sources into html; sources cited in forms.csv but missing from
+        # sources.bib get a bare row
+        differ = Differ(conn, "sources", full)
+
+        def reference_rows():
+            sources = pybtex.database.parse_file(os.path.join(data_dir, "sources.bib")).entries
+            formatted = format_sources(sources, bib_cache or default_bib_cache(db_path), workers)
+            for source, short in short_refs(sources).items():
+                cited_refs.discard(source)
+                yield (source, short, formatted[source], sources[source].fields.get("included", "No"))
+            for ref in sorted(cited_refs):
+                yield (ref, None, None, None)
+
+        with stage("references") as counter:
+            counter["rows"] = sync_rows(conn, differ, tables["references"], reference_rows())
+            counter["rows"] += len(delete_rows(conn, differ, "references"))
+        written += counter["rows"]
+
+        with stage("indexes", unit="indexes") as counter:
+            for table in Base.metadata.sorted_tables:
+                for index in table.indexes:
+                    index.create(conn, checkfirst=True)
+                    counter["rows"] += 1
+
+        # a full build indexes every lemma at once; the 'rebuild' of an external-content
+        # FTS table beats inserting its rows one by one
+        if indexes is None or not indexes.fts:
+            with stage("full-text index") as counter:
+                counter["rows"] = build_fts(conn)
+        if indexes is None or not indexes.fuzzy:
+            with stage("fuzzy index", unit="forms") as counter:
+                counter["rows"] = build_fuzzy(conn)
+        if indexes is not None:
+            with stage("search indexes") as counter:
+                counter["rows"] = indexes.add()
+
+        # update language lemma counts and parameter clades
+        with stage("derived fields") as counter:
+            counter["rows"] = update_derived(conn, affected_langs, affected_params)
+
+        # refresh the planner's statistics so it picks the composite indexes
+        conn.exec_driver_sql("ANALYZE")
+
+        # a new build id tells the app that cached pages and counts are stale
+        if written or not conn.exec_driver_sql("SELECT 1 FROM build_info WHERE key = 'build_id'").first():
+            insert_rows(
+                conn,
+                tables["build_info"],
+                [("build_id", uuid.uuid4().hex), ("built_at", datetime.now(timezone.utc).isoformat())],
+                prefix="OR REPLACE ",
+            )
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Build data.db from the Jambu CLDF dataset.")
+    parser.add_argument("--data", default=DATA_DIR, help="directory containing the CLDF tables")
+    parser.add_argument("--db", default=DB_PATH, help="path of the SQLite database to write")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="processes used to transform forms and format sources (0 = in-process)",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="update the existing database in place, rewriting only rows that changed",
+    )
+    parser.add_argument(
+        "--bib-cache", help=f"formatted sources cache (default: {BIB_CACHE} next to the database)"
+    )
+    args = parser.parse_args()
+    main(
+        data_dir=args.data,
+        db_path=args.db,
+        workers=args.workers,
+        incremental=args.incremental,
+        bib_cache=args.bib_cache,
+    )
 
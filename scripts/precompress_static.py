@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+"""
+Writes gzip (and, with brotli installed, brotli) copies of the static assets
+next to the originals, so the webapp can serve them without compressing on
+every request. Run after changing anything in src/static.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from src.neojambu.compression import precompress_directory
+
+STATIC_DIR = os.path.join(os.path.dirname(__file__), '..', 'src', 'static')
+
+
+def main():
+    written = precompress_directory(STATIC_DIR)
+    for path in written:
+        print(f"✅ {os.path.relpath(path, STATIC_DIR)}: {os.path.getsize(path)} bytes")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
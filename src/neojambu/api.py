@@ -0,0 +1,137 @@
+"""
+File: api.py
+Description: Column projections and JSON / NDJSON / CSV encoding for the /query and /export APIs.
+"""
+
+import csv
+import io
+import json
+
+from flask import Response, stream_with_context
+from .models import Language, Lemma, LemmaReference, Reference
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; the stdlib encoder is used without it
+    orjson = None
+
+# the columns each kind of row is exposed with; the folded *_key search columns stay internal
+LEMMA_FIELDS = [
+    "id", "word", "gloss", "native", "phonemic", "original", "notes",
+    "clades", "cognateset", "order", "language_id", "origin_lemma_id",
+]
+LANGUAGE_FIELDS = [
+    "id", "name", "language", "dialect", "glottocode", "long", "lat",
+    "clade", "color", "lemma_count", "order", "map_marker",
+]
+REFERENCE_FIELDS = ["id", "short", "source", "progress"]
+
+# rows pulled from SQLite per round trip while streaming
+STREAM_BATCH = 500
+# rows per fetchmany() batch, and so per chunk written, in bulk exports
+EXPORT_BATCH = 2000
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+def columns(entity, fields):
+    return [getattr(entity, field) for field in fields]
+
+
+def lemma_columns(entity=Lemma):
+    return columns(entity, LEMMA_FIELDS)
+
+
+def language_columns(entity=Language):
+    return columns(entity, LANGUAGE_FIELDS)
+
+
+def reference_columns(entity=Reference):
+    return columns(entity, REFERENCE_FIELDS)
+
+
+def record(fields, row):
+    """a projected row as a dict keyed by `fields`"""
+    return dict(zip(fields, row))
+
+
+def lemmas_by_id(session, ids):
+    """{id: lemma} for the lemmas among `ids`, in one query"""
+    rows = session.query(*lemma_columns()).filter(Lemma.id.in_(ids))
+    return {row.id: record(LEMMA_FIELDS, row) for row in rows}
+
+
+def languages_by_id(session, ids):
+    """{id: language} for the languages among `ids`, in one query"""
+    rows = session.query(*language_columns()).filter(Language.id.in_(ids))
+    return {row.id: record(LANGUAGE_FIELDS, row) for row in rows}
+
+
+def lemma_references(session, lemma_ids):
+    """{lemma id: [reference, ...]} for `lemma_ids` (a list or a subquery of ids), in one query"""
+    sources = {}
+    for lemma_id, *row in (
+        session.query(LemmaReference.lemma_id, *reference_columns())
+        .join(Reference, Reference.id == LemmaReference.reference_id)
+        .filter(LemmaReference.lemma_id.in_(lemma_ids))
+    ):
+        sources.setdefault(lemma_id, []).append(record(REFERENCE_FIELDS, row))
+    return sources
+
+
+def dumps(obj):
+    """compact UTF-8 JSON, through orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def json_response(obj, status=200, headers=None):
+    return Response(dumps(obj), status=status, headers=headers, mimetype="application/json")
+
+
+def ndjson_response(session, query, fields):
+    """
+    streams `query` as one JSON object per line, fetching STREAM_BATCH rows at a
+    time so that the full result is never held in memory; closes `session` when done
+    """
+
+    def generate():
+        try:
+            for row in query.yield_per(STREAM_BATCH):
+                yield dumps(record(fields, row)) + b"\n"
+        finally:
+            session.close()
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+def encode_batch(rows, fields, fmt):
+    if fmt == "csv":
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        return buffer.getvalue().encode()
+    return b"".join(dumps(record(fields, row)) + b"\n" for row in rows)
+
+
+def export_rows(engine, statement, fields, fmt):
+    """
+    runs `statement` on its own connection and yields the result EXPORT_BATCH rows at
+    a time, encoded as CSV (with a header row) or NDJSON; the connection is released
+    when the generator finishes or is closed by a client that went away
+    """
+    with engine.connect().execution_options(stream_results=True) as conn:
+        result = conn.execute(statement)
+        if fmt == "csv":
+            yield encode_batch([fields], fields, fmt)
+        while True:
+            rows = result.fetchmany(EXPORT_BATCH)
+            if not rows:
+                break
+            yield encode_batch(rows, fields, fmt)
+
+
+def export_response(engine, statement, fields, fmt, filename):
+    """a streamed download of `statement`; compress_response gzips it on the way out"""
+    response = Response(export_rows(engine, statement, fields, fmt), mimetype=EXPORT_FORMATS[fmt])
+    response.headers["Content-Disposition"] = f'attachment; filename="{filename}.{fmt}"'
+    return response
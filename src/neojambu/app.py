@@ -1,18 +1,36 @@
-from flask import Flask, render_template, request, url_for
-from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker, joinedload, Query
-from sqlalchemy.orm.collections import InstrumentedList
-from .models import Language, Lemma, Concept, Reference
+from flask import Flask, Response, abort, g, has_request_context, render_template, request, send_from_directory, url_for
+from sqlalchemy import bindparam, distinct, func, select, text
+from sqlalchemy.orm import sessionmaker, joinedload, selectinload, aliased, Query
+from .models import Language, Lemma, Concept, Reference, LemmaReference
 # Import colors from make_database script
 import sys
 import os
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'scripts'))
 from make_database import colors
 from markdown import markdown
+from markupsafe import Markup
 from jinja2 import Environment
 from itertools import groupby
 
-from .search import filter_data, filter_page
+from .search import (
+    detect_folded_keys, detect_fts, detect_fuzzy, enable_patterns, filter_data, filter_page,
+    filter_signature, filter_values, join_origin, page_keys, statement_shape, unindexed,
+)
+from .cache import BuildId, CompileStats, CountCache, ResponseCache, StatementCache
+from .db import DB_PATH, engine_from_env, env_int
+from .registry import Registry
+from .suggest import SUGGEST_LIMIT, Suggestions
+from .rows import LanguageRow, lemma_row_columns, lemma_rows
+from .compression import compress_response, precompressed
+from .api import (
+    LEMMA_FIELDS, LANGUAGE_FIELDS, REFERENCE_FIELDS,
+    lemma_columns, language_columns, reference_columns, record, json_response, ndjson_response,
+    EXPORT_FORMATS, export_response, lemmas_by_id, languages_by_id, lemma_references,
+)
+from functools import wraps
+import hashlib
+import re
+import mimetypes
 
 import os
 
@@ -23,33 +41,245 @@ static_dir = os.path.join(os.path.dirname(__file__), '..', 'static')
 app = Flask(__name__, template_folder=template_dir, static_folder=static_dir)
 app.jinja_env.filters["markdown"] = lambda text: markdown(text.replace("\\n", "\n\n"))
 
-# load database with connection pooling
-engine = create_engine(
-    "sqlite:///data.db",
-    pool_pre_ping=True,
-    pool_recycle=3600,
-    connect_args={'check_same_thread': False}
-)
+# clades in the order make_database.py lists their colours
+order = list(colors.keys())
+
+# load database with the engine profile picked by NEOJAMBU_DB_PROFILE (see db.py)
+engine = engine_from_env(DB_PATH)
 Session = sessionmaker(bind=engine)
 
+# filter through the full-text index when the build made one, and with fold=1 through
+# the folded keys when the build has them
+if os.path.exists(DB_PATH):
+    detect_fts(engine)
+    detect_folded_keys(engine)
+
+# listing counts are cached per filter signature until data.db is rebuilt. Setting
+# APPROXIMATE_COUNT_LIMIT (or NEOJAMBU_APPROXIMATE_COUNT_LIMIT) makes filters that have
+# to scan (see search.unindexed) stop counting at that many matches and report "N+"
+app.config.setdefault("APPROXIMATE_COUNT_LIMIT", env_int("NEOJAMBU_APPROXIMATE_COUNT_LIMIT", None))
+build_id = BuildId(engine, DB_PATH)
+counts = CountCache(build_id)
+
+# ?fuzzy=<edits> matches the word filter by edit distance when the build made the fuzzy tables
+if os.path.exists(DB_PATH):
+    detect_fuzzy(engine, build_id)
+
+# rendered pages are cached per route and query args, in each worker and in a
+# file next to data.db that both gunicorn workers share
+app.config.setdefault("RESPONSE_CACHE", True)
+app.config.setdefault("RESPONSE_CACHE_SIZE", 512)
+app.config.setdefault("RESPONSE_CACHE_BYTES", 128 * 1024 * 1024)
+responses = ResponseCache(
+    build_id,
+    os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "responses_cache.db"),
+    maxsize=app.config["RESPONSE_CACHE_SIZE"],
+    max_bytes=app.config["RESPONSE_CACHE_BYTES"],
+)
+
+
+def cached(view):
+    """serves a view's successful responses from the response cache"""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not app.config["RESPONSE_CACHE"]:
+            return view(*args, **kwargs)
+        # pages embed their own URL, so the host is part of the key
+        key = request.base_url + "?" + "&".join(
+            f"{name}={value}" for name, value in sorted(request.args.items(multi=True))
+        )
+        entry = responses.get(key)
+        if entry:
+            status, headers, body = entry
+            return Response(body, status=status, headers=headers)
+        response = app.make_response(view(*args, **kwargs))
+        if response.status_code == 200 and not response.is_streamed:
+            headers = [(name, value) for name, value in response.headers if name != "Content-Length"]
+            responses.set(key, response.status_code, headers, response.get_data())
+        return response
+
+    return wrapper
+
+
+# HTML and JSON above COMPRESS_MIN_SIZE go out gzip- or brotli-encoded. Flask runs
+# after_request hooks in reverse, so registering this before add_validators below
+# lets it see (and suffix) the ETag those set.
+app.config.setdefault("COMPRESS_MIN_SIZE", 1024)
+
+
+@app.after_request
+def compress(response):
+    return compress_response(response, request.accept_encodings, app.config["COMPRESS_MIN_SIZE"])
+
+
+def send_static(filename):
+    """serves the .br/.gz copy scripts/precompress_static.py made, when the client accepts it"""
+    found = precompressed(app.static_folder, filename, request.accept_encodings)
+    if found is None:
+        response = app.send_static_file(filename)
+    else:
+        path, encoding = found
+        response = send_from_directory(app.static_folder, path, mimetype=mimetypes.guess_type(filename)[0])
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+app.view_functions["static"] = send_static
+
+
+# conditional GET: a response depends only on its URL and the data.db build, so a
+# validator made from the two lets browsers and CDNs revalidate without a query
+app.config.setdefault("CACHE_MAX_AGE", 300)
+UNCACHEABLE_ENDPOINTS = {"static", "cache_stats"}
+build_id()  # fingerprint data.db at startup
+
+# languages and references (see registry.py), the typeahead indexes (see suggest.py) and
+# the form columns ?pattern= searches (see patterns.py) are read once per build and kept
+# in memory. Each is loaded on first use, or up front by init_app().
+registry = Registry(engine, build_id)
+suggestions = Suggestions(engine, build_id)
+pattern_index = enable_patterns(engine, build_id) if os.path.exists(DB_PATH) else None
+# no connection opened while importing should outlive a fork
+engine.dispose()
+
+
+def init_app():
+    """
+    loads the in-memory indexes for the current build. The deployment's app.py calls it,
+    so that gunicorn --preload builds them once, before forking, and the workers share
+    them; the pool is emptied afterwards so that no SQLite connection crosses the fork.
+    """
+    registry.refresh()
+    suggestions.refresh()
+    if pattern_index is not None:
+        pattern_index.refresh()
+    engine.dispose()
+    return app
+
+
+@app.errorhandler(re.error)
+def bad_pattern(error):
+    return f"Invalid pattern: {error}", 400
+
+
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.last_modified = build_id.built_at
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config["CACHE_MAX_AGE"]
+    return response
+
+
+@app.before_request
+def conditional_get():
+    if request.method not in ("GET", "HEAD") or request.endpoint in UNCACHEABLE_ENDPOINTS | {None}:
+        return None
+    build = build_id()
+    if build is None:
+        return None
+    g.etag = hashlib.sha1(f"{build} {request.full_path}".encode()).hexdigest()[:24]
+    if request.if_none_match:
+        # compressed representations carry the coding as a suffix (see compress_response)
+        for etag in [g.etag] + [f"{g.etag}-{encoding}" for encoding in ("br", "gzip")]:
+            if request.if_none_match.contains(etag):
+                return not_modified(etag)
+    elif request.if_modified_since and build_id.built_at <= request.if_modified_since:
+        return not_modified(g.etag)
+    return None
+
+
+@app.after_request
+def add_validators(response):
+    etag = g.get("etag")
+    if etag and response.status_code == 200:
+        response.set_etag(etag)
+        response.last_modified = build_id.built_at
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config["CACHE_MAX_AGE"]
+    return response
+
 # Create session per request instead of global session
 def get_session():
     return Session()
-order = list(colors.keys())
+
+
+# hot routes build their queries once per statement shape (see search.statement_shape)
+# and re-run them with each request's values; /cache/stats reports how often that, and
+# SQLAlchemy's own compiled-SQL cache, save the work
+statements = StatementCache()
+compiled = CompileStats(engine, lambda: request.endpoint if has_request_context() else None)
+
+
+def route_query(session, name, build, **params):
+    """
+    the (query, sort) `build` makes from filter_data for route `name`, built once per
+    statement shape and bound to `session` with this request's values; `params` fills
+    the route's own bindparams
+    """
+    query, sort = statements.get(name, statement_shape(request), build)
+    return query.with_session(session).params(**filter_values(request), **params), sort
+
+
+def count_rows(query, *key):
+    """row count of a filtered listing; `key` names the listing the query belongs to"""
+    limit = app.config["APPROXIMATE_COUNT_LIMIT"]
+    return counts.count(query, key + filter_signature(request), limit if limit and unindexed(request) else None)
+
+
+# the live filter UI (scripts.js) asks for ?fragment=results and gets only the count,
+# the result rows and the pager: the blocks of those names in the listing's template
+FRAGMENT_BLOCKS = ("showing", "results", "pager")
+
+
+def render_listing(template, **context):
+    """render_template, or with ?fragment=results just the template's fragment blocks"""
+    if request.args.get("fragment") != "results":
+        return render_template(template, **context)
+    listing = app.jinja_env.get_template(template)
+    app.update_template_context(context)
+    blocks = listing.new_context(context)
+    return render_template("fragment.html", **{
+        name: Markup("".join(listing.blocks[name](blocks)))
+        for name in FRAGMENT_BLOCKS
+        if name in listing.blocks
+    })
 
 @app.route("/")
 def hello_world():
     return render_template("index.html", title="Home")
 
 
-def serialise(query):
-    if type(query) in [Query, list, InstrumentedList]:
-        return [serialise(row) for row in query]
-    else:
-        result = query.__dict__
-        if "_sa_instance_state" in result:
-            del result["_sa_instance_state"]
-        return result
+def cursor_headers(next_cursor, prev_cursor):
+    """keyset pagination tokens for a page of /query results, passed back as ?cursor="""
+    headers = {}
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    if prev_cursor:
+        headers["X-Prev-Cursor"] = prev_cursor
+    return headers
+
+
+@app.route("/cache/stats")
+def cache_stats():
+    return {
+        "responses": responses.stats(),
+        "counts": {"hits": counts.cache.hits, "misses": counts.cache.misses},
+        "statements": {"built": statements.routes.stats(), "compiled": compiled.routes.stats()},
+    }
+
+
+@app.route("/suggest")
+def suggest():
+    """completions for a filter box: ?field=lang|clade|source|word|gloss&q=<prefix>"""
+    field = request.args.get("field")
+    if field not in suggestions.refresh().fields:
+        abort(400)
+    limit = min(max(request.args.get("limit", SUGGEST_LIMIT, type=int), 1), 50)
+    prefix = request.args.get("q", "")
+    return json_response(suggestions.complete(field, prefix, limit) if prefix else [])
 
 
 @app.route("/query")
@@ -60,103 +290,208 @@ def query():
     if query_type == "reflex":
         reflex = request.args.get("reflex")
         session = get_session()
-        lemma = session.query(Lemma).filter_by(id=reflex).first()
-        result = serialise(lemma)
+        row = session.query(*lemma_columns()).filter(Lemma.id == reflex).first()
         session.close()
-        return result
+        if row is None:
+            return json_response(None, 404)
+        return json_response(record(LEMMA_FIELDS, row))
 
     # list of reflexes
     if query_type == "reflexes":
         session = get_session()
-        lemmas, sort = filter_data(session.query(Lemma).join(Language), request, Lemma)
-        lemmas = lemmas.order_by(Lemma.order, Language.clade, Language.name)
-        lemmas = filter_page(lemmas, request)
-        result = serialise(lemmas)
+        lemmas, sort = filter_data(session.query(*lemma_columns()).join(Lemma.language), request, Lemma)
+        lemmas, next_cursor, prev_cursor = filter_page(lemmas, request, page_keys(request, [Lemma.order, Lemma.id]))
+        result = [record(LEMMA_FIELDS, row) for row in lemmas]
         session.close()
-        return result
+        return json_response(result, headers=cursor_headers(next_cursor, prev_cursor))
 
-    # a single language's reflexes
+    # a single language's reflexes, each with the etymon it descends from
     if query_type == "language":
         session = get_session()
         language = request.args.get("language")
-        lang = session.query(Language).filter_by(id=language).first()
+        origin = aliased(Lemma, name="origin")
         lemmas = (
-            session.query(Lemma)
-            .filter_by(language_id=language)
-            .options(joinedload(Lemma.origin_lemma))
-            .join(Language)
+            session.query(*lemma_columns(), *lemma_columns(origin))
+            .filter(Lemma.language_id == language)
+            .join(Lemma.language)
         )
         lemmas, sort = filter_data(lemmas, request, Lemma)
-        lemmas = lemmas.join(Lemma.origin_lemma, aliased=True).order_by(Lemma.order)
-        lemmas = filter_page(lemmas, request)
-
-        result = serialise(lemmas)
-        for i in range(len(result)):
-            result[i]["origin_lemma"] = serialise(result[i]["origin_lemma"])
+        lemmas = lemmas.join(Lemma.origin_lemma.of_type(origin))
+        lemmas, next_cursor, prev_cursor = filter_page(lemmas, request, page_keys(request, [Lemma.order, Lemma.id]))
+
+        width = len(LEMMA_FIELDS)
+        result = []
+        for row in lemmas:
+            lemma = record(LEMMA_FIELDS, row[:width])
+            lemma["origin_lemma"] = record(LEMMA_FIELDS, row[width:])
+            result.append(lemma)
         session.close()
-        return result
+        return json_response(result, headers=cursor_headers(next_cursor, prev_cursor))
 
     # all languages
     if query_type == "languages":
         session = get_session()
-        langs = session.query(Language).order_by(Language.order, Language.name)
+        langs = session.query(*language_columns()).order_by(Language.order, Language.name)
         langs, sort = filter_data(langs, request, Language)
-        result = serialise(langs)
+        if request.args.get("format") == "ndjson":
+            return ndjson_response(session, langs, LANGUAGE_FIELDS)
+        result = [record(LANGUAGE_FIELDS, row) for row in langs]
         session.close()
-        return result
+        return json_response(result)
 
-    # a single entry's reflexes
+    # a single entry's reflexes, with their languages and sources
     if query_type == "entry":
         session = get_session()
         entry = request.args.get("entry")
         reflexes = (
-            session.query(Lemma)
-            .filter_by(origin_lemma_id=entry)
-            .options(joinedload(Lemma.language), joinedload(Lemma.references))
+            session.query(*lemma_columns(), *language_columns())
+            .filter(Lemma.origin_lemma_id == entry)
+            .join(Lemma.language)
         )
         reflexes, sort = filter_data(reflexes, request, Lemma)
-        result = serialise(reflexes)
-        for i in range(len(result)):
-            result[i]["language"] = serialise(result[i]["language"])
-            result[i]["references"] = serialise(result[i]["references"])
+        # sources for all of the entry's reflexes in one query rather than one per reflex
+        sources = lemma_references(session, select(Lemma.id).where(Lemma.origin_lemma_id == entry))
+
+        width = len(LEMMA_FIELDS)
+        result = []
+        for row in reflexes:
+            lemma = record(LEMMA_FIELDS, row[:width])
+            lemma["language"] = record(LANGUAGE_FIELDS, row[width:])
+            lemma["references"] = sources.get(lemma["id"], [])
+            result.append(lemma)
         session.close()
-        return result
+        return json_response(result)
 
     # all entries
     if query_type == "entries":
         session = get_session()
         entries = (
-            session.query(Lemma)
+            session.query(*lemma_columns())
             .filter(Lemma.origin_lemma_id == None)
-            .order_by(Lemma.order)
         )
-        entries, sort = filter_data(entries.join(Language), request, Lemma)
-        entries = filter_page(entries, request)
-        result = serialise(entries)
+        entries, sort = filter_data(entries.join(Lemma.language), request, Lemma)
+        entries, next_cursor, prev_cursor = filter_page(entries, request, page_keys(request, [Lemma.order, Lemma.id]))
+        result = [record(LEMMA_FIELDS, row) for row in entries]
         session.close()
-        return result
+        return json_response(result, headers=cursor_headers(next_cursor, prev_cursor))
 
     # single ref
     if query_type == "reference":
         session = get_session()
         reference = request.args.get("reference")
-        source = session.query(Reference).filter_by(id=reference).first()
-        result = serialise(source)
+        row = session.query(*reference_columns()).filter(Reference.id == reference).first()
         session.close()
-        return result
+        if row is None:
+            return json_response(None, 404)
+        return json_response(record(REFERENCE_FIELDS, row))
 
     # all refs
     if query_type == "references":
         session = get_session()
-        sources = session.query(Reference)
+        sources = session.query(*reference_columns())
         sources, sort = filter_data(sources, request, Reference)
-        result = serialise(sources)
+        if request.args.get("format") == "ndjson":
+            return ndjson_response(session, sources, REFERENCE_FIELDS)
+        result = [record(REFERENCE_FIELDS, row) for row in sources]
+        session.close()
+        return json_response(result)
+
+
+# POST /query/batch resolves many ids per type with a fixed number of queries;
+# BATCH_LIMIT caps the ids of each type so that one request stays cheap
+app.config.setdefault("BATCH_LIMIT", 1000)
+BATCH_TYPES = ("reflex", "entry", "language")
+
+
+@app.route("/query/batch", methods=["POST"])
+def query_batch():
+    """
+    takes {"reflex": [ids], "entry": [ids], "language": [ids]} (any subset) and
+    returns the same shape with each list replaced by a map from id to result:
+    a reflex with its language, origin_lemma and references; an entry's reflexes,
+    as /query?type=entry returns them; or a language. Unknown ids map to null.
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not body or not set(body) <= set(BATCH_TYPES):
+        return json_response({"error": f"expected an object with keys among {', '.join(BATCH_TYPES)}"}, 400)
+    for kind, ids in body.items():
+        if not isinstance(ids, list) or not all(isinstance(id, (str, int)) for id in ids):
+            return json_response({"error": f"{kind} must be a list of ids"}, 400)
+        if len(ids) > app.config["BATCH_LIMIT"]:
+            return json_response({"error": f"at most {app.config['BATCH_LIMIT']} ids per type"}, 400)
+    ids = {kind: list(dict.fromkeys(str(id) for id in body[kind])) for kind in body}
+
+    session = get_session()
+    result = {}
+    if "reflex" in ids:
+        lemmas = lemmas_by_id(session, ids["reflex"])
+        langs = languages_by_id(session, {lemma["language_id"] for lemma in lemmas.values()})
+        origins = lemmas_by_id(session, {lemma["origin_lemma_id"] for lemma in lemmas.values()} - {None})
+        sources = lemma_references(session, list(lemmas))
+        for lemma in lemmas.values():
+            lemma["language"] = langs.get(lemma["language_id"])
+            lemma["origin_lemma"] = origins.get(lemma["origin_lemma_id"])
+            lemma["references"] = sources.get(lemma["id"], [])
+        result["reflex"] = {id: lemmas.get(id) for id in ids["reflex"]}
+
+    if "entry" in ids:
+        reflexes = (
+            session.query(*lemma_columns(), *language_columns())
+            .filter(Lemma.origin_lemma_id.in_(ids["entry"]))
+            .join(Lemma.language)
+        )
+        sources = lemma_references(session, select(Lemma.id).where(Lemma.origin_lemma_id.in_(ids["entry"])))
+        found = set(lemmas_by_id(session, ids["entry"]))
+        result["entry"] = {id: [] if id in found else None for id in ids["entry"]}
+        width = len(LEMMA_FIELDS)
+        for row in reflexes:
+            lemma = record(LEMMA_FIELDS, row[:width])
+            lemma["language"] = record(LANGUAGE_FIELDS, row[width:])
+            lemma["references"] = sources.get(lemma["id"], [])
+            result["entry"][lemma["origin_lemma_id"]].append(lemma)
+
+    if "language" in ids:
+        langs = languages_by_id(session, ids["language"])
+        result["language"] = {id: langs.get(id) for id in ids["language"]}
+    session.close()
+    return json_response(result)
+
+
+# bulk downloads of lemmas, streamed straight from a database cursor
+exports = {
+    "languages": (Language, lambda id: Lemma.language_id == id),
+    "entries": (Lemma, lambda id: Lemma.origin_lemma_id == id),
+    "references": (Reference, lambda id: Lemma.id.in_(
+        select(LemmaReference.lemma_id).where(LemmaReference.reference_id == id)
+    )),
+}
+
+
+@app.route("/export/lemmas")
+@app.route("/export/<kind>/<id>")
+def export(kind=None, id=None):
+    fmt = request.args.get("format", "csv")
+    if fmt not in EXPORT_FORMATS:
+        abort(400)
+    statement = select(*lemma_columns())
+    filename = "lemmas"
+    if kind is not None:
+        if kind not in exports:
+            abort(404)
+        model, condition = exports[kind]
+        session = get_session()
+        found = session.query(model.id).filter(model.id == id).first()
         session.close()
-        return result
+        if found is None:
+            abort(404)
+        statement = statement.where(condition(id)).order_by(Lemma.order)
+        filename = f"lemmas-{kind}-{id}"
+    return export_response(engine, statement, LEMMA_FIELDS, fmt, filename)
 
 
 @app.route("/reflexes")
 @app.route("/reflexes/<reflex>")
+@cached
 def reflexes(reflex=None):
     page = int(request.args.get("page", 1))
     if reflex:
@@ -164,7 +499,7 @@ def reflexes(reflex=None):
         lemma = session.query(Lemma).options(
             joinedload(Lemma.language), 
             joinedload(Lemma.origin_lemma).joinedload(Lemma.language),
-            joinedload(Lemma.references)
+            selectinload(Lemma.references)
         ).filter_by(id=reflex).first()
         session.close()
         if lemma:
@@ -174,23 +509,27 @@ def reflexes(reflex=None):
         return "Lemma not found"
     else:
         session = get_session()
-        lemmas, sort = filter_data(session.query(Lemma).join(Language), request, Lemma)
-        if sort:
-            lemmas = lemmas.order_by(Lemma.order, Language.clade, Language.name)
-        
+        lemmas, sort = route_query(session, "reflexes", lambda: filter_data(
+            join_origin(Query(lemma_row_columns(with_origin=True)).join(Lemma.language)),
+            request,
+            Lemma,
+            joined=[join_origin],
+        ))
+
         # Optimize: Get count first, then get page results
-        count = lemmas.count()
-        reflexes_list = lemmas.options(
-            joinedload(Lemma.language), 
-            joinedload(Lemma.origin_lemma).joinedload(Lemma.language),
-            joinedload(Lemma.references)
-        ).offset(page * 50 - 50).limit(50).all()
+        count = count_rows(lemmas, "reflexes")
+        rows, next_cursor, prev_cursor = filter_page(
+            lemmas, request, page_keys(request, [Lemma.order, Lemma.id])
+        )
+        reflexes_list = registry.attach(session, lemma_rows(rows, with_origin=True, unique=True))
         session.close()
         
-        return render_template(
+        return render_listing(
             "reflexes.html",
             reflexes=reflexes_list,
             page=page,
+            next_cursor=next_cursor,
+            prev_cursor=prev_cursor,
             count=count,
             title="Reflexes",
         )
@@ -198,116 +537,59 @@ def reflexes(reflex=None):
 
 @app.route("/languages")
 @app.route("/languages/<lang1>")
-@app.route("/languages/<lang1>/<lang2>")
-def languages(lang1=None, lang2=None):
+@cached
+def languages(lang1=None):
     page = int(request.args.get("page", 1))
-    if lang1 and lang2:
-        session = get_session()
-        lang1_data = (
-            session.query(Lemma)
-            .filter_by(language_id=lang1)
-            .filter(Lemma.origin_lemma_id is not None)
-            .join(Lemma.origin_lemma, aliased=True)
-            .order_by(Lemma.order)
-            .all()
-        )
-        lang2_data = (
-            session.query(Lemma)
-            .filter_by(language_id=lang2)
-            .filter(Lemma.origin_lemma_id is not None)
-            .join(Lemma.origin_lemma, aliased=True)
-            .order_by(Lemma.order)
-            .all()
-        )
-        lang1_data = [(x.origin_lemma_id, x) for x in lang1_data]
-        lang2_data = [(x.origin_lemma_id, x) for x in lang2_data]
-        lang1_dict, lang2_dict = {}, {}
-
-        for i in lang1_data:
-            if i[0] not in lang1_dict:
-                lang1_dict[i[0]] = []
-            lang1_dict[i[0]].append(i[1])
-        for i in lang2_data:
-            if i[0] not in lang2_dict:
-                lang2_dict[i[0]] = []
-            lang2_dict[i[0]].append(i[1])
-
-        both = []
-        for i in lang1_dict:
-            if i in lang2_dict:
-                both.append(i)
-
-        lang1 = session.query(Language).filter_by(id=lang1).first()
-        lang2 = session.query(Language).filter_by(id=lang2).first()
-        session.close()
-
-        if lang1 and lang2:
-            return render_template(
-                "compare.html",
-                colors=colors,
-                both=both,
-                count=len(both),
-                lang1=lang1,
-                lang2=lang2,
-                lang_dict=lang1_dict,
-                lang2_dict=lang2_dict,
-                title=f"Languages {lang1.name} vs {lang2.name}",
-            )
-        else:
-            return "Language not found"
-
-    elif lang1:
+    if lang1:
         page = int(request.args.get("page", 1))
-        session = get_session()
-
-        language = session.query(Language).filter_by(id=lang1).first()
+        language = registry.language(lang1)
         if language:
-            lemmas = (
-                session.query(Lemma)
-                .filter_by(language_id=lang1)
-                .options(joinedload(Lemma.origin_lemma))
-            )
-            lemmas, sort = filter_data(lemmas.join(Language), request, Lemma)
-            if sort:
-                lemmas = lemmas.order_by(Lemma.order)
+            session = get_session()
+            lemmas, sort = route_query(session, "language", lambda: filter_data(
+                join_origin(
+                    Query(lemma_row_columns(with_origin=True))
+                    .filter(Lemma.language_id == bindparam("language_id"))
+                    .join(Lemma.language)
+                ),
+                request,
+                Lemma,
+                joined=[join_origin],
+            ), language_id=lang1)
 
             # Optimize: Get count first, then get page results
-            count = lemmas.count()
-            reflexes_list = lemmas.options(
-            joinedload(Lemma.language), 
-            joinedload(Lemma.origin_lemma).joinedload(Lemma.language),
-            joinedload(Lemma.references)
-        ).offset(page * 50 - 50).limit(50).all()
+            count = count_rows(lemmas, "language", lang1)
+            rows, next_cursor, prev_cursor = filter_page(
+                lemmas, request, page_keys(request, [Lemma.order, Lemma.id])
+            )
+            reflexes_list = registry.attach(session, lemma_rows(rows, with_origin=True, unique=True))
             session.close()
 
-            return render_template(
+            return render_listing(
                 "reflexes.html",
                 lang=language,
                 colors=colors,
                 count=count,
                 reflexes=reflexes_list,
                 page=page,
+                next_cursor=next_cursor,
+                prev_cursor=prev_cursor,
                 title=f"Language {language.name}",
             )
         else:
-            session.close()
             return "Language not found"
 
-    elif lang2:
-        return "Wut did you do"
-
     else:
         session = get_session()
-        langs = session.query(Language)
+        langs = session.query(*language_columns())
         langs, sort = filter_data(langs, request, Language)
         if sort:
             langs = langs.order_by(Language.order, Language.name)
         
-        langs_list = langs.all()
-        count = langs.count()
+        langs_list = [LanguageRow(*row) for row in langs]
+        count = len(langs_list)
         session.close()
         
-        return render_template(
+        return render_listing(
             "langs.html",
             langs=langs_list,
             count=count,
@@ -316,38 +598,97 @@ def languages(lang1=None, lang2=None):
         )
 
 
+# /languages/<a>/<b>/... lists the etyma with reflexes in every one of the languages
+app.config.setdefault("COMPARE_LIMIT", 8)
+
+
+@app.route("/languages/<lang1>/<path:others>")
+@cached
+def compare(lang1, others):
+    page = int(request.args.get("page", 1))
+    ids = list(dict.fromkeys([lang1] + [id for id in others.split("/") if id]))
+    if len(ids) > app.config["COMPARE_LIMIT"]:
+        return f"Compare at most {app.config['COMPARE_LIMIT']} languages"
+    langs = [registry.language(id) for id in ids]
+    if None in langs:
+        return "Language not found"
+    session = get_session()
+
+    # etyma reflected in all of the languages, found by grouping their reflexes in SQL
+    shared = (
+        select(Lemma.origin_lemma_id)
+        .where(Lemma.language_id.in_(ids), Lemma.origin_lemma_id != None)
+        .group_by(Lemma.origin_lemma_id)
+        .having(func.count(distinct(Lemma.language_id)) == len(ids))
+    )
+    etyma = session.query(*lemma_row_columns()).filter(Lemma.id.in_(shared))
+    count = counts.count(etyma, ("compare",) + tuple(ids))
+    etyma, next_cursor, prev_cursor = filter_page(etyma, request, [(Lemma.order, False), (Lemma.id, False)])
+    etyma = lemma_rows(etyma)
+
+    # then only the page's reflexes are loaded
+    reflexes = {etymon.id: {id: [] for id in ids} for etymon in etyma}
+    for reflex in lemma_rows(
+        session.query(*lemma_row_columns())
+        .filter(Lemma.origin_lemma_id.in_(list(reflexes)), Lemma.language_id.in_(ids))
+        .order_by(Lemma.order)
+    ):
+        reflexes[reflex.origin_lemma_id][reflex.language_id].append(reflex)
+    session.close()
+
+    return render_template(
+        "compare.html",
+        colors=colors,
+        langs=langs,
+        etyma=etyma,
+        reflexes=reflexes,
+        count=count,
+        page=page,
+        next_cursor=next_cursor,
+        prev_cursor=prev_cursor,
+        title="Languages " + " vs ".join(lang.name for lang in langs),
+    )
+
+
 @app.route("/entries")
 @app.route("/entries/<entry>")
+@cached
 def entries(entry=None, lang=None):
     page = int(request.args.get("page", 1))
     if entry:
         session = get_session()
         entry_info = session.query(Lemma).options(joinedload(Lemma.language)).filter_by(id=entry).first()
         if entry_info:
-            reflexes_query = session.query(Lemma).filter_by(origin_lemma_id=entry).join(Language)
-            total_count = reflexes_query.count()
-            reflexes_query, sort = filter_data(
-                reflexes_query,
-                request,
-                Lemma,
-            )
-            count = reflexes_query.count()
+            # unfiltered, every reflex is loaded below anyway, so the total is just their number
+            total_count = counts.count(
+                session.query(Lemma).filter_by(origin_lemma_id=entry), ("entry", entry)
+            ) if filter_signature(request) else None
+
+            def build():
+                reflexes_query, sort = filter_data(
+                    Query(lemma_row_columns())
+                    .filter(Lemma.origin_lemma_id == bindparam("entry_id"))
+                    .join(Lemma.language),
+                    request,
+                    Lemma,
+                )
+                if sort:
+                    reflexes_query = reflexes_query.order_by(Lemma.cognateset)
+                return reflexes_query, sort
+
+            # the reflexes are loaded once; both groupings below are made from this list
+            reflexes_query, sort = route_query(session, "entry", build, entry_id=entry)
+            reflexes_list = registry.attach(session, lemma_rows(reflexes_query))
+            count = len(reflexes_list)
+            if total_count is None:
+                total_count = count
+            language_order = lambda lemma: (lemma.language.order, lemma.language.name)
 
             # group reflexes by cognate set first (i.e. subgroup)
-            if sort:
-                reflexes_cognatesets = reflexes_query.options(
-                    joinedload(Lemma.language),
-                    joinedload(Lemma.references)
-                ).order_by(Lemma.cognateset).all()
-            else:
-                reflexes_cognatesets = reflexes_query.options(
-                    joinedload(Lemma.language),
-                    joinedload(Lemma.references)
-                ).all()
             grouped_cognatesets = [
                 [key, list(group)]
                 for key, group in groupby(
-                    reflexes_cognatesets, key=lambda lemma: lemma.cognateset if sort else None
+                    reflexes_list, key=lambda lemma: lemma.cognateset if sort else None
                 )
             ]
             if sort:
@@ -356,9 +697,7 @@ def entries(entry=None, lang=None):
             # subgroup each cognateset by language
             for i in range(len(grouped_cognatesets)):
                 if sort:
-                    grouped_cognatesets[i][1].sort(
-                        key=lambda x: (x.language.order, x.language.name)
-                    )
+                    grouped_cognatesets[i][1].sort(key=language_order)
                 grouped_cognatesets[i][1] = [
                     (key, list(group))
                     for key, group in groupby(
@@ -367,16 +706,10 @@ def entries(entry=None, lang=None):
                 ]
 
             # by langs separately (for dots on map)
-            reflexes_langs = reflexes_query.options(
-                joinedload(Lemma.language),
-                joinedload(Lemma.references)
-            ).order_by(
-                Language.order, Language.name
-            ).all()
             grouped_langs = {
                 key: list(group)
                 for key, group in groupby(
-                    reflexes_langs, key=lambda lemma: lemma.language
+                    sorted(reflexes_list, key=language_order), key=lambda lemma: lemma.language
                 )
             }
             session.close()
@@ -397,25 +730,29 @@ def entries(entry=None, lang=None):
             return "Entry not found"
     else:
         session = get_session()
-        entries_query = (
-            session.query(Lemma)
+        entries, sort = route_query(session, "entries", lambda: filter_data(
+            Query(lemma_row_columns())
             .filter(Lemma.origin_lemma_id == None)
-            .options(joinedload(Lemma.language))  # Eagerly load language relationship
-        )
-        entries, sort = filter_data(entries_query.join(Language), request, Lemma)
-        if sort:
-            entries = entries.order_by(Lemma.order)
-        
+            .join(Lemma.language),
+            request,
+            Lemma,
+        ))
+
         # Optimize: Get count first, then get page results
-        count = entries.count()
-        entries_list = entries.offset(page * 50 - 50).limit(50).all()
+        count = count_rows(entries, "entries")
+        rows, next_cursor, prev_cursor = filter_page(
+            entries, request, page_keys(request, [Lemma.order, Lemma.id])
+        )
+        entries_list = registry.attach(session, lemma_rows(rows), references=False)
         session.close()
         
-        return render_template(
+        return render_listing(
             "entries.html",
             entries=entries_list,
             count=count,
             page=page,
+            next_cursor=next_cursor,
+            prev_cursor=prev_cursor,
             colors=colors,
             order=order,
             title="Entries",
@@ -424,6 +761,7 @@ def entries(entry=None, lang=None):
 
 @app.route("/references")
 @app.route("/references/<ref>")
+@cached
 def references(ref=None):
     if ref:
         session = get_session()
@@ -438,11 +776,10 @@ def references(ref=None):
         else:
             return "Source not found"
     else:
-        session = get_session()
-        refs = session.query(Reference).all()
-        session.close()
+        refs = list(registry.refresh().references.values())
         return render_template("references.html", sources=refs, title="Sources")
 
 
 if __name__ == "__main__":
+    init_app()
     app.run(threaded=True, port=2222)
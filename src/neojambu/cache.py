@@ -0,0 +1,329 @@
+"""
+File: cache.py
+Description: Caches for values derived from data.db (counts, rendered responses), keyed by the
+database build id so that a rebuilt database never serves stale results.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from sqlalchemy import event, text
+from sqlalchemy.engine.default import CACHE_HIT, CACHE_MISS
+
+
+class LRUCache:
+    """
+    a thread-safe dict that forgets its least recently used entries past `maxsize`
+    entries or, with `max_bytes` set, past that total `sizeof` of its values
+    """
+
+    def __init__(self, maxsize=1024, max_bytes=None, sizeof=len):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.data = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def size(self, value):
+        return self.sizeof(value) if self.max_bytes else 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return self.data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self.lock:
+            if key in self.data:
+                self.bytes -= self.size(self.data[key])
+            self.data[key] = value
+            self.data.move_to_end(key)
+            self.bytes += self.size(value)
+            while len(self.data) > self.maxsize or (self.max_bytes and self.bytes > self.max_bytes):
+                _, evicted = self.data.popitem(last=False)
+                self.bytes -= self.size(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self.data)
+
+
+class BuildId:
+    """
+    the build id make_database.py stored in data.db, re-read whenever the file is
+    replaced or modified; databases built before build_info existed fall back to
+    the file's modification time. `built_at` is when that build was made. When the
+    file changes under a running app, pooled connections are dropped so that new
+    ones open the new file (see db.serving_engine).
+    """
+
+    def __init__(self, engine, path=None):
+        self.engine = engine
+        self.path = path or engine.url.database
+        self.stamp = None
+        self.value = None
+        self.built_at = None
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        stamp = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            if stamp != self.stamp:
+                if self.stamp is not None:
+                    self.engine.dispose()
+                info = self.read()
+                self.value = info.get("build_id") or f"mtime-{stat.st_mtime_ns}"
+                self.built_at = (
+                    datetime.fromisoformat(info["built_at"]) if "built_at" in info
+                    else datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+                ).replace(microsecond=0)
+                self.stamp = stamp
+            return self.value
+
+    def read(self):
+        with self.engine.connect() as conn:
+            if not conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'build_info'")).first():
+                return {}
+            return dict(conn.execute(text("SELECT key, value FROM build_info")).fetchall())
+
+
+class CountCache:
+    """row counts of listing queries, memoised per filter signature and build"""
+
+    def __init__(self, build_id, maxsize=4096):
+        self.build_id = build_id
+        self.cache = LRUCache(maxsize)
+
+    def count(self, query, key, limit=None):
+        """
+        query.count(), cached under `key`; with `limit` set, counting stops after
+        `limit` matches and the result is the string "<limit>+"
+        """
+        key = (self.build_id(), limit) + tuple(key)
+        result = self.cache.get(key)
+        if result is None:
+            if limit:
+                result = query.order_by(None).limit(limit + 1).count()
+                if result > limit:
+                    result = f"{limit}+"
+            else:
+                result = query.order_by(None).count()
+            self.cache.set(key, result)
+        return result
+
+
+class RouteCounter:
+    """hit and miss counts per route"""
+
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def add(self, route, hit):
+        with self.lock:
+            counts = self.counts.setdefault(route, [0, 0])
+            counts[0 if hit else 1] += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                route: {"hits": hits, "misses": misses, "hit_rate": round(hits / (hits + misses), 3)}
+                for route, (hits, misses) in self.counts.items()
+                if hits + misses
+            }
+
+
+class StatementCache:
+    """
+    route queries built once per route and statement shape (which filters and sort a
+    request uses, not their values) and re-run with each request's values via .params()
+    """
+
+    def __init__(self, maxsize=1024):
+        self.cache = LRUCache(maxsize)
+        self.routes = RouteCounter()
+
+    def get(self, route, shape, build):
+        key = (route,) + tuple(shape)
+        statement = self.cache.get(key)
+        self.routes.add(route, statement is not None)
+        if statement is None:
+            statement = build()
+            self.cache.set(key, statement)
+        return statement
+
+    def clear(self):
+        self.cache.clear()
+
+
+class CompileStats:
+    """whether SQLAlchemy found each statement a route ran in its compiled-SQL cache"""
+
+    def __init__(self, engine, route):
+        self.route = route
+        self.routes = RouteCounter()
+        event.listen(engine, "after_cursor_execute", self.record)
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        if context is None or context.cache_hit not in (CACHE_HIT, CACHE_MISS):
+            return
+        route = self.route()
+        if route is not None:  # statements run outside a request are not a route's
+            self.routes.add(route, context.cache_hit is CACHE_HIT)
+
+
+class DiskCache:
+    """
+    a SQLite file shared by every worker process, trimmed to `max_bytes` by
+    dropping the least recently read entries; entries from other builds are
+    discarded the first time a new build writes
+    """
+
+    def __init__(self, path, max_bytes=128 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.conn = None
+        self.build = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, timeout=1, isolation_level=None, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode = WAL")
+            self.conn.execute("PRAGMA synchronous = NORMAL")
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY, build TEXT, value BLOB, size INTEGER, accessed REAL
+                )"""
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        return self.conn
+
+    def get(self, build, key):
+        try:
+            with self.lock:
+                conn = self.connect()
+                row = conn.execute("SELECT value FROM responses WHERE key = ? AND build = ?", (key, build)).fetchone()
+                if row:
+                    conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+        except sqlite3.Error:
+            # a busy or unwritable cache is just a miss
+            return None
+        return row[0] if row else None
+
+    def set(self, build, key, value):
+        try:
+            with self.lock:
+                conn = self.connect()
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    if build != self.build:
+                        conn.execute("DELETE FROM responses WHERE build != ?", (build,))
+                        self.build = build
+                    conn.execute(
+                        "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                        (key, build, value, len(value), time.time()),
+                    )
+                    self.evict(conn)
+                    conn.execute("COMMIT")
+                except sqlite3.Error:
+                    conn.execute("ROLLBACK")
+                    raise
+        except sqlite3.Error:
+            pass
+
+    def evict(self, conn):
+        excess = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0] - self.max_bytes
+        if excess > 0:
+            # drop the least recently read entries until a quarter of the budget is free again
+            excess += self.max_bytes // 4
+            for key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                excess -= size
+                if excess <= 0:
+                    break
+
+    def stats(self):
+        try:
+            with self.lock:
+                return self.connect().execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+                ).fetchone()
+        except sqlite3.Error:
+            return (None, None)
+
+    def clear(self):
+        try:
+            with self.lock:
+                self.connect().execute("DELETE FROM responses")
+        except sqlite3.Error:
+            pass
+
+
+class ResponseCache:
+    """
+    rendered responses in two tiers: an LRU in each worker and a DiskCache
+    shared between workers; both are keyed by the build id, and each holds at
+    most `max_bytes` of response bodies
+    """
+
+    def __init__(self, build_id, path, maxsize=512, max_bytes=128 * 1024 * 1024):
+        self.build_id = build_id
+        self.memory = LRUCache(maxsize, max_bytes, sizeof=lambda entry: len(entry[2]))
+        self.disk = DiskCache(path, max_bytes)
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """(status, headers, body) cached under `key`, or None"""
+        build = self.build_id()
+        entry = self.memory.get((build, key))
+        if entry is None:
+            value = self.disk.get(build, key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            head, body = value.split(b"\n", 1)
+            status, headers = json.loads(head)
+            entry = (status, headers, body)
+            self.memory.set((build, key), entry)
+        return entry
+
+    def set(self, key, status, headers, body):
+        build = self.build_id()
+        self.memory.set((build, key), (status, headers, body))
+        self.disk.set(build, key, json.dumps([status, headers]).encode() + b"\n" + body)
+
+    def clear(self):
+        self.memory.clear()
+        self.disk.clear()
+
+    def stats(self):
+        entries, size = self.disk.stats()
+        return {
+            "build_id": self.build_id(),
+            "memory": {"hits": self.memory.hits, "entries": len(self.memory), "bytes": self.memory.bytes},
+            "disk": {"hits": self.disk_hits, "entries": entries, "bytes": size},
+            "misses": self.misses,
+        }
@@ -0,0 +1,143 @@
+"""
+File: compression.py
+Description: gzip / brotli content negotiation for dynamic responses and precompressed static assets.
+"""
+
+import gzip
+import mimetypes
+import os
+import zlib
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+COMPRESSIBLE = {
+    "text/html",
+    "text/css",
+    "text/plain",
+    "text/csv",
+    "text/javascript",
+    "application/javascript",
+    "application/json",
+    "application/x-ndjson",
+    "image/svg+xml",
+}
+
+# dynamic responses are compressed on every request, so favour speed over ratio;
+# precompressed static files are made once and use the strongest settings
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+STATIC_GZIP_LEVEL = 9
+STATIC_BROTLI_QUALITY = 11
+
+SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+
+def available():
+    """content codings this process can produce, in order of preference"""
+    return ["br", "gzip"] if brotli else ["gzip"]
+
+
+def negotiate(accept_encodings, offered=None):
+    """the preferred coding the client accepts (werkzeug's parsed Accept-Encoding), or None"""
+    for encoding in offered or available():
+        if accept_encodings[encoding] > 0:
+            return encoding
+    return None
+
+
+def compress(data, encoding, static=False):
+    if encoding == "br":
+        return brotli.compress(data, quality=STATIC_BROTLI_QUALITY if static else BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=STATIC_GZIP_LEVEL if static else GZIP_LEVEL, mtime=0)
+
+
+def compress_stream(chunks, encoding):
+    """compresses an iterable of byte strings as it is consumed, yielding compressed chunks"""
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        process, finish = compressor.process, compressor.finish
+    else:
+        # wbits=31 writes a gzip header and trailer around the deflate stream
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        process, finish = compressor.compress, compressor.flush
+    try:
+        for chunk in chunks:
+            data = process(chunk)
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def compress_response(response, accept_encodings, min_size):
+    """
+    compresses a finished response in place when it is worth it and the client accepts it;
+    streamed responses are compressed chunk by chunk as they are sent, whatever their size
+    """
+    if (
+        response.status_code != 200
+        or response.direct_passthrough
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in COMPRESSIBLE
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate(accept_encodings)
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+    elif response.content_length is None or response.content_length < min_size:
+        return response
+    else:
+        response.set_data(compress(response.get_data(), encoding))
+    response.headers["Content-Encoding"] = encoding
+    # each coding is a different representation, so it needs its own strong validator
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak)
+    return response
+
+
+def precompressed(directory, filename, accept_encodings):
+    """(path, encoding) of an up-to-date precompressed copy of a static file the client accepts"""
+    path = os.path.join(directory, filename)
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    offered = [encoding for encoding in SUFFIXES if os.path.exists(path + SUFFIXES[encoding])]
+    encoding = negotiate(accept_encodings, offered) if offered else None
+    if encoding and os.stat(path + SUFFIXES[encoding]).st_mtime >= mtime:
+        return filename + SUFFIXES[encoding], encoding
+    return None
+
+
+def precompress_directory(directory, min_size=256):
+    """writes .gz (and, with brotli installed, .br) copies of every compressible file in `directory`"""
+    written = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.endswith(tuple(SUFFIXES.values())):
+                continue
+            path = os.path.join(root, name)
+            if os.path.getsize(path) < min_size or not is_compressible(name):
+                continue
+            with open(path, "rb") as f:
+                data = f.read()
+            for encoding in available():
+                with open(path + SUFFIXES[encoding], "wb") as f:
+                    f.write(compress(data, encoding, static=True))
+                written.append(path + SUFFIXES[encoding])
+    return written
+
+
+def is_compressible(filename):
+    mimetype, _ = mimetypes.guess_type(filename)
+    return mimetype in COMPRESSIBLE
@@ -0,0 +1,89 @@
+"""
+File: db.py
+Description: SQLAlchemy engine profiles for data.db. "serving" opens the file read-only with
+pragmas tuned for lookups and a connection pool shared by a worker's threads; "default" keeps
+the original read-write settings. Both are picked and tuned through environment variables.
+"""
+
+import os
+from urllib.parse import quote
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+
+DB_PATH = os.environ.get("NEOJAMBU_DB", "data.db")
+
+# serving pragmas, set on every new connection; cache_size is in KiB when negative
+SERVING_PRAGMAS = {
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64 * 1024,
+    "temp_store": "MEMORY",
+    "query_only": "ON",
+}
+# connections kept open per worker; gunicorn's threads each hold at most one at a time
+SERVING_POOL_SIZE = 8
+
+
+def env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def default_engine(path=DB_PATH):
+    """the settings the app was first deployed with"""
+    return create_engine(
+        f"sqlite:///{path}",
+        pool_pre_ping=True,
+        pool_recycle=3600,
+        connect_args={"check_same_thread": False},
+    )
+
+
+def serving_engine(path=DB_PATH, immutable=True, pragmas=None, pool_size=SERVING_POOL_SIZE):
+    """
+    data.db opened read-only (and, with `immutable`, without any file locking or change
+    detection, which is only safe while nothing writes to the file: the build id check
+    disposes of the pool once the file is replaced or modified)
+    """
+    params = "mode=ro&immutable=1" if immutable else "mode=ro"
+    engine = create_engine(
+        f"sqlite:///file:{quote(os.path.abspath(path))}?{params}&uri=true",
+        poolclass=QueuePool,
+        pool_size=pool_size,
+        max_overflow=pool_size,
+        connect_args={"check_same_thread": False},
+    )
+    pragmas = SERVING_PRAGMAS if pragmas is None else pragmas
+
+    @event.listens_for(engine, "connect")
+    def set_serving_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in pragmas.items():
+            cursor.execute(f"PRAGMA {pragma} = {value}")
+        cursor.close()
+
+    return engine
+
+
+def engine_from_env(path=DB_PATH):
+    """
+    the engine NEOJAMBU_DB_PROFILE asks for ("serving", the default, or "default"), tuned by
+    NEOJAMBU_DB_IMMUTABLE (0 to keep file locking), NEOJAMBU_DB_POOL_SIZE,
+    NEOJAMBU_SQLITE_MMAP_SIZE (bytes) and NEOJAMBU_SQLITE_CACHE_SIZE (KiB)
+    """
+    profile = os.environ.get("NEOJAMBU_DB_PROFILE", "serving")
+    if profile == "default":
+        return default_engine(path)
+    if profile != "serving":
+        raise ValueError(f"unknown NEOJAMBU_DB_PROFILE {profile!r}; expected 'serving' or 'default'")
+    pragmas = {
+        **SERVING_PRAGMAS,
+        "mmap_size": env_int("NEOJAMBU_SQLITE_MMAP_SIZE", SERVING_PRAGMAS["mmap_size"]),
+        "cache_size": -env_int("NEOJAMBU_SQLITE_CACHE_SIZE", -SERVING_PRAGMAS["cache_size"]),
+    }
+    return serving_engine(
+        path,
+        immutable=os.environ.get("NEOJAMBU_DB_IMMUTABLE", "1") != "0",
+        pragmas=pragmas,
+        pool_size=env_int("NEOJAMBU_DB_POOL_SIZE", SERVING_POOL_SIZE),
+    )
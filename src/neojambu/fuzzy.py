@@ -0,0 +1,115 @@
+"""
+File: fuzzy.py
+Description: Approximate matching of reflex forms. make_database.py indexes the distinct
+forms of Lemma.word and Lemma.phonemic by their bigrams (models.fuzzy_*); the forms within
+an edit distance of a term are then looked up among the forms sharing enough of its
+bigrams, and only those candidates have their distance computed.
+"""
+
+import unicodedata
+
+from sqlalchemy import func, select
+from .cache import LRUCache
+from .models import fuzzy_forms, fuzzy_grams
+
+GRAM = 2
+FUZZY_MAX = 3
+# matching forms kept per search, closest first
+FUZZY_LIMIT = 1000
+
+
+def form_key(value):
+    """a form as the index holds it: case-folded, but keeping its diacritics, which tell sounds apart"""
+    if not value:
+        return None
+    return unicodedata.normalize("NFC", value.casefold())
+
+
+def grams(form):
+    """the distinct bigrams of `form`, padded so that its first and last letters count twice"""
+    padded = f"^{form}$"
+    return {padded[i:i + GRAM] for i in range(len(padded) - GRAM + 1)}
+
+
+def bitmasks(term):
+    """for each letter of `term`, a bitmask of the positions it is at"""
+    masks = {}
+    for i, char in enumerate(term):
+        masks[char] = masks.get(char, 0) | (1 << i)
+    return masks
+
+
+def edit_distance(term, masks, form):
+    """
+    Levenshtein distance between `term` (with its bitmasks) and `form`, by Myers'
+    bit-parallel algorithm in Hyyro's formulation: a column of the DP table is held
+    as bitmasks of its vertical +1 and -1 steps, so each letter of `form` is a few
+    integer operations rather than a pass over `term`
+    """
+    if not term:
+        return len(form)
+    full = (1 << len(term)) - 1
+    last = 1 << (len(term) - 1)
+    plus, minus, score = full, 0, len(term)
+    for char in form:
+        equal = masks.get(char, 0)
+        vertical = equal | minus
+        horizontal = (((equal & plus) + plus) ^ plus) | equal
+        up = minus | (~(horizontal | plus) & full)
+        down = plus & horizontal
+        if up & last:
+            score += 1
+        elif down & last:
+            score -= 1
+        up = ((up << 1) | 1) & full
+        down = (down << 1) & full
+        plus = down | (~(vertical | up) & full)
+        minus = up & vertical
+    return score
+
+
+class FuzzyIndex:
+    """
+    searches the fuzzy_* tables of data.db. An edit changes at most GRAM of a form's
+    bigrams, so a form within `distance` of a term shares all but GRAM * `distance` of
+    the term's bigrams; terms too short for that to leave any are matched against forms
+    sharing at least one. Results are memoised per term, distance and build.
+    """
+
+    def __init__(self, engine, build_id, maxsize=256):
+        self.engine = engine
+        self.build_id = build_id
+        self.cache = LRUCache(maxsize)
+
+    def match(self, term, distance):
+        """(form id, distance) of the forms within `distance` edits of `term`, closest first"""
+        key = (self.build_id(), term, distance)
+        found = self.cache.get(key)
+        if found is None:
+            found = self.search(form_key(term), distance)
+            self.cache.set(key, found)
+        return found
+
+    def search(self, term, distance):
+        if not term:
+            return ()
+        wanted = grams(term)
+        candidates = select(fuzzy_forms.c.id, fuzzy_forms.c.form).where(fuzzy_forms.c.id.in_(
+            select(fuzzy_grams.c.form_id)
+            .where(
+                fuzzy_grams.c.gram.in_(wanted),
+                fuzzy_grams.c.length.between(len(term) - distance, len(term) + distance),
+            )
+            .group_by(fuzzy_grams.c.form_id)
+            .having(func.count() >= max(len(wanted) - GRAM * distance, 1))
+        ))
+        with self.engine.connect() as conn:
+            rows = conn.execute(candidates).all()
+        masks = bitmasks(term)
+        found = sorted(
+            (edits, form_id)
+            for form_id, form in rows
+            for edits in [edit_distance(term, masks, form)]
+            if edits <= distance
+        )
+        return tuple((form_id, edits) for edits, form_id in found[:FUZZY_LIMIT])
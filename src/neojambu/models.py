@@ -1,5 +1,5 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, Enum
-from sqlalchemy.orm import sessionmaker, relationship, backref, aliased
+from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, Enum, Index, MetaData, Table
+from sqlalchemy.orm import sessionmaker, relationship, backref, aliased, deferred
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -46,6 +46,14 @@ class Reference(Base):
 
 class Lemma(Base):
     __tablename__ = "lemmas"
+    __table_args__ = (
+        # entry pages: reflexes of an etymon, grouped by cognate set
+        Index("idx_lemmas_origin_lemma_id", "origin_lemma_id", "cognateset"),
+        # language pages: a language's lemmas in dictionary order
+        Index("idx_lemmas_language_id", "language_id", "order"),
+        Index("idx_lemmas_order", "order"),
+        Index("idx_lemmas_cognateset", "cognateset"),
+    )
 
     id = Column(String, primary_key=True)
     word = Column(String)
@@ -56,12 +64,17 @@ class Lemma(Base):
     notes = Column(String)
     clades = Column(String)
     cognateset = Column(String)
-    order = Column(Integer)
+    order = Column(Integer, nullable=False)
 
     language_id = Column(String, ForeignKey("languages.id"))
     origin_lemma_id = Column(
         String, ForeignKey("lemmas.id")
     )  # self-referencing foreign key
+    # accent- and case-folded copies of word, gloss and native (see search.fold); deferred,
+    # so that loading a Lemma works against databases built before they existed
+    word_key = deferred(Column(String))
+    gloss_key = deferred(Column(String))
+    native_key = deferred(Column(String))
     relation = Enum("inheritance", "loaning", name="relation_types")
 
     # Relationships
@@ -85,10 +98,77 @@ class LemmaConcept(Base):
 
 class LemmaReference(Base):
     __tablename__ = "lemma_reference"
+    __table_args__ = (
+        # the primary key covers lookups by lemma; this covers them by reference
+        Index("idx_lemma_reference_reference_id", "reference_id", "lemma_id"),
+    )
 
     lemma_id = Column(Integer, ForeignKey("lemmas.id"), primary_key=True)
     reference_id = Column(Integer, ForeignKey("references.id"), primary_key=True)
 
 
+# Build metadata
+class BuildHash(Base):
+    __tablename__ = "build_hashes"
+
+    kind = Column(String, primary_key=True)  # forms, parameters, languages or sources
+    id = Column(String, primary_key=True)
+    hash = Column(String)
+
+
+class BuildInfo(Base):
+    __tablename__ = "build_info"
+
+    key = Column(String, primary_key=True)
+    value = Column(String)
+
+
+# Full-text search: an FTS5 trigram index over the lemma text, with lemmas as its
+# external content. create_all cannot make virtual tables, so it lives outside
+# Base.metadata and make_database.py maintains it.
+lemmas_fts = Table(
+    "lemmas_fts",
+    MetaData(),
+    Column("id", String),
+    Column("word", String),
+    Column("gloss", String),
+    Column("notes", String),
+    Column("native", String),
+    Column("phonemic", String),
+    Column("word_key", String),
+    Column("gloss_key", String),
+    Column("native_key", String),
+)
+
+
+# Fuzzy search: the distinct forms (Lemma.word and Lemma.phonemic, see fuzzy.form_key),
+# the bigrams of each along with the form's length, so that a search reads only forms of
+# a plausible length, and the lemmas each form belongs to. They are derived from lemmas,
+# so like lemmas_fts they live outside Base.metadata and make_database.py maintains them.
+fuzzy_metadata = MetaData()
+fuzzy_forms = Table(
+    "fuzzy_forms",
+    fuzzy_metadata,
+    Column("id", Integer, primary_key=True),
+    Column("form", String, nullable=False),
+    # an incremental build looks forms up by their text
+    Index("idx_fuzzy_forms_form", "form", unique=True),
+)
+fuzzy_grams = Table(
+    "fuzzy_grams",
+    fuzzy_metadata,
+    Column("gram", String, primary_key=True),
+    Column("length", Integer, primary_key=True),
+    Column("form_id", Integer, primary_key=True),
+    sqlite_with_rowid=False,
+)
+fuzzy_lemmas = Table(
+    "fuzzy_lemmas",
+    fuzzy_metadata,
+    Column("form_id", Integer, primary_key=True),
+    Column("lemma_id", String, primary_key=True),
+    sqlite_with_rowid=False,
+)
+
 # Update Language model to include relationship with Lemma
 Language.lemmas = relationship("Lemma", order_by=Lemma.id, back_populates="language")
\ No newline at end of file
@@ -0,0 +1,228 @@
+"""
+File: patterns.py
+Description: Regular-expression filters over lemma forms (?pattern=). The forms a pattern
+can match, along with each lemma's language and clade as integer codes, are held in
+arrays that are loaded once per build. Language and clade restrictions become NumPy masks,
+so the compiled pattern only runs over the lemmas that survive them.
+"""
+
+import json
+import re
+import threading
+import time
+import unicodedata
+from itertools import compress
+
+from sqlalchemy import select
+from .cache import LRUCache
+from .models import Language, Lemma
+
+try:
+    from re import _parser as sre_parse  # Python 3.11+
+except ImportError:
+    import sre_parse
+
+try:
+    import numpy
+except ImportError:  # pip install neojambu[regex]; lists and comprehensions are used without it
+    numpy = None
+
+PATTERN_FIELDS = ("word", "native", "phonemic")
+# longer patterns are refused, as are ones that do not compile
+PATTERN_MAX_LENGTH = 200
+# so are patterns matching more lemmas than this, or taking longer (in seconds) to match;
+# candidates are matched PATTERN_CHUNK at a time, so either is noticed early
+PATTERN_MATCH_LIMIT = 10000
+PATTERN_TIME_LIMIT = 2.0
+PATTERN_CHUNK = 256
+# total length of the memoised id arrays
+PATTERN_CACHE_BYTES = 16 * 1024 * 1024
+
+
+REPEATS = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT)
+
+
+def unbounded(item):
+    """the body of `item` if it is an unbounded repeat (*, +, {n,}), seen through a plain group"""
+    op, av = item
+    if op is sre_parse.SUBPATTERN and len(av[-1]) == 1:
+        return unbounded(av[-1][0])
+    if op in REPEATS and av[1] == sre_parse.MAXREPEAT:
+        return av[2]
+    return None
+
+
+def literal(body):
+    return body[0][1] if len(body) == 1 and body[0][0] is sre_parse.LITERAL else None
+
+
+def children(op, av):
+    """the sequences nested in a parsed item"""
+    if op is sre_parse.SUBPATTERN:
+        yield av[-1]
+    elif op in REPEATS:
+        yield av[2]
+    elif op is sre_parse.BRANCH:
+        yield from av[1]
+    elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+        yield av[1]
+    elif op is sre_parse.GROUPREF_EXISTS:
+        yield from (branch for branch in av[1:] if branch is not None)
+
+
+def check_repeats(items, repeated=False):
+    """
+    re.error for the shapes that backtrack exponentially in re: an unbounded repeat inside
+    another, two unbounded repeats in a row (unless each repeats a different letter, as in
+    k+a+), and alternatives inside an unbounded repeat that do not each start with a
+    different letter, as in (.|.)*
+    """
+    previous = None
+    for op, av in items:
+        if repeated and op is sre_parse.BRANCH:
+            starts = [literal(alternative[:1]) for alternative in av[1]]
+            if None in starts or len(set(starts)) < len(starts):
+                raise re.error("alternatives inside an unbounded repeat must start with different letters")
+        body = unbounded((op, av))
+        if body is not None:
+            if repeated:
+                raise re.error("nested unbounded repeats are not allowed")
+            if previous is not None and (literal(previous) is None or literal(previous) == literal(body)):
+                raise re.error("adjacent unbounded repeats are not allowed")
+        for child in [body] if body is not None else children(op, av):
+            check_repeats(child, repeated or body is not None)
+        previous = body
+
+
+def compile_pattern(pattern):
+    """the compiled ?pattern=; re.error for one that is too long, backtracks badly or does not compile"""
+    if len(pattern) > PATTERN_MAX_LENGTH:
+        raise re.error(f"patterns are limited to {PATTERN_MAX_LENGTH} characters")
+    pattern = unicodedata.normalize("NFC", pattern)
+    check_repeats(sre_parse.parse(pattern))
+    return re.compile(pattern)
+
+
+def contains_folded(value, texts):
+    """codes of the `texts` that contain `value`, ignoring case; a superset of what LIKE matches"""
+    value = value.casefold()
+    return [code for code, text in enumerate(texts) if text and value in text.casefold()]
+
+
+class PatternIndex:
+    """
+    the lemma ids, their PATTERN_FIELDS forms (NFC, "" where missing) and the codes of
+    their language and clade, in column arrays reloaded when the build id changes.
+    Matches, and refusals of patterns that match too broadly, are memoised per build,
+    pattern and restriction.
+    """
+
+    def __init__(self, engine, build_id, maxsize=128, max_bytes=PATTERN_CACHE_BYTES):
+        self.engine = engine
+        self.build_id = build_id
+        self.build = None
+        self.columns = None
+        self.lock = threading.Lock()
+        # entries are ("ids", JSON array) or ("error", message)
+        self.cache = LRUCache(maxsize, max_bytes, sizeof=lambda entry: len(entry[1]))
+
+    def refresh(self):
+        build = self.build_id()
+        if build != self.build:
+            with self.lock:
+                if build != self.build:
+                    self.load()
+                    self.build = build
+        return self
+
+    def load(self):
+        with self.engine.connect() as conn:
+            languages = conn.execute(select(Language.id, Language.name, Language.clade)).all()
+            rows = conn.execute(
+                select(Lemma.id, Lemma.language_id, *[getattr(Lemma, field) for field in PATTERN_FIELDS])
+            ).all()
+        language_codes = {id: code for code, (id, _, _) in enumerate(languages)}
+        clades = sorted({clade or "" for _, _, clade in languages})
+        clade_codes = {clade: code for code, clade in enumerate(clades)}
+        language_clades = [clade_codes[clade or ""] for _, _, clade in languages]
+
+        ids = [row[0] for row in rows]
+        language = [language_codes.get(row[1], -1) for row in rows]
+        clade = [language_clades[code] if code >= 0 else -1 for code in language]
+        forms = {
+            field: [unicodedata.normalize("NFC", row[2 + i]) if row[2 + i] else "" for row in rows]
+            for i, field in enumerate(PATTERN_FIELDS)
+        }
+        if numpy is not None:
+            ids = numpy.array(ids, dtype=object)
+            language = numpy.array(language, dtype=numpy.int32)
+            clade = numpy.array(clade, dtype=numpy.int32)
+            forms = {field: numpy.array(values, dtype=object) for field, values in forms.items()}
+        # swapped in whole, so a reader sees either the old build's columns or the new ones
+        self.columns = {
+            "ids": ids,
+            "language": language,
+            "clade": clade,
+            "forms": forms,
+            "language_names": [name for _, name, _ in languages],
+            "clades": clades,
+        }
+
+    def candidates(self, columns, languages=None, clades=None):
+        """positions of the lemmas in the given language and clade codes (None: any)"""
+        if numpy is not None:
+            mask = numpy.ones(len(columns["ids"]), dtype=bool)
+            if languages is not None:
+                mask &= numpy.isin(columns["language"], languages)
+            if clades is not None:
+                mask &= numpy.isin(columns["clade"], clades)
+            return numpy.flatnonzero(mask)
+        languages = None if languages is None else set(languages)
+        clades = None if clades is None else set(clades)
+        return [
+            i for i, (language, clade) in enumerate(zip(columns["language"], columns["clade"]))
+            if (languages is None or language in languages) and (clades is None or clade in clades)
+        ]
+
+    def match(self, pattern, field="word", lang=None, clade=None):
+        """
+        a JSON array of the ids of the lemmas whose `field` matches `pattern` (re.search),
+        among those whose language name contains `lang` and whose clade contains `clade`,
+        as the lang and clade filters read them; re.error if it matches too broadly
+        """
+        columns = self.refresh().columns
+        key = (self.build, pattern, field, lang, clade)
+        found = self.cache.get(key)
+        if found is None:
+            try:
+                found = self.search(columns, compile_pattern(pattern).search, field, lang, clade)
+            except re.error as error:
+                found = error.msg
+                self.cache.set(key, ("error", found))
+                raise
+            self.cache.set(key, ("ids", found))
+        elif found[0] == "error":
+            raise re.error(found[1])
+        else:
+            found = found[1]
+        return found
+
+    def search(self, columns, search, field, lang, clade):
+        positions = self.candidates(
+            columns,
+            None if not lang else contains_folded(lang, columns["language_names"]),
+            None if not clade else contains_folded(clade, columns["clades"]),
+        )
+        forms, ids = columns["forms"][field], columns["ids"]
+        matched = []
+        started = time.monotonic()
+        for start in range(0, len(positions), PATTERN_CHUNK):
+            chunk = positions[start:start + PATTERN_CHUNK]
+            # with NumPy the chunk's forms are gathered in one step
+            texts = forms[chunk] if numpy is not None else (forms[i] for i in chunk)
+            matched.extend(compress(chunk, map(search, texts)))
+            if len(matched) > PATTERN_MATCH_LIMIT:
+                raise re.error(f"the pattern matches more than {PATTERN_MATCH_LIMIT} lemmas; narrow it down")
+            if time.monotonic() - started > PATTERN_TIME_LIMIT:
+                raise re.error("the pattern takes too long to match; narrow it down")
+        return json.dumps(ids[matched].tolist() if numpy is not None else [ids[i] for i in matched])
@@ -0,0 +1,71 @@
+"""
+File: registry.py
+Description: The languages and references of the current data.db build, read once and
+kept in memory, so that lemma queries need only select language and reference ids.
+"""
+
+import threading
+from types import MappingProxyType
+
+from sqlalchemy import select
+from .api import language_columns, reference_columns
+from .models import LemmaReference
+from .rows import LanguageRow, ReferenceRow
+
+
+class Registry:
+    """
+    read-only maps of every language and reference by id, reloaded when the build id
+    changes. Loading it before gunicorn forks lets the workers share it copy-on-write.
+    """
+
+    def __init__(self, engine, build_id):
+        self.engine = engine
+        self.build_id = build_id
+        self.build = None
+        self.languages = MappingProxyType({})
+        self.references = MappingProxyType({})
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        build = self.build_id()
+        if build != self.build:
+            with self.lock:
+                if build != self.build:
+                    self.load()
+                    self.build = build
+        return self
+
+    def load(self):
+        with self.engine.connect() as conn:
+            languages = {row[0]: LanguageRow(*row) for row in conn.execute(select(*language_columns()))}
+            references = {row[0]: ReferenceRow(*row) for row in conn.execute(select(*reference_columns()))}
+        # swapped in whole, so a reader sees either the old maps or the new ones
+        self.languages = MappingProxyType(languages)
+        self.references = MappingProxyType(references)
+
+    def language(self, id):
+        return self.refresh().languages.get(id)
+
+    def attach(self, session, lemmas, references=True):
+        """
+        fills in `language` (and the etymon's) on each of `lemmas` (rows.LemmaRow) from
+        the registry, and with `references` their sources from one lemma_reference query
+        """
+        self.refresh()
+        languages = self.languages
+        for lemma in lemmas:
+            lemma.language = languages.get(lemma.language_id)
+            if lemma.origin_lemma is not None:
+                lemma.origin_lemma.language = languages.get(lemma.origin_lemma.language_id)
+        if references and lemmas:
+            sources = {lemma.id: [] for lemma in lemmas}
+            pairs = session.execute(
+                select(LemmaReference.lemma_id, LemmaReference.reference_id)
+                .where(LemmaReference.lemma_id.in_(list(sources)))
+            )
+            for lemma_id, reference_id in pairs:
+                sources[lemma_id].append(self.references[reference_id])
+            for lemma in lemmas:
+                lemma.references = sources[lemma.id]
+        return lemmas
@@ -0,0 +1,65 @@
+"""
+File: rows.py
+Description: Read models for the HTML views: compact rows built straight from column
+queries, with the attribute names of the ORM models so that templates read them alike.
+"""
+
+from collections import namedtuple
+
+from .api import LANGUAGE_FIELDS, LEMMA_FIELDS, REFERENCE_FIELDS, lemma_columns
+from .search import origin_lemma
+
+LanguageRow = namedtuple("LanguageRow", LANGUAGE_FIELDS)
+
+
+class ReferenceRow(namedtuple("ReferenceRow", REFERENCE_FIELDS)):
+    __slots__ = ()
+
+    # rendered as a link, like models.Reference
+    def __repr__(self):
+        return f'<a href="/references/{self.id}">{self.short}</a>'
+
+    __str__ = __repr__
+
+
+class LemmaRow:
+    """a lemma's columns, plus the language, etymon and sources the registry fills in"""
+
+    __slots__ = tuple(LEMMA_FIELDS) + ("language", "origin_lemma", "references")
+
+    def __init__(self, values, origin_lemma=None):
+        for field, value in zip(LEMMA_FIELDS, values):
+            setattr(self, field, value)
+        self.language = None
+        self.origin_lemma = origin_lemma
+        self.references = ()
+
+    def __repr__(self):
+        return f"<LemmaRow(id='{self.id}', word='{self.word}', language_id='{self.language_id}')>"
+
+
+WIDTH = len(LEMMA_FIELDS)
+
+
+def lemma_row_columns(with_origin=False):
+    """the columns lemma_rows() reads: the lemma's, then (outer-joined through
+    search.join_origin) its etymon's"""
+    return lemma_columns() + (lemma_columns(origin_lemma) if with_origin else [])
+
+
+def lemma_rows(rows, with_origin=False, unique=False):
+    """
+    LemmaRows from result rows of lemma_row_columns(with_origin); `unique` drops repeats
+    of a lemma (as a source join makes), as the ORM does for queries with joined loads
+    """
+    if unique:
+        first = {}
+        for row in rows:
+            first.setdefault(row[0], row)
+        rows = first.values()
+    if not with_origin:
+        return [LemmaRow(row) for row in rows]
+    return [
+        LemmaRow(row[:WIDTH], LemmaRow(row[WIDTH:]) if row[WIDTH] is not None else None)
+        for row in rows
+    ]
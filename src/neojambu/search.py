@@ -5,39 +5,219 @@ Author: Aryaman Arora (aryaman.arora2020@gmail.com)
 Date: 2023-05-19
 """
 
-from .models import Language, Lemma, Concept, Reference
+import base64
+import json
+import unicodedata
+
+from sqlalchemy import and_, bindparam, case, false, func, or_, select, text, tuple_
+from sqlalchemy.sql.elements import BindParameter
+from sqlalchemy.orm import aliased
+from .fuzzy import FUZZY_MAX, FuzzyIndex
+from .patterns import PATTERN_FIELDS, PatternIndex
+from .models import Language, Lemma, Concept, Reference, fuzzy_grams, fuzzy_lemmas, lemmas_fts
+
+PAGE_SIZE = 50
+
+# the etymon a reflex descends from; origin_lang and origin share the one join.
+# origin filters go through origin_lemma_id so SQLite can start from the etymon
+origin_lemma = aliased(Lemma, name="origin_lemma")
+join_origin = lambda x: x.outerjoin(Lemma.origin_lemma.of_type(origin_lemma))
 
 joins = {
     "source": lambda x: x.join(Lemma.references),
-    "origin_lang": lambda x: x.outerjoin(Lemma.origin_lemma, aliased=True),
-    "origin": lambda x: x.outerjoin(Lemma.origin_lemma, aliased=True),
+    "origin_lang": join_origin,
+    "origin": join_origin,
 }
 
+def fold(value):
+    """
+    search key for accent- and case-insensitive matching: compatibility-decomposed
+    (so that ʰ becomes h), stripped of combining marks, case-folded and recomposed
+    """
+    if value is None:
+        return None
+    decomposed = unicodedata.normalize("NFKD", value)
+    stripped = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return unicodedata.normalize("NFC", stripped.casefold())
+
+
+def short(value):
+    """whether a search term is too short for the trigram index"""
+    return len(value) < 3
+
+
+# set by detect_fts() once the app knows whether data.db has the lemmas_fts table
+fts_enabled = False
+
+
+def detect_fts(engine):
+    global fts_enabled
+    with engine.connect() as conn:
+        found = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = :name"), {"name": lemmas_fts.name})
+        fts_enabled = found.first() is not None
+    return fts_enabled
+
+
+# set by detect_folded_keys(); databases built before the folded keys have only lower() to go by
+folded_keys = True
+
+
+def detect_folded_keys(engine):
+    global folded_keys
+    with engine.connect() as conn:
+        columns = {row[1] for row in conn.execute(text(f'PRAGMA table_info("{Lemma.__tablename__}")'))}
+        folded_keys = {"word_key", "gloss_key", "native_key"} <= columns
+    return folded_keys
+
+
+# set by detect_fuzzy() when data.db has the fuzzy search tables; without them ?fuzzy= is ignored
+fuzzy_index = None
+
+
+def detect_fuzzy(engine, build_id):
+    global fuzzy_index
+    with engine.connect() as conn:
+        found = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = :name"), {"name": fuzzy_grams.name})
+        fuzzy_index = FuzzyIndex(engine, build_id) if found.first() is not None else None
+    return fuzzy_index
+
+
+def fuzzy_distance(request):
+    """the edit distance ?fuzzy= asks the word filter for, up to FUZZY_MAX; 0 keeps substring matching"""
+    if fuzzy_index is None or not request.args.get("word"):
+        return 0
+    try:
+        distance = int(request.args.get("fuzzy") or 0)
+    except ValueError:
+        return 0
+    return min(max(distance, 0), FUZZY_MAX)
+
+
+def fuzzy_matches(name, values):
+    """ids of the lemmas with one of the forms whose ids `values` holds under `name`"""
+    return Lemma.id.in_(select(fuzzy_lemmas.c.lemma_id).where(
+        fuzzy_lemmas.c.form_id.in_(bindparam(name, values[name], expanding=True))
+    ))
+
+
+def fuzzy_values(request):
+    """
+    the ids of the forms within ?fuzzy= edits of the word filter, as `fuzzy`, and of
+    those exactly 0, 1, ... edits away as fuzzy_0, fuzzy_1, ... for ranking
+    """
+    distance = fuzzy_distance(request)
+    if not distance:
+        return {}
+    matches = fuzzy_index.match(request.args["word"], distance)
+    values = {"fuzzy": [form_id for form_id, _ in matches]}
+    for edits in range(distance):
+        values[f"fuzzy_{edits}"] = [form_id for form_id, found in matches if found == edits]
+    return values
+
+
+def fuzzy_rank(request):
+    """the number of edits to a fuzzy match's closest form, which ranks it"""
+    distance = fuzzy_distance(request)
+    values = filter_values(request)
+    return case(
+        *[(fuzzy_matches(f"fuzzy_{edits}", values), edits) for edits in range(distance)],
+        else_=distance,
+    )
+
+
+def contains(entity, column, value, ids=None):
+    """
+    substring match on a lemma text column, narrowed through the trigram index when possible;
+    `value` is a string or a bindparam holding one, and `ids` is the column the matching
+    lemma ids are compared against (default: entity.id)
+    """
+    like = getattr(entity, column).like("%" + value + "%")
+    # trigrams need three characters; shorter terms can only scan
+    if not fts_enabled or short(value.value if isinstance(value, BindParameter) else value):
+        return like
+    # the index folds case beyond ASCII, so keep the LIKE to hold its exact semantics
+    candidates = select(lemmas_fts.c.id).where(lemmas_fts.c[column].like("%" + value + "%"))
+    return (entity.id if ids is None else ids).in_(candidates) & like
+
+
+def contains_folded(entity, column, value, ids=None):
+    """contains() on the folded key of `column`, or a case-insensitive LIKE where data.db lacks the keys"""
+    if not folded_keys:
+        return func.lower(getattr(entity, column)).like("%" + value + "%")
+    return contains(entity, f"{column}_key", value, ids)
+
+
 sorts = {
     "lang": Language.name,
     "word": Lemma.word,
     "gloss": Lemma.gloss,
     "notes": Lemma.notes,
     "source": Reference.short,
-    "origin": Lemma.order,
+    "origin": origin_lemma.order,
     "clade": Language.clade,
     "reflexes": Language.lemma_count
 }
 
 filters = {
     "lang": lambda x, y, z: x.filter(Language.name.like("%" + y + "%")),
-    "word": lambda x, y, z: x.filter(Lemma.word.like("%" + y + "%")),
-    "gloss": lambda x, y, z: x.filter(Lemma.gloss.like("%" + y + "%")),
-    "notes": lambda x, y, z: x.filter(Lemma.notes.like("%" + y + "%")),
+    "word": lambda x, y, z: x.filter(contains(Lemma, "word", y)),
+    "gloss": lambda x, y, z: x.filter(contains(Lemma, "gloss", y)),
+    "notes": lambda x, y, z: x.filter(contains(Lemma, "notes", y)),
+    "native": lambda x, y, z: x.filter(contains(Lemma, "native", y)),
     "source": lambda x, y, z: x.filter(Reference.short.like("%" + y + "%")),
-    "origin_lang": lambda x, y, z: x.filter(Lemma.language_id == y),
-    "origin": lambda x, y, z: x.filter(Lemma.word.like("%" + y + "%")),
+    "origin_lang": lambda x, y, z: x.filter(origin_lemma.language_id == y),
+    "origin": lambda x, y, z: x.filter(contains(origin_lemma, "word", y, Lemma.origin_lemma_id)),
     "clade": lambda x, y, z: x.filter(Language.clade.like("%" + y + "%")),
     "reflexes": lambda x, y, z: x
 }
 
+# with fold=1 the text filters match the folded keys precomputed by make_database.py;
+# filter_data folds the value before it gets here
+folded_filters = {
+    "word": lambda x, y, z: x.filter(contains_folded(Lemma, "word", y)),
+    "gloss": lambda x, y, z: x.filter(contains_folded(Lemma, "gloss", y)),
+    "native": lambda x, y, z: x.filter(contains_folded(Lemma, "native", y)),
+    "origin": lambda x, y, z: x.filter(contains_folded(origin_lemma, "word", y, Lemma.origin_lemma_id)),
+}
+
+
+# set by enable_patterns(); ?pattern= is ignored until then
+pattern_index = None
 
-def filter_data(query, request, model):
+
+def enable_patterns(engine, build_id):
+    """the PatternIndex ?pattern= filters go through; it loads the current build on first use"""
+    global pattern_index
+    pattern_index = PatternIndex(engine, build_id)
+    return pattern_index
+
+
+def pattern_field(request):
+    """the lemma column ?pattern= is matched against (?pattern_field=, word by default)"""
+    field = request.args.get("pattern_field", "word")
+    return field if field in PATTERN_FIELDS else "word"
+
+
+def pattern_values(request):
+    """the ids of the lemmas ?pattern= matches, as a JSON array bound as `pattern`"""
+    if pattern_index is None or not request.args.get("pattern"):
+        return {}
+    return {"pattern": pattern_index.match(
+        request.args["pattern"], pattern_field(request), request.args.get("lang"), request.args.get("clade")
+    )}
+
+
+def pattern_matches(values):
+    """lemmas among the ids in `values`; one JSON parameter holds any number of them"""
+    matched = func.json_each(bindparam("pattern", values["pattern"])).table_valued("value")
+    return Lemma.id.in_(select(matched.c.value))
+
+
+def filter_data(query, request, model, joined=()):
+    """
+    applies the request's filters and sort to `query`; `joined` lists the join
+    functions (values of `joins`) the caller has already applied
+    """
     # sort
     order, col = None, None
     s = request.args.get("sort", None)
@@ -45,12 +225,26 @@ def filter_data(query, request, model):
         order, col = s.split("-")
 
     # filter
+    folding = request.args.get("fold") == "1"
+    distance = fuzzy_distance(request) if model is Lemma else 0
+    joined = set(joined)
+    if model is Lemma and "pattern" in filter_values(request):
+        # the regular expression is matched in memory (see patterns.py); its ids narrow the query
+        query = query.filter(pattern_matches(filter_values(request)))
     for i in filters:
         r = request.args.get(i, None)
-        if (r or (col == i and col in sorts)) and i in joins:
+        if (r or (col == i and col in sorts)) and i in joins and joins[i] not in joined:
             query = joins[i](query)
-        if r:
-            query = filters[i](query, r, model)
+            joined.add(joins[i])
+        if r and i == "word" and distance:
+            # forms within ?fuzzy= edits of the word, whatever its script or field
+            query = query.filter(fuzzy_matches("fuzzy", filter_values(request)))
+        elif r:
+            # values go in as bindparams named after their filter, so that a query
+            # built for one request can be re-run for another with .params()
+            query = (folded_filters if folding and i in folded_filters else filters)[i](
+                query, bindparam(i, filter_values(request)[i]), model
+            )
         if col == i and col in sorts:
             if order == "asc":
                 query = query.order_by(sorts[col])
@@ -60,6 +254,186 @@ def filter_data(query, request, model):
     return query, s is None or s == ""
 
 
-def filter_page(query, request):
-    page = int(request.args.get("page", 1))
-    return query.limit(50).offset(int(page) * 50 - 50).all()
+def filter_values(request):
+    """
+    the request's filter values as filter_data binds them, folded where fold=1 asks for
+    it, and with ?fuzzy= or ?pattern= the matching form or lemma ids
+    """
+    folding = request.args.get("fold") == "1"
+    return {
+        **{
+            i: fold(request.args[i]) if folding and i in folded_filters else request.args[i]
+            for i in filters
+            if request.args.get(i)
+        },
+        **fuzzy_values(request),
+        **pattern_values(request),
+    }
+
+
+def statement_shape(request):
+    """
+    everything about a request's filters and sort that changes the SQL filter_data
+    builds, as opposed to the values bound into it
+    """
+    folding = request.args.get("fold") == "1"
+    return (
+        tuple(
+            (i, folding and i in folded_filters, short(value))
+            for i, value in filter_values(request).items()
+            if i in filters
+        ),
+        request.args.get("sort", ""),
+        fts_enabled,
+        folded_keys,
+        fuzzy_distance(request),
+        "pattern" in filter_values(request),
+    )
+
+
+def filter_signature(request):
+    """the filters a listing is narrowed by, normalised so equal filters share cache entries"""
+    signature = tuple(sorted((i, request.args[i]) for i in filters if request.args.get(i)))
+    if signature and request.args.get("fold") == "1":
+        signature += (("fold", "1"),)
+    if fuzzy_distance(request):
+        signature += (("fuzzy", str(fuzzy_distance(request))),)
+    if pattern_index is not None and request.args.get("pattern"):
+        signature += (("pattern", request.args["pattern"]), ("pattern_field", pattern_field(request)))
+    return signature
+
+
+def unindexed(request):
+    """
+    whether counting the request's matches means scanning lemmas: a substring filter the
+    trigram index cannot serve (too short, no index, or fold=1 without the folded keys),
+    ?fuzzy= or ?pattern=. The language, clade and source filters join small indexed tables.
+    """
+    if fuzzy_distance(request) or (pattern_index is not None and request.args.get("pattern")):
+        return True
+    folding = request.args.get("fold") == "1"
+    for i in ("word", "gloss", "notes", "native", "origin"):
+        value = request.args.get(i)
+        if not value:
+            continue
+        if folding and i in folded_filters:
+            if not folded_keys:
+                return True
+            value = fold(value)
+        if not fts_enabled or short(value):
+            return True
+    return False
+
+
+def page_keys(request, default):
+    """
+    (column, descending) pairs a list is paged by: the requested sort column, then
+    `default`, whose last column must be unique so that every row has its own position
+    """
+    keys = []
+    s = request.args.get("sort", None)
+    if s:
+        order, col = s.split("-")
+        if col in filters and col in sorts and order in ("asc", "desc"):
+            keys.append((sorts[col], order == "desc"))
+    elif fuzzy_distance(request):
+        # unsorted fuzzy matches come closest first
+        keys.append((fuzzy_rank(request), False))
+    return keys + [(column, False) for column in default]
+
+
+def encode_cursor(request, direction, values):
+    """opaque token for the rows after (or before) the row whose sort key is `values`"""
+    token = {"s": request.args.get("sort", ""), "d": direction, "k": list(values)}
+    return base64.urlsafe_b64encode(json.dumps(token).encode()).decode()
+
+
+def decode_cursor(request, keys):
+    """(direction, values) of the request's cursor, or None if it has none or it was made for another sort"""
+    cursor = request.args.get("cursor", None)
+    if not cursor:
+        return None
+    try:
+        token = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        direction, values = token["d"], token["k"]
+        if (
+            token.get("s") != request.args.get("sort", "")
+            or direction not in ("next", "prev")
+            or not isinstance(values, list)
+            or len(values) != len(keys)
+            or not all(value is None or isinstance(value, (str, int, float)) for value in values)
+        ):
+            return None
+    except (ValueError, TypeError, KeyError):
+        return None
+    return direction, values
+
+
+def nullable(column):
+    """
+    whether a sort key can be NULL: computed keys (such as fuzzy_rank) and the columns of
+    aliased entities, which are outer-joined (origin_lemma), always can; others as declared
+    """
+    parent = getattr(column, "parent", None)
+    if parent is None or parent.is_aliased_class:
+        return True
+    return getattr(column, "nullable", True)
+
+
+def after(keys, values):
+    """rows strictly after `values` in the order given by `keys`"""
+    descending = {desc for _, desc in keys}
+    if None not in values and (descending == {False} or (
+        descending == {True} and not any(nullable(column) for column, _ in keys)
+    )):
+        # a row-value comparison lets SQLite seek straight to the cursor through an index
+        columns = tuple_(*[column for column, _ in keys])
+        return columns < tuple_(*values) if True in descending else columns > tuple_(*values)
+
+    # SQLite sorts NULL first, which a row-value comparison gets wrong for
+    # descending keys, so spell the comparison out one column at a time
+    clauses = []
+    for i, ((column, desc), value) in enumerate(zip(keys, values)):
+        ties = [c.is_(None) if v is None else c == v for (c, _), v in zip(keys[:i], values[:i])]
+        if value is None:
+            beyond = false() if desc else column.isnot(None)
+        elif desc:
+            beyond = or_(column < value, column.is_(None))
+        else:
+            beyond = column > value
+        clauses.append(and_(*ties, beyond))
+    return or_(*clauses)
+
+
+def filter_page(query, request, keys, size=PAGE_SIZE):
+    """
+    one page of `query` ordered by `keys` (see page_keys), with next and previous
+    cursors (None at either end). A cursor seeks straight to its rows; without one
+    the page number is used as an offset, which is fine for the first few pages.
+    """
+    # the sort keys ride along after the query's own columns (or entity)
+    width = len(query.column_descriptions)
+    cursor = decode_cursor(request, keys)
+    backwards = cursor is not None and cursor[0] == "prev"
+    keys = [(column, descending != backwards) for column, descending in keys]
+    query = query.order_by(None).order_by(
+        *[column.desc() if descending else column.asc() for column, descending in keys]
+    ).add_columns(*[column for column, _ in keys])
+
+    if cursor:
+        query = query.filter(after(keys, cursor[1]))
+        earlier = True
+    else:
+        offset = max(int(request.args.get("page", 1)), 1) * size - size
+        query = query.offset(offset)
+        earlier = offset > 0
+    rows = query.limit(size + 1).all()
+    more = len(rows) > size
+    rows = rows[:size]
+    if backwards:
+        rows.reverse()
+        earlier, more = more, True
+
+    next_cursor = encode_cursor(request, "next", rows[-1][width:]) if rows and more else None
+    prev_cursor = encode_cursor(request, "prev", rows[0][width:]) if rows and earlier else None
+    return [row[0] if width == 1 else row[:width] for row in rows], next_cursor, prev_cursor
@@ -0,0 +1,88 @@
+"""
+File: suggest.py
+Description: Typeahead completions for the filter boxes, from sorted prefix indexes over
+language names, clades, source shorthands and entry headwords and glosses, built once per
+data.db build.
+"""
+
+import re
+import threading
+from bisect import bisect_left
+from types import MappingProxyType
+
+from sqlalchemy import select
+from .models import Language, Lemma, Reference
+from .search import fold
+
+SUGGEST_LIMIT = 10
+# a value is also found by the start of each of its words ("munda" finds "Proto-Munda")
+WORD_START = re.compile(r"(?<=[\s\-(/])\w")
+
+
+class PrefixIndex:
+    """
+    (folded key, value) pairs in key order; the completions of a prefix are the run of
+    keys starting at its bisect position, so a lookup costs a binary search and `limit` steps
+    """
+
+    def __init__(self, values):
+        pairs = set()
+        for value in values:
+            if not value:
+                continue
+            key = fold(value)
+            pairs.add((key, value))
+            for start in WORD_START.finditer(key):
+                pairs.add((key[start.start():], value))
+        pairs = sorted(pairs)
+        self.keys = [key for key, _ in pairs]
+        self.values = [value for _, value in pairs]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def complete(self, prefix, limit=SUGGEST_LIMIT):
+        prefix = fold(prefix)
+        found = {}
+        i = bisect_left(self.keys, prefix)
+        while i < len(self.keys) and len(found) < limit and self.keys[i].startswith(prefix):
+            found.setdefault(self.values[i], None)
+            i += 1
+        return list(found)
+
+
+class Suggestions:
+    """a PrefixIndex per filter field, rebuilt when the build id changes"""
+
+    def __init__(self, engine, build_id):
+        self.engine = engine
+        self.build_id = build_id
+        self.build = None
+        self.fields = MappingProxyType({})
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        build = self.build_id()
+        if build != self.build:
+            with self.lock:
+                if build != self.build:
+                    self.load()
+                    self.build = build
+        return self
+
+    def load(self):
+        with self.engine.connect() as conn:
+            languages = conn.execute(select(Language.name, Language.clade)).all()
+            sources = conn.execute(select(Reference.short)).scalars().all()
+            entries = conn.execute(select(Lemma.word, Lemma.gloss).where(Lemma.origin_lemma_id == None)).all()
+        self.fields = MappingProxyType({
+            "lang": PrefixIndex(name for name, _ in languages),
+            "clade": PrefixIndex(clade for _, clade in languages),
+            "source": PrefixIndex(sources),
+            "word": PrefixIndex(word for word, _ in entries),
+            "gloss": PrefixIndex(gloss for _, gloss in entries),
+        })
+
+    def complete(self, field, prefix, limit=SUGGEST_LIMIT):
+        """completions of `prefix` for filter `field`; KeyError for a field without an index"""
+        return self.refresh().fields[field].complete(prefix, limit)
@@ -1,6 +1,8 @@
 document.addEventListener('DOMContentLoaded', () => {
 
     const classes = ['lang', 'origin-lang', 'entry-name', 'source', 'gloss', 'word', 'origin', 'clade', 'notes', 'reflexes'];
+    // filter boxes with server-side completions (see /suggest)
+    const suggested = ['lang', 'source', 'gloss', 'word', 'clade'];
     const special_chars = ['ŋ', 'ṭ', 'ḍ', 'ṇ', 'ṣ', 'ṛ', 'r̩', 'r̆', 'ṁ', 'ʰ'];
     var pal = document.createElement("div");
     pal.classList.add("palette");
@@ -16,10 +18,20 @@ document.addEventListener('DOMContentLoaded', () => {
     // create node
     var loader = document.createElement("tr");
     var temp = $('<div/>');
+    var pending = null;
     loader.classList.add("loader-line");
     loader.classList.add("hidden");
     results.prepend(loader);
 
+    // page links carry a keyset cursor when the server has one, with the page number as a fallback
+    const pageParams = (nav) => {
+        const obj = { page: nav.dataset.page };
+        if (nav.dataset.cursor) {
+            obj.cursor = nav.dataset.cursor;
+        }
+        return obj;
+    }
+
     const filterEntries = (obj) => {
         // add loading spinner to start of results
         results.prepend(loader);
@@ -30,21 +42,45 @@ document.addEventListener('DOMContentLoaded', () => {
         if (!('page' in obj)) {
             url.searchParams.delete('page');
         }
+        if (!('cursor' in obj)) {
+            url.searchParams.delete('cursor');
+        }
         window.history.pushState({}, null, url);
 
-        temp.load(url + ' .results, .showing, .page', function () {
-            $('.results').html($('.results > *', temp));
-            $('.page').html($('.page > *', temp));
-            $('.showing').html($('.showing', temp));
-            // page navigation
-            const pageNav = document.querySelectorAll('.page-nav');
-            pageNav.forEach(nav => {
-                nav.addEventListener('click', event => {
-                    filterEntries({ page: event.target.dataset.page });
+        // only the results, count and pager are rendered; a newer filter cancels the request in flight
+        if (pending) {
+            pending.abort();
+        }
+        const request = pending = new AbortController();
+        const fragmentUrl = new URL(url);
+        fragmentUrl.searchParams.set('fragment', 'results');
+        fetch(fragmentUrl, { signal: request.signal })
+            .then(response => response.text())
+            .then(html => {
+                // pages without a fragment mode answer in full; parseHTML leaves their scripts out
+                temp.empty().append($.parseHTML(html));
+                $('.results').html($('.results > *', temp));
+                $('.page').html($('.page > *', temp));
+                $('.showing').html($('.showing', temp));
+                // page navigation
+                const pageNav = document.querySelectorAll('.page-nav');
+                pageNav.forEach(nav => {
+                    nav.addEventListener('click', event => {
+                        filterEntries(pageParams(event.target));
+                    });
                 });
+                origUrl = url;
+            })
+            .catch(error => {
+                if (error.name !== 'AbortError') {
+                    throw error;
+                }
+            })
+            .finally(() => {
+                if (pending === request) {
+                    pending = null;
+                }
             });
-            origUrl = url;
-        });
     }
 
     for (let i = 0; i < classes.length; i++) {
@@ -68,6 +104,40 @@ document.addEventListener('DOMContentLoaded', () => {
             });
             filter.parentNode.appendChild(palette);
 
+            // completions as a datalist, refreshed as the user types
+            if (suggested.includes(className)) {
+                let list = document.createElement('datalist');
+                let suggesting = null;
+                list.id = `${className}-suggestions`;
+                filter.setAttribute('list', list.id);
+                filter.parentNode.appendChild(list);
+                filter.addEventListener('input', event => {
+                    if (suggesting) {
+                        suggesting.abort();
+                    }
+                    if (!filter.value) {
+                        list.replaceChildren();
+                        return;
+                    }
+                    suggesting = new AbortController();
+                    const params = new URLSearchParams({ field: className, q: filter.value });
+                    fetch(`/suggest?${params}`, { signal: suggesting.signal })
+                        .then(response => response.json())
+                        .then(values => {
+                            list.replaceChildren(...values.map(value => {
+                                let option = document.createElement('option');
+                                option.value = value;
+                                return option;
+                            }));
+                        })
+                        .catch(error => {
+                            if (error.name !== 'AbortError') {
+                                throw error;
+                            }
+                        });
+                });
+            }
+
             filter.addEventListener('keyup', event => {
                 loader.classList.remove('hidden');
                 let new_value = event.target.value;
@@ -134,7 +204,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const pageNav = document.querySelectorAll('.page-nav');
     pageNav.forEach(nav => {
         nav.addEventListener('click', event => {
-            filterEntries({ page: event.target.dataset.page });
+            filterEntries(pageParams(event.target));
         });
     });
 });
\ No newline at end of file
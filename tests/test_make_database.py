@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Tests for the database build script, run against a tiny CLDF fixture.
+"""
+import os
+import sqlite3
+import sys
+
+import pytest
+
+# the app imports make_database itself, so load it first to avoid a circular import
+from src.neojambu import app  # noqa: F401
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+import make_database
+
+LANGUAGES = """ID,Name,Glottocode,Longitude,Latitude,Clade
+Indo-Aryan,Indo-Aryan,indo1321,77.0,28.0,OIA
+hin,Hindi,hind1269,77.2,28.6,W. Hindi
+pnb,Punjabi: Lahore,panj1256,74.3,31.5,Punjabic
+"""
+
+PARAMETERS = """ID,Name,Description,Language_ID,Etyma
+1,kāṣṭhá,wood,Indo-Aryan,
+2,jambú,rose apple,Indo-Aryan,see [1]
+"""
+
+FORMS = """ID,Language_ID,Parameter_ID,Form,Gloss,Native,Phonemic,Original,Description,Source,Cognateset
+f1,hin,1,kāṭh,wood,काठ,kaːʈʰ,,,turner[1];platts,
+f2,pnb,1,kāṭṭh,timber,,,,,turner[2],
+f3,hin,>2,jāmun,rose apple,,,,,,
+"""
+
+SOURCES = """@book{turner,
+  author = {Turner, Ralph Lilley},
+  title = {A comparative dictionary of the Indo-Aryan languages},
+  year = {1966},
+  publisher = {Oxford University Press},
+  included = {Yes}
+}
+"""
+
+
+def write_cldf(data_dir, languages=LANGUAGES, parameters=PARAMETERS, forms=FORMS):
+    data_dir.mkdir(exist_ok=True)
+    (data_dir / "languages.csv").write_text(languages)
+    (data_dir / "parameters.csv").write_text(parameters)
+    (data_dir / "forms.csv").write_text(forms)
+    (data_dir / "sources.bib").write_text(SOURCES)
+    return str(data_dir)
+
+
+def dump(db_path):
+    conn = sqlite3.connect(db_path)
+    tables = ["languages", "references", "lemmas", "lemma_reference", "build_hashes"]
+    result = {table: sorted(conn.execute(f'SELECT * FROM "{table}"').fetchall(), key=repr) for table in tables}
+    conn.close()
+    return result
+
+
+@pytest.fixture
+def built_db(tmp_path):
+    db_path = str(tmp_path / "data.db")
+    make_database.main(data_dir=write_cldf(tmp_path / "cldf"), db_path=db_path)
+    conn = sqlite3.connect(db_path)
+    yield conn
+    conn.close()
+
+
+class TestParseRef:
+    def test_empty(self):
+        assert make_database.parse_ref("") == []
+
+    def test_strips_pages_and_duplicates(self):
+        assert sorted(make_database.parse_ref("a[1];b;a[2]")) == ["a", "b"]
+
+
+class TestBulkLoad:
+    def test_row_counts(self, built_db):
+        assert built_db.execute("SELECT COUNT(*) FROM languages").fetchone()[0] == 3
+        assert built_db.execute("SELECT COUNT(*) FROM lemmas").fetchone()[0] == 5
+        assert built_db.execute("SELECT COUNT(*) FROM lemma_reference").fetchone()[0] == 3
+
+    def test_relation_prefix_stripped(self, built_db):
+        origin = built_db.execute("SELECT origin_lemma_id FROM lemmas WHERE id = 'f3'").fetchone()[0]
+        assert origin == "2"
+
+    def test_order(self, built_db):
+        rows = built_db.execute('SELECT id, "order" FROM lemmas ORDER BY "order"').fetchall()
+        assert rows == [("1", 0), ("f1", 1), ("f2", 2), ("2", 1000), ("f3", 1001)]
+
+    def test_derived_fields(self, built_db):
+        counts = dict(built_db.execute("SELECT id, lemma_count FROM languages"))
+        assert counts == {"Indo-Aryan": 2, "hin": 2, "pnb": 1}
+        clades = built_db.execute("SELECT clades FROM lemmas WHERE id = '1'").fetchone()[0]
+        assert clades == "Punjabic,W. Hindi"
+
+    def test_indexes_created(self, built_db):
+        names = {row[0] for row in built_db.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        assert {
+            "idx_lemmas_origin_lemma_id",
+            "idx_lemmas_language_id",
+            "idx_lemmas_order",
+            "idx_lemmas_cognateset",
+            "idx_lemma_reference_reference_id",
+        } <= names
+
+    def test_full_text_index(self, built_db):
+        rows = built_db.execute("SELECT id FROM lemmas_fts WHERE gloss LIKE '%ose app%'").fetchall()
+        assert sorted(rows) == [("2",), ("f3",)]
+
+    def test_fuzzy_index(self, built_db):
+        rows = built_db.execute(
+            "SELECT fuzzy_forms.form, fuzzy_lemmas.lemma_id FROM fuzzy_forms "
+            "JOIN fuzzy_lemmas ON fuzzy_lemmas.form_id = fuzzy_forms.id WHERE fuzzy_lemmas.lemma_id = 'f1'"
+        ).fetchall()
+        assert sorted(rows) == [("kaːʈʰ", "f1"), ("kāṭh", "f1")]
+        grams = built_db.execute(
+            "SELECT gram, length FROM fuzzy_grams JOIN fuzzy_forms ON fuzzy_forms.id = fuzzy_grams.form_id "
+            "WHERE fuzzy_forms.form = 'kāṭh'"
+        ).fetchall()
+        assert sorted(grams) == [("^k", 4), ("h$", 4), ("kā", 4), ("āṭ", 4), ("ṭh", 4)]
+
+    def test_folded_keys(self, built_db):
+        keys = built_db.execute("SELECT word_key, gloss_key, native_key FROM lemmas WHERE id = 'f1'").fetchone()
+        assert keys == ("kath", "wood", "काठ")
+        assert built_db.execute("SELECT word_key FROM lemmas WHERE id = '1'").fetchone()[0] == "kastha"
+
+    def test_unknown_reference_gets_bare_row(self, built_db):
+        refs = dict(built_db.execute('SELECT id, short FROM "references"'))
+        assert refs == {"turner": "T1966", "platts": None}
+
+
+class TestTransform:
+    def test_parse_relation(self):
+        row = make_database.parse_relation({"Parameter_ID": "~12"})
+        assert row == {"Parameter_ID": "12", "Relation": "s"}
+
+    def test_process_pool_keeps_order(self, monkeypatch):
+        monkeypatch.setattr(make_database, "CHUNK_SIZE", 3)
+        rows = [{"Parameter_ID": f">{i}", "Source": f"r{i}[1]"} for i in range(20)]
+        funcs = (make_database.parse_relation, make_database.parse_refs)
+        result = list(make_database.transform(rows, funcs, workers=2))
+        assert [row["Parameter_ID"] for row in result] == [str(i) for i in range(20)]
+        assert [row["Refs"] for row in result] == [[f"r{i}"] for i in range(20)]
+
+
+class TestDiffer:
+    def test_full_build_remembers_no_ids(self):
+        differ = make_database.Differ(None, "forms", full=True)
+        assert differ.changed("f1", ("f1",))
+        assert not differ.seen and differ.deleted() == []
+
+
+class TestIncrementalBuild:
+    EDITED_FORMS = (
+        FORMS.replace("f2,pnb,1,kāṭṭh", "f2,hin,2,kāṭṭh").replace("f3,hin,>2,jāmun,rose apple,,,,,,\n", "")
+        + "f4,pnb,2,jamū,rose apple,,,,,platts[3],\n"
+    )
+
+    def test_unchanged_data_writes_nothing(self, tmp_path, capsys):
+        data_dir = write_cldf(tmp_path / "cldf")
+        db_path = str(tmp_path / "data.db")
+        make_database.main(data_dir=data_dir, db_path=db_path)
+        before = dump(db_path)
+        capsys.readouterr()
+        make_database.main(data_dir=data_dir, db_path=db_path, incremental=True)
+        assert "forms: 0 rows" in capsys.readouterr().out
+        assert dump(db_path) == before
+
+    def test_matches_full_build(self, tmp_path):
+        db_path = str(tmp_path / "data.db")
+        make_database.main(data_dir=write_cldf(tmp_path / "cldf"), db_path=db_path)
+        languages = LANGUAGES.replace("Punjabic", "Sindhic")
+        data_dir = write_cldf(tmp_path / "cldf", languages=languages, forms=self.EDITED_FORMS)
+        make_database.main(data_dir=data_dir, db_path=db_path, incremental=True)
+
+        full_path = str(tmp_path / "full.db")
+        make_database.main(data_dir=data_dir, db_path=full_path)
+        assert dump(db_path) == dump(full_path)
+
+    def test_full_text_index_follows_edits(self, tmp_path):
+        data_dir = write_cldf(tmp_path / "cldf")
+        db_path = str(tmp_path / "data.db")
+        make_database.main(data_dir=data_dir, db_path=db_path)
+        write_cldf(tmp_path / "cldf", forms=self.EDITED_FORMS)
+        make_database.main(data_dir=data_dir, db_path=db_path, incremental=True)
+        conn = sqlite3.connect(db_path)
+        rows = conn.execute("SELECT id FROM lemmas_fts WHERE word LIKE '%jam%'").fetchall()
+        conn.close()
+        assert sorted(rows) == [("2",), ("f4",)]
+
+    def test_fuzzy_index_follows_edits(self, tmp_path):
+        data_dir = write_cldf(tmp_path / "cldf")
+        db_path = str(tmp_path / "data.db")
+        make_database.main(data_dir=data_dir, db_path=db_path)
+        write_cldf(tmp_path / "cldf", forms=self.EDITED_FORMS)
+        make_database.main(data_dir=data_dir, db_path=db_path, incremental=True)
+        conn = sqlite3.connect(db_path)
+        forms = {row[0] for row in conn.execute("SELECT form FROM fuzzy_forms")}
+        conn.close()
+        assert "jamū" in forms and "jāmun" not in forms
+
+    def test_search_indexes_match_full_build(self, tmp_path):
+        data_dir = write_cldf(tmp_path / "cldf")
+        db_path = str(tmp_path / "data.db")
+        make_database.main(data_dir=data_dir, db_path=db_path)
+        write_cldf(tmp_path / "cldf", forms=self.EDITED_FORMS.replace("timber", "beam"))
+        make_database.main(data_dir=data_dir, db_path=db_path, incremental=True)
+        full_path = str(tmp_path / "full.db")
+        make_database.main(data_dir=data_dir, db_path=full_path)
+
+        def indexes(path):
+            conn = sqlite3.connect(path)
+            conn.execute("INSERT INTO lemmas_fts(lemmas_fts, rank) VALUES ('integrity-check', 1)")
+            found = {
+                term: sorted(conn.execute("SELECT id FROM lemmas_fts WHERE lemmas_fts MATCH ?", (term,)).fetchall())
+                for term in ("beam", "timber", "kāṭ", "jam", "rose")
+            }
+            found["links"] = sorted(conn.execute(
+                "SELECT form, lemma_id FROM fuzzy_forms JOIN fuzzy_lemmas ON fuzzy_lemmas.form_id = fuzzy_forms.id"
+            ).fetchall())
+            found["grams"] = sorted(conn.execute(
+                "SELECT form, gram, length FROM fuzzy_forms JOIN fuzzy_grams ON fuzzy_grams.form_id = fuzzy_forms.id"
+            ).fetchall())
+            conn.close()
+            return found
+
+        assert indexes(db_path) == indexes(full_path)
+
+    def test_build_id_changes_only_with_data(self, tmp_path):
+        data_dir = write_cldf(tmp_path / "cldf")
+        db_path = str(tmp_path / "data.db")
+
+        def build_id():
+            conn = sqlite3.connect(db_path)
+            value = conn.execute("SELECT value FROM build_info WHERE key = 'build_id'").fetchone()[0]
+            conn.close()
+            return value
+
+        make_database.main(data_dir=data_dir, db_path=db_path)
+        first = build_id()
+        make_database.main(data_dir=data_dir, db_path=db_path, incremental=True)
+        assert build_id() == first
+        write_cldf(tmp_path / "cldf", forms=self.EDITED_FORMS)
+        make_database.main(data_dir=data_dir, db_path=db_path, incremental=True)
+        assert build_id() != first
+
+
+class TestSourcesCache:
+    def test_cache_hits_skip_formatting(self, tmp_path, monkeypatch):
+        data_dir = write_cldf(tmp_path / "cldf")
+        db_path = str(tmp_path / "data.db")
+        make_database.main(data_dir=data_dir, db_path=db_path)
+        assert (tmp_path / "sources_cache.json").exists()
+
+        def fail(bibtex):
+            raise AssertionError("cached source was formatted again")
+
+        monkeypatch.setattr(make_database, "format_source", fail)
+        make_database.main(data_dir=data_dir, db_path=db_path)
+        conn = sqlite3.connect(db_path)
+        source = conn.execute('SELECT source FROM "references" WHERE id = \'turner\'').fetchone()[0]
+        conn.close()
+        assert "Turner" in source
+
+    def test_short_refs_are_disambiguated_in_order(self):
+        entries = make_database.pybtex.database.parse_string(
+            SOURCES + SOURCES.replace("{turner,", "{turner2,") + SOURCES.replace("{turner,", "{turner3,"),
+            "bibtex",
+        ).entries
+        assert make_database.short_refs(entries) == {
+            "turner": "T1966",
+            "turner2": "T1966a",
+            "turner3": "T1966b",
+        }
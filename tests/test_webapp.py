@@ -3,13 +3,27 @@
 Comprehensive test suite for neojambu webapp performance improvements.
 Tests database indexes, session management, and Flask routes.
 """
+import csv
+import gzip
+import io
+import json
+import os
+import re
+import sys
+import flask
 import pytest
 import time
 from flask import Flask
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, func, text
 from sqlalchemy.orm import sessionmaker
-from src.neojambu.app import app, get_session
+from src.neojambu.app import app, get_session, responses
 from src.neojambu.models import Lemma, Language, Reference
+from src.neojambu import api, db, fuzzy, patterns, search
+from src.neojambu.cache import CountCache, LRUCache, ResponseCache
+from src.neojambu.compression import precompress_directory
+from src.neojambu.registry import Registry
+from src.neojambu.rows import lemma_row_columns, lemma_rows
+from src.neojambu.suggest import PrefixIndex
 
 class TestDatabaseIndexes:
     """Test that database indexes are properly created and functioning."""
@@ -80,6 +94,14 @@ class TestDatabaseIndexes:
             assert end - start < 0.05, f"Query too slow: {end - start:.4f}s"
             assert len(result) > 0, "Should return results"
 
+    def test_route_queries_use_indexes(self):
+        """Test that no route query falls back to scanning a large table."""
+        sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+        from check_query_plans import check_query_plans
+
+        failures = check_query_plans()
+        assert not failures, "\n".join(f"{route}: {'; '.join(bad)}" for route, _, bad in failures)
+
 
 class TestSessionManagement:
     """Test session management and connection pooling."""
@@ -279,6 +301,957 @@ class TestPerformanceRegression:
         finally:
             session.close()
 
+    def test_entry_page_statement_count(self, monkeypatch):
+        """The entry page loads its reflexes once, however many there are."""
+        monkeypatch.setitem(app.config, 'RESPONSE_CACHE', False)
+        session = get_session()
+        try:
+            small, large = [
+                session.query(Lemma.origin_lemma_id).filter(Lemma.origin_lemma_id != None)
+                .group_by(Lemma.origin_lemma_id).order_by(order(func.count())).first()[0]
+                for order in (lambda x: x, lambda x: x.desc())
+            ]
+        finally:
+            session.close()
+        engine = sys.modules["src.neojambu.app"].engine
+        statements = []
+        record = lambda *args: statements.append(args[2])
+        client = app.test_client()
+        event.listen(engine, "before_cursor_execute", record)
+        try:
+            for entry in (small, large):
+                for args in ("", "?sort=asc-lang"):
+                    statements.clear()
+                    assert client.get(f'/entries/{entry}{args}').status_code == 200
+                    assert len(statements) <= 3, statements
+        finally:
+            event.remove(engine, "before_cursor_execute", record)
+
+
+
+class TestFullTextSearch:
+    """Test that filters through the trigram index match plain LIKE filters."""
+
+    QUERIES = [
+        "/query?type=reflexes&word=ana",
+        "/query?type=reflexes&gloss=wat",
+        "/query?type=reflexes&word=ka",
+        "/query?type=entries&word=ara",
+        "/query?type=reflexes&origin=akar&origin_lang=Indo-Aryan",
+        "/query?type=reflexes&word=zzzq",
+    ]
+
+    def setup_method(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+    def test_index_detected(self):
+        assert search.fts_enabled, "data.db has no lemmas_fts table"
+
+    def test_matches_like_fallback(self, monkeypatch):
+        for url in self.QUERIES:
+            indexed = self.client.get(url).get_json()
+            monkeypatch.setattr(search, "fts_enabled", False)
+            plain = self.client.get(url).get_json()
+            monkeypatch.setattr(search, "fts_enabled", True)
+            assert indexed == plain, url
+
+
+
+class TestFoldedSearch:
+    """Test accent- and case-insensitive matching against the folded search keys."""
+
+    def test_fold(self):
+        assert search.fold("kāṣṭhá") == "kastha"
+        assert search.fold("Kr̩ṣṇa") == "krsna"
+        assert search.fold("bʰāī") == "bhai"
+        assert search.fold(None) is None
+
+    def test_fold_mode_ignores_accents(self):
+        session = get_session()
+        try:
+            lemma = session.query(Lemma).filter(Lemma.word != Lemma.word_key).first()
+        finally:
+            session.close()
+        if not lemma:
+            pytest.skip("No accented words in database")
+        term = lemma.word.upper()
+        with app.test_client() as client:
+            folded = client.get(f"/query?type=reflexes&word={term}&fold=1").get_json()
+        assert lemma.id in [row["id"] for row in folded] or len(folded) == 50
+        assert all(search.fold(term) in search.fold(row["word"]) for row in folded)
+
+    def test_databases_without_keys(self, tmp_path, monkeypatch):
+        from src.neojambu.models import Base
+        engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+        Base.metadata.create_all(engine)
+        with engine.begin() as conn:
+            for column in ("word_key", "gloss_key", "native_key"):
+                conn.execute(text(f"ALTER TABLE lemmas DROP COLUMN {column}"))
+            conn.execute(text("INSERT INTO lemmas (id, word, \"order\") VALUES ('x', 'kāṭh', 1)"))
+        monkeypatch.setattr(search, "folded_keys", True)
+        assert not search.detect_folded_keys(engine)
+        session = sessionmaker(bind=engine)()
+        assert session.query(Lemma).filter_by(id="x").first().word == "kāṭh"
+        session.close()
+
+        with app.test_client() as client:
+            folded = client.get("/query?type=reflexes&word=KA&fold=1").get_json()
+        assert folded and all("ka" in row["word"].lower() for row in folded)
+
+
+
+class TestKeysetPagination:
+    """Test that cursor pages match the offset pages they replace."""
+
+    def setup_method(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+    def ids(self, url):
+        response = self.client.get(url)
+        return [row["id"] for row in response.get_json()], response.headers
+
+    def test_cursors_match_offsets(self):
+        for base in ["/query?type=reflexes", "/query?type=entries", "/query?type=reflexes&sort=desc-gloss"]:
+            first, headers = self.ids(base)
+            assert "X-Prev-Cursor" not in headers
+            second, headers = self.ids(f"{base}&cursor={headers['X-Next-Cursor']}")
+            assert second == self.ids(f"{base}&page=2")[0], base
+            back, _ = self.ids(f"{base}&cursor={headers['X-Prev-Cursor']}")
+            assert back == first, base
+
+    def test_invalid_cursor_falls_back_to_page(self):
+        page = self.ids("/query?type=reflexes&page=3")[0]
+        assert self.ids("/query?type=reflexes&page=3&cursor=not-a-cursor")[0] == page
+        _, headers = self.ids("/query?type=reflexes")
+        # a cursor made for one sort is ignored under another
+        assert self.ids(f"/query?type=reflexes&sort=asc-word&cursor={headers['X-Next-Cursor']}")[0] == \
+            self.ids("/query?type=reflexes&sort=asc-word")[0]
+
+    def test_prev_cursor_keeps_outer_joined_nulls(self):
+        session = get_session()
+        roots = session.query(Lemma).filter(Lemma.origin_lemma_id == None).count()
+        session.close()
+        # the page holding the last of the lemmas without an origin, which sort first
+        base = f"/query?type=reflexes&sort=asc-origin&page={(roots - 1) // 50 + 1}"
+        page, headers = self.ids(base)
+        _, headers = self.ids(f"{base}&cursor={headers['X-Next-Cursor']}")
+        assert self.ids(f"{base}&cursor={headers['X-Prev-Cursor']}")[0] == page
+
+    def test_malformed_token_falls_back_to_page(self):
+        import base64
+        page = self.ids("/query?type=reflexes&page=2")[0]
+        for token in [{"s": "", "d": "next", "k": 5}, {"s": "", "d": "next", "k": [1]},
+                      {"s": "", "d": "next", "k": [{}, []]}, [1, 2], "next"]:
+            cursor = base64.urlsafe_b64encode(json.dumps(token).encode()).decode()
+            response = self.client.get(f"/query?type=reflexes&page=2&cursor={cursor}")
+            assert response.status_code == 200, token
+            assert [row["id"] for row in response.get_json()] == page, token
+
+    def test_html_pages_link_cursors(self):
+        response = self.client.get('/reflexes')
+        assert b'data-cursor="' in response.data
+
+
+
+class TestCountCache:
+    """Test cached and approximate listing counts."""
+
+    def test_lru_evicts_oldest(self):
+        cache = LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        assert cache.get("b") is None
+        assert cache.get("a") == 1 and cache.get("c") == 3
+
+    def test_lru_evicts_by_size(self):
+        cache = LRUCache(maxsize=10, max_bytes=10)
+        cache.set("a", "x" * 4)
+        cache.set("b", "x" * 4)
+        cache.set("c", "x" * 4)
+        assert cache.get("a") is None and cache.bytes == 8
+        cache.set("b", "x")
+        assert cache.bytes == 5
+
+    def test_counts_cached_per_build(self):
+        build = ["first"]
+        counts = CountCache(lambda: build[0])
+        session = get_session()
+        try:
+            query = session.query(Lemma)
+            total = counts.count(query, ("all",))
+            assert counts.count(query.filter(Lemma.id == None), ("all",)) == total
+            build[0] = "second"
+            assert counts.count(query.filter(Lemma.id == None), ("all",)) == 0
+        finally:
+            session.close()
+
+    def test_approximate_count(self):
+        counts = CountCache(lambda: "build")
+        session = get_session()
+        try:
+            assert counts.count(session.query(Lemma), ("all",), limit=10) == "10+"
+        finally:
+            session.close()
+
+    def test_scanning_filter_reports_approximate_count(self, monkeypatch):
+        monkeypatch.setitem(app.config, "APPROXIMATE_COUNT_LIMIT", 5)
+        monkeypatch.setitem(app.config, "RESPONSE_CACHE", False)
+        with app.test_client() as client:
+            # two letters are too few for the trigram index, so this filter is counted approximately
+            response = client.get('/reflexes?word=ka')
+            # language, clade and source filters go through indexed joins and are counted exactly
+            exact = client.get('/reflexes?lang=a')
+        assert response.status_code == 200
+        assert b'of 5+ reflexes' in response.data
+        assert not re.search(rb'of \S+\+ reflexes', exact.data)
+
+    def test_counts_are_exact_by_default(self, monkeypatch):
+        assert app.config["APPROXIMATE_COUNT_LIMIT"] is None
+        monkeypatch.setitem(app.config, "RESPONSE_CACHE", False)
+        with app.test_client() as client:
+            response = client.get('/reflexes?word=ka')
+        assert not re.search(rb'of \S+\+ reflexes', response.data)
+
+
+
+class TestResponseCache:
+    """Test the two-tier rendered response cache."""
+
+    def setup_method(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+    def test_repeat_request_is_served_from_cache(self):
+        responses.clear()
+        first = self.client.get('/languages?sort=asc-lang&lang=a')
+        hits = responses.memory.hits
+        second = self.client.get('/languages?lang=a&sort=asc-lang')
+        assert second.status_code == 200
+        assert second.data == first.data
+        assert responses.memory.hits == hits + 1
+
+    def test_disk_tier_is_shared(self, tmp_path):
+        build = ["first"]
+        shared = str(tmp_path / "responses.db")
+        writer = ResponseCache(lambda: build[0], shared)
+        reader = ResponseCache(lambda: build[0], shared)
+        writer.set("/references?", 200, [("Content-Type", "text/html")], b"<p>refs</p>")
+        assert reader.get("/references?") == (200, [["Content-Type", "text/html"]], b"<p>refs</p>")
+        assert reader.disk_hits == 1
+        build[0] = "second"
+        assert reader.get("/references?") is None
+
+    def test_disk_tier_evicts_by_size(self, tmp_path):
+        disk = ResponseCache(lambda: "build", str(tmp_path / "responses.db"), max_bytes=1000).disk
+        for i in range(10):
+            disk.set("build", f"/page{i}", b"x" * 300)
+        entries, size = disk.stats()
+        assert size <= 1000
+        assert disk.get("build", "/page9") is not None
+
+    def test_memory_tier_evicts_by_size(self, tmp_path):
+        cache = ResponseCache(lambda: "build", str(tmp_path / "responses.db"), max_bytes=1000)
+        for i in range(10):
+            cache.set(f"/page{i}", 200, [], b"x" * 300)
+        assert cache.memory.bytes <= 1000 and len(cache.memory) == 3
+        assert cache.memory.get(("build", "/page9")) is not None
+
+    def test_stats_endpoint(self):
+        response = self.client.get('/cache/stats')
+        assert response.status_code == 200
+        assert {"memory", "disk", "misses"} <= set(response.get_json()["responses"])
+
+
+
+class TestConditionalGet:
+    """Test ETag / Last-Modified revalidation tied to the database build."""
+
+    def setup_method(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+    def test_validators_and_cache_control(self):
+        response = self.client.get('/query?type=languages')
+        assert response.headers.get('ETag')
+        assert response.headers.get('Last-Modified')
+        assert 'max-age' in response.headers.get('Cache-Control', '')
+        other = self.client.get('/query?type=references')
+        assert other.headers['ETag'] != response.headers['ETag']
+
+    def test_not_modified_without_a_session(self, monkeypatch):
+        etag = self.client.get('/languages').headers['ETag']
+
+        def fail():
+            raise AssertionError("session opened for a 304")
+
+        # src.neojambu re-exports the Flask app under the module's name
+        monkeypatch.setattr(sys.modules["src.neojambu.app"], "get_session", fail)
+        response = self.client.get('/languages', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.headers['ETag'] == etag
+        modified = self.client.get('/languages').headers['Last-Modified']
+        response = self.client.get('/languages', headers={'If-Modified-Since': modified})
+        assert response.status_code == 304
+
+    def test_stale_etag_gets_full_response(self):
+        response = self.client.get('/languages', headers={'If-None-Match': '"stale"'})
+        assert response.status_code == 200
+
+
+
+class TestQueryApi:
+    """Test the column-projected /query API."""
+
+    def setup_method(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+    def test_rows_are_plain_columns(self):
+        rows = self.client.get('/query?type=reflexes').get_json()
+        assert rows and set(rows[0]) == set(api.LEMMA_FIELDS)
+        reflex = self.client.get(f"/query?type=reflex&reflex={rows[0]['id']}").get_json()
+        assert reflex == rows[0]
+
+    def test_nested_rows(self):
+        session = get_session()
+        try:
+            reflex = session.query(Lemma).filter(Lemma.origin_lemma_id != None).first()
+            entry, language = reflex.origin_lemma_id, reflex.language_id
+        finally:
+            session.close()
+        rows = self.client.get(f'/query?type=entry&entry={entry}').get_json()
+        assert all(row['origin_lemma_id'] == entry for row in rows)
+        assert all(row['language']['id'] == row['language_id'] for row in rows)
+        assert all(set(ref) == set(api.REFERENCE_FIELDS) for row in rows for ref in row['references'])
+        rows = self.client.get(f'/query?type=language&language={language}').get_json()
+        assert all(row['origin_lemma']['id'] == row['origin_lemma_id'] for row in rows)
+
+    def test_missing_rows_are_404(self):
+        response = self.client.get('/query?type=reflex&reflex=does-not-exist')
+        assert response.status_code == 404
+        assert response.get_json() is None
+
+    def test_ndjson_matches_json(self):
+        for kind in ['languages', 'references']:
+            rows = self.client.get(f'/query?type={kind}').get_json()
+            response = self.client.get(f'/query?type={kind}&format=ndjson')
+            assert response.mimetype == 'application/x-ndjson'
+            assert response.is_streamed
+            assert [json.loads(line) for line in response.data.splitlines()] == rows
+
+
+class TestExport:
+    """Test the streamed bulk exports."""
+
+    def setup_method(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+    def test_csv_has_every_lemma(self):
+        session = get_session()
+        try:
+            total = session.query(Lemma).count()
+        finally:
+            session.close()
+        response = self.client.get('/export/lemmas')
+        assert response.is_streamed
+        assert response.mimetype == 'text/csv'
+        rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+        assert rows[0] == api.LEMMA_FIELDS
+        assert len(rows) == total + 1
+
+    def test_gzipped_ndjson_matches_query(self, monkeypatch):
+        monkeypatch.setattr(api, 'EXPORT_BATCH', 7)
+        session = get_session()
+        try:
+            language = session.query(Language.id).filter(Language.lemma_count > 0).first()[0]
+        finally:
+            session.close()
+        response = self.client.get(f'/export/languages/{language}?format=ndjson', headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        rows = [json.loads(line) for line in gzip.decompress(response.data).splitlines()]
+        assert rows and all(row['language_id'] == language for row in rows)
+        assert [row['order'] for row in rows] == sorted(row['order'] for row in rows)
+
+    def test_unknown_exports(self):
+        assert self.client.get('/export/references/does-not-exist').status_code == 404
+        assert self.client.get('/export/concepts/1').status_code == 404
+        assert self.client.get('/export/lemmas?format=xml').status_code == 400
+
+
+class TestBatchQuery:
+    """Test POST /query/batch."""
+
+    def setup_method(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+    def sample(self, n):
+        session = get_session()
+        try:
+            reflexes = session.query(Lemma).filter(Lemma.origin_lemma_id != None).limit(n).all()
+            return (
+                [reflex.id for reflex in reflexes],
+                list({reflex.origin_lemma_id for reflex in reflexes}),
+                list({reflex.language_id for reflex in reflexes}),
+            )
+        finally:
+            session.close()
+
+    def statements(self, body):
+        engine = sys.modules["src.neojambu.app"].engine
+        captured = []
+        record = lambda *args: captured.append(args[2])
+        event.listen(engine, "before_cursor_execute", record)
+        try:
+            response = self.client.post('/query/batch', json=body)
+        finally:
+            event.remove(engine, "before_cursor_execute", record)
+        assert response.status_code == 200
+        return response.get_json(), len(captured)
+
+    def test_matches_single_queries(self):
+        reflexes, entries, languages = self.sample(5)
+        result, _ = self.statements({"reflex": reflexes + ["missing"], "entry": entries, "language": languages})
+        assert result["reflex"]["missing"] is None
+        for id in reflexes:
+            single = self.client.get(f'/query?type=reflex&reflex={id}').get_json()
+            batched = result["reflex"][id]
+            assert {field: batched[field] for field in api.LEMMA_FIELDS} == single
+            assert batched["origin_lemma"]["id"] == single["origin_lemma_id"]
+            assert batched["language"]["id"] == single["language_id"]
+        for id in entries:
+            single = self.client.get(f'/query?type=entry&entry={id}').get_json()
+            assert sorted(result["entry"][id], key=lambda row: row["id"]) == sorted(single, key=lambda row: row["id"])
+        assert set(result["language"]) == set(languages)
+
+    def test_query_count_is_constant(self):
+        few = self.statements(dict(zip(["reflex", "entry", "language"], self.sample(2))))[1]
+        many = self.statements(dict(zip(["reflex", "entry", "language"], self.sample(40))))[1]
+        assert few == many
+
+    def test_bad_requests(self):
+        assert self.client.post('/query/batch', data='not json').status_code == 400
+        assert self.client.post('/query/batch', json={"concept": ["1"]}).status_code == 400
+        assert self.client.post('/query/batch', json={"reflex": "1"}).status_code == 400
+        limit = app.config['BATCH_LIMIT']
+        assert self.client.post('/query/batch', json={"reflex": ["1"] * (limit + 1)}).status_code == 400
+
+
+class TestLanguageComparison:
+    """Test /languages/<a>/<b>/... against an intersection done in Python."""
+
+    def setup_method(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+    def etyma(self, *langs):
+        session = get_session()
+        try:
+            rows = session.query(Lemma.language_id, Lemma.origin_lemma_id).filter(
+                Lemma.language_id.in_(langs), Lemma.origin_lemma_id != None
+            )
+            by_lang = {}
+            for lang, origin in rows:
+                by_lang.setdefault(lang, set()).add(origin)
+            return set.intersection(*[by_lang.get(lang, set()) for lang in langs])
+        finally:
+            session.close()
+
+    def shown(self, url):
+        response = self.client.get(url)
+        assert response.status_code == 200
+        html = response.get_data(as_text=True)
+        return set(re.findall(r'<a href="/entries/([^"]+)">', html)), html
+
+    def test_pair_and_three_way(self):
+        session = get_session()
+        try:
+            a, b = session.query(Lemma.language_id, func.count()).filter(
+                Lemma.origin_lemma_id != None
+            ).group_by(Lemma.language_id).order_by(func.count().desc()).limit(2)
+            a, b = a[0], b[0]
+            c = session.query(Language.id).filter(Language.id.notin_([a, b])).first()[0]
+        finally:
+            session.close()
+        expected = self.etyma(a, b)
+        shown, html = self.shown(f'/languages/{a}/{b}')
+        assert f'({len(expected)} matches)' in html
+        assert shown <= expected
+        assert len(shown) == min(len(expected), search.PAGE_SIZE)
+        shown, html = self.shown(f'/languages/{a}/{b}/{c}')
+        expected = self.etyma(a, b, c)
+        assert f'({len(expected)} matches)' in html
+        assert shown <= expected and len(shown) == min(len(expected), search.PAGE_SIZE)
+
+    def test_pages_cover_every_etymon(self):
+        session = get_session()
+        try:
+            lang = session.query(Lemma.language_id).filter(Lemma.origin_lemma_id != None).group_by(
+                Lemma.language_id).having(func.count() > search.PAGE_SIZE).first()[0]
+        finally:
+            session.close()
+        # comparing a language with itself lists every etymon it reflects
+        seen, html = self.shown(f'/languages/{lang}/{lang}')
+        cursor = re.search(r'data-cursor="([^"]+)"', html).group(1)
+        more, _ = self.shown(f'/languages/{lang}/{lang}?page=2&cursor={cursor}')
+        assert not seen & more
+        assert seen | more <= self.etyma(lang)
+
+    def test_unknown_language(self):
+        assert self.client.get('/languages/does-not-exist/also-not').get_data(as_text=True) == "Language not found"
+
+
+class TestEngineProfiles:
+    """Test the read-only serving engine profile."""
+
+    def test_serving_pragmas_and_read_only(self):
+        engine = db.serving_engine(db.DB_PATH)
+        try:
+            with engine.connect() as conn:
+                assert conn.exec_driver_sql("PRAGMA query_only").scalar() == 1
+                assert conn.exec_driver_sql("PRAGMA temp_store").scalar() == 2
+                assert conn.exec_driver_sql("PRAGMA cache_size").scalar() == db.SERVING_PRAGMAS["cache_size"]
+                assert conn.execute(text("SELECT COUNT(*) FROM languages")).scalar() > 0
+                with pytest.raises(Exception):
+                    conn.exec_driver_sql("CREATE TABLE scratch (a)")
+        finally:
+            engine.dispose()
+
+    def test_profile_from_environment(self, monkeypatch):
+        monkeypatch.setenv("NEOJAMBU_DB_PROFILE", "serving")
+        monkeypatch.setenv("NEOJAMBU_SQLITE_CACHE_SIZE", "1024")
+        monkeypatch.setenv("NEOJAMBU_DB_POOL_SIZE", "3")
+        engine = db.engine_from_env(db.DB_PATH)
+        try:
+            assert engine.pool.size() == 3
+            with engine.connect() as conn:
+                assert conn.exec_driver_sql("PRAGMA cache_size").scalar() == -1024
+        finally:
+            engine.dispose()
+        monkeypatch.setenv("NEOJAMBU_DB_PROFILE", "default")
+        assert db.engine_from_env(db.DB_PATH).url.database == db.DB_PATH
+        monkeypatch.setenv("NEOJAMBU_DB_PROFILE", "fast")
+        with pytest.raises(ValueError):
+            db.engine_from_env(db.DB_PATH)
+
+
+class TestStatementCache:
+    """Test that hot routes reuse their built queries with new values."""
+
+    def setup_method(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.statements = sys.modules["src.neojambu.app"].statements
+
+    def test_shape_ignores_values(self):
+        with app.test_request_context('/reflexes?word=ana&sort=asc-lang'):
+            shape = search.statement_shape(flask.request)
+        with app.test_request_context('/reflexes?word=kat&sort=asc-lang'):
+            assert search.statement_shape(flask.request) == shape
+        with app.test_request_context('/reflexes?word=ka&sort=asc-lang'):
+            # too short for the trigram index, so a different statement
+            assert search.statement_shape(flask.request) != shape
+
+    def test_reused_queries_bind_new_values(self, monkeypatch):
+        monkeypatch.setitem(app.config, 'RESPONSE_CACHE', False)
+        self.statements.clear()
+        before = self.statements.routes.stats().get("reflexes", {"hits": 0})["hits"]
+        for term in ["ana", "kat", "zzzq"]:
+            html = self.client.get(f'/reflexes?gloss={term}').get_data(as_text=True)
+            expected = self.client.get(f'/query?type=reflexes&gloss={term}').get_json()
+            assert all(f'/reflexes/{row["id"]}"' in html for row in expected)
+        assert self.statements.routes.stats()["reflexes"]["hits"] == before + 2
+
+    def test_stats_report_hit_rates(self, monkeypatch):
+        monkeypatch.setitem(app.config, 'RESPONSE_CACHE', False)
+        for _ in range(2):
+            self.client.get('/entries?gloss=wat')
+        stats = self.client.get('/cache/stats').get_json()["statements"]
+        assert stats["built"]["entries"]["hits"] >= 1
+        assert 0 < stats["compiled"]["entries"]["hit_rate"] <= 1
+
+
+class TestRegistry:
+    """Test the in-memory language and reference registry."""
+
+    def test_loaded_by_init_app_not_import(self):
+        import subprocess
+        script = (
+            "import sys\n"
+            "import src.neojambu.app\n"
+            "module = sys.modules['src.neojambu.app']\n"
+            "indexes = [module.registry, module.suggestions, module.pattern_index]\n"
+            "assert all(index.build is None for index in indexes)\n"
+            "module.init_app()\n"
+            "assert all(index.build is not None for index in indexes)\n"
+        )
+        subprocess.run([sys.executable, "-c", script], check=True, cwd=os.path.join(os.path.dirname(__file__), '..'))
+
+    def test_matches_database(self):
+        registry = sys.modules["src.neojambu.app"].registry.refresh()
+        session = get_session()
+        try:
+            languages = session.query(Language).all()
+            assert set(registry.languages) == {lang.id for lang in languages}
+            lang = languages[0]
+            assert registry.language(lang.id).name == lang.name
+            assert registry.language(lang.id).map_marker == lang.map_marker
+            reference = session.query(Reference).first()
+            assert str(registry.references[reference.id]) == repr(reference)
+        finally:
+            session.close()
+
+    def test_attach_fills_relationships(self):
+        module = sys.modules["src.neojambu.app"]
+        session = get_session()
+        try:
+            lemmas = session.query(Lemma).filter(Lemma.origin_lemma_id != None).limit(20).all()
+            expected = {lemma.id: sorted(ref.id for ref in lemma.references) for lemma in lemmas}
+            origins = {lemma.id: lemma.origin_lemma.language_id for lemma in lemmas}
+            rows = session.query(*lemma_row_columns(with_origin=True)).outerjoin(
+                Lemma.origin_lemma.of_type(search.origin_lemma)
+            ).filter(Lemma.id.in_(list(expected))).all()
+            lemmas = module.registry.attach(session, lemma_rows(rows, with_origin=True))
+        finally:
+            session.close()
+        for lemma in lemmas:
+            assert lemma.language.id == lemma.language_id
+            assert lemma.origin_lemma.language.id == origins[lemma.id]
+            assert sorted(ref.id for ref in lemma.references) == expected[lemma.id]
+
+    def test_reloads_on_new_build(self):
+        module = sys.modules["src.neojambu.app"]
+        build = ["one"]
+        registry = Registry(module.engine, lambda: build[0])
+        first = registry.refresh().languages
+        assert registry.refresh().languages is first
+        build[0] = "two"
+        assert registry.refresh().languages is not first
+        with pytest.raises(TypeError):
+            registry.languages["new"] = None
+
+
+class TestReadModels:
+    """Test that list pages render compact rows rather than ORM instances."""
+
+    def setup_method(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+    def test_list_pages_load_no_entities(self, monkeypatch):
+        monkeypatch.setitem(app.config, 'RESPONSE_CACHE', False)
+        session = get_session()
+        lang = session.query(Language).order_by(Language.lemma_count.desc()).first()
+        other = session.query(Language).filter(Language.id != lang.id).order_by(Language.lemma_count.desc()).first()
+        entry = session.query(Lemma.origin_lemma_id).filter(Lemma.origin_lemma_id != None).first()[0]
+        session.close()
+        loaded = []
+        listener = lambda target, context: loaded.append(target)
+        event.listen(Lemma, 'load', listener)
+        event.listen(Language, 'load', listener)
+        try:
+            for url in ['/reflexes', '/reflexes?origin=a&source=a', f'/languages/{lang.id}', '/languages',
+                        '/entries', f'/languages/{lang.id}/{other.id}', '/references']:
+                assert self.client.get(url).status_code == 200
+        finally:
+            event.remove(Lemma, 'load', listener)
+            event.remove(Language, 'load', listener)
+        assert loaded == []
+
+    def test_rows_read_like_models(self):
+        session = get_session()
+        try:
+            lemma = session.query(Lemma).filter(Lemma.origin_lemma_id != None).first()
+            row = session.query(*lemma_row_columns(with_origin=True)).outerjoin(
+                Lemma.origin_lemma.of_type(search.origin_lemma)
+            ).filter(Lemma.id == lemma.id).one()
+            (row,) = lemma_rows([row, row], with_origin=True, unique=True)
+            assert (row.id, row.word, row.gloss) == (lemma.id, lemma.word, lemma.gloss)
+            assert row.origin_lemma.word == lemma.origin_lemma.word
+            with pytest.raises(AttributeError):
+                row.extra = 1
+        finally:
+            session.close()
+
+
+class TestFragments:
+    """Test the results-only rendering the live filter UI requests."""
+
+    def setup_method(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+    def results(self, html):
+        return re.search(r'<tbody class="results">.*?</tbody>', html, re.S).group(0)
+
+    def test_fragment_matches_full_page(self):
+        session = get_session()
+        lang = session.query(Language).order_by(Language.lemma_count.desc()).first()
+        session.close()
+        for url in ['/reflexes?word=an', f'/languages/{lang.id}?page=2', '/entries?gloss=wat', '/languages?clade=a']:
+            full = self.client.get(url).get_data(as_text=True)
+            fragment = self.client.get(url + '&fragment=results').get_data(as_text=True)
+            assert self.results(fragment) == self.results(full)
+            assert re.search(r'<p class="muted showing">.*?</p>', full).group(0) in fragment
+            assert '<script' not in fragment and '<head' not in fragment
+            assert len(fragment) < len(full)
+
+    def test_fragment_keeps_pager(self):
+        full = self.client.get('/reflexes').get_data(as_text=True)
+        fragment = self.client.get('/reflexes?fragment=results').get_data(as_text=True)
+        cursor = re.search(r'data-cursor="([^"]+)"', full).group(1)
+        assert f'data-cursor="{cursor}"' in fragment
+        assert '<div class="page"' in fragment
+
+    def test_unsupported_pages_render_in_full(self):
+        response = self.client.get('/references?fragment=results')
+        assert response.status_code == 200
+        assert '<head' in response.get_data(as_text=True)
+
+
+class TestSuggest:
+    """Test the /suggest typeahead endpoint and its prefix index."""
+
+    def setup_method(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+    def test_completes_language_names(self):
+        session = get_session()
+        names = [name for (name,) in session.query(Language.name)]
+        session.close()
+        prefix = names[0][:2]
+        expected = sorted({name for name in names if search.fold(name).startswith(search.fold(prefix))})
+        found = self.client.get(f'/suggest?field=lang&q={prefix}&limit=50').get_json()
+        assert set(found) <= set(expected)
+        assert len(found) == min(len(expected), 50)
+
+    def test_headwords_only(self):
+        session = get_session()
+        entry = session.query(Lemma.word).filter(Lemma.origin_lemma_id == None).first()[0]
+        reflex = session.query(Lemma.word).filter(Lemma.origin_lemma_id != None, Lemma.word.notin_(
+            session.query(Lemma.word).filter(Lemma.origin_lemma_id == None)
+        )).first()[0]
+        session.close()
+        assert entry in self.client.get(f'/suggest?field=word&q={entry}').get_json()
+        assert reflex not in self.client.get(f'/suggest?field=word&q={reflex}&limit=50').get_json()
+
+    def test_bad_requests(self):
+        assert self.client.get('/suggest?field=notes&q=a').status_code == 400
+        assert self.client.get('/suggest?field=lang').get_json() == []
+        # a limit that is not a number falls back to the default
+        response = self.client.get('/suggest?field=lang&q=a&limit=x')
+        assert response.status_code == 200
+        assert response.get_json() == self.client.get('/suggest?field=lang&q=a').get_json()
+
+    def test_prefix_index(self):
+        index = PrefixIndex(['Proto-Munda', 'Punjabi', 'Pāli', None, 'Munda'])
+        assert index.complete('p') == ['Pāli', 'Proto-Munda', 'Punjabi']
+        assert index.complete('MUN') == ['Munda', 'Proto-Munda']
+        assert index.complete('pa', limit=1) == ['Pāli']
+        assert index.complete('x') == []
+
+
+class TestFuzzySearch:
+    """Test edit-distance matching of the word filter (?fuzzy=)."""
+
+    def setup_method(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        assert search.fuzzy_index is not None, "data.db has no fuzzy search tables"
+
+    def levenshtein(self, a, b):
+        previous = list(range(len(b) + 1))
+        for i, x in enumerate(a, 1):
+            current = [i]
+            for j, y in enumerate(b, 1):
+                current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (x != y)))
+            previous = current
+        return previous[-1]
+
+    def sample_word(self):
+        session = get_session()
+        word = session.query(Lemma.word).filter(func.length(Lemma.word) >= 5).order_by(Lemma.id).first()[0]
+        session.close()
+        return word
+
+    def test_edit_distance(self):
+        import random
+        rng = random.Random(0)
+        letters = "aāṭṭhkʰ"
+        for _ in range(2000):
+            a = "".join(rng.choice(letters) for _ in range(rng.randint(0, 8)))
+            b = "".join(rng.choice(letters) for _ in range(rng.randint(0, 8)))
+            assert fuzzy.edit_distance(a, fuzzy.bitmasks(a), b) == self.levenshtein(a, b)
+
+    def test_finds_misspelling_first(self):
+        word = self.sample_word()
+        typo = word[:2] + "q" + word[3:]
+        rows = self.client.get(f'/query?type=reflexes&word={typo}&fuzzy=1').get_json()
+        assert word in [row["word"] for row in rows]
+        assert self.client.get(f'/query?type=reflexes&word={typo}').get_json() == []
+
+    def test_matches_are_within_distance_and_ranked(self):
+        word = self.sample_word()[:4]
+        rows = self.client.get(f'/query?type=reflexes&word={word}&fuzzy=2').get_json()
+        assert rows
+        session = get_session()
+        phonemic = dict(session.query(Lemma.id, Lemma.phonemic).filter(Lemma.id.in_([row["id"] for row in rows])))
+        session.close()
+        distances = [
+            min(self.levenshtein(fuzzy.form_key(word), fuzzy.form_key(form))
+                for form in (row["word"], phonemic[row["id"]]) if form)
+            for row in rows
+        ]
+        assert max(distances) <= 2
+        assert distances == sorted(distances)
+
+    def test_pages_do_not_overlap(self):
+        word = self.sample_word()[:3]
+        first = self.client.get(f'/query?type=reflexes&word={word}&fuzzy=2')
+        cursor = first.headers.get('X-Next-Cursor')
+        assert cursor, "expected more than one page of fuzzy matches"
+        second = self.client.get(f'/query?type=reflexes&word={word}&fuzzy=2&page=2&cursor={cursor}').get_json()
+        assert second
+        assert not {row["id"] for row in first.get_json()} & {row["id"] for row in second}
+
+    def test_prev_cursor_returns_to_first_page(self, monkeypatch):
+        monkeypatch.setitem(app.config, 'RESPONSE_CACHE', False)
+        word = self.sample_word()[:3]
+        first = self.client.get(f'/query?type=reflexes&word={word}&fuzzy=2')
+        cursor = first.headers['X-Next-Cursor']
+        second = self.client.get(f'/query?type=reflexes&word={word}&fuzzy=2&page=2&cursor={cursor}')
+        back = self.client.get(
+            f'/query?type=reflexes&word={word}&fuzzy=2&cursor={second.headers["X-Prev-Cursor"]}'
+        )
+        assert back.status_code == 200
+        assert [row["id"] for row in back.get_json()] == [row["id"] for row in first.get_json()]
+        page = self.client.get(f'/reflexes?word={word}&fuzzy=2&page=2&cursor={cursor}').get_data(as_text=True)
+        prev = re.search(r'data-cursor="([^"]+)">←', page).group(1)
+        assert self.client.get(f'/reflexes?word={word}&fuzzy=2&cursor={prev}').status_code == 200
+
+    def test_pages_and_counts_are_kept_apart(self, monkeypatch):
+        monkeypatch.setitem(app.config, 'RESPONSE_CACHE', False)
+        word = self.sample_word()
+        exact = self.client.get(f'/reflexes?word={word}').get_data(as_text=True)
+        fuzzy_page = self.client.get(f'/reflexes?word={word}&fuzzy=3').get_data(as_text=True)
+        count = lambda html: re.search(r'of (\S+) reflexes', html).group(1)
+        assert int(count(fuzzy_page)) >= int(count(exact))
+        assert self.client.get(f'/entries?word={word}&fuzzy=1').status_code == 200
+
+
+class TestPatternSearch:
+    """Test regular-expression filtering through the in-memory form columns (?pattern=)."""
+
+    def setup_method(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.index = search.pattern_index
+        assert self.index is not None
+
+    def expected(self, pattern, field="word", clade=None):
+        session = get_session()
+        query = session.query(Lemma.id, getattr(Lemma, field)).join(Lemma.language)
+        if clade:
+            query = query.filter(Language.clade.like(f"%{clade}%"))
+        rows = query.all()
+        session.close()
+        return sorted(id for id, form in rows if form and re.search(pattern, form))
+
+    def test_matches_python_re(self):
+        for pattern, field in [("^k.*ṭ", "word"), ("a$", "phonemic"), ("ṭṭ", "word")]:
+            assert sorted(json.loads(self.index.match(pattern, field))) == self.expected(pattern, field)
+
+    def test_clade_mask(self):
+        session = get_session()
+        clade = session.query(Language.clade).filter(Language.clade != None).first()[0]
+        session.close()
+        assert sorted(json.loads(self.index.match("a", "word", clade=clade))) == self.expected("a", clade=clade)
+
+    def test_without_numpy(self, monkeypatch):
+        module = sys.modules["src.neojambu.app"]
+        monkeypatch.setattr(patterns, "numpy", None)
+        index = patterns.PatternIndex(module.engine, module.build_id)
+        assert sorted(json.loads(index.match("^k.*ṭ"))) == self.expected("^k.*ṭ")
+
+    def test_listing_and_query(self, monkeypatch):
+        monkeypatch.setitem(app.config, 'RESPONSE_CACHE', False)
+        expected = self.expected("^k.*ṭ")
+        rows = self.client.get('/query?type=reflexes&pattern=^k.*ṭ').get_json()
+        assert rows and all(row["id"] in expected for row in rows)
+        html = self.client.get('/reflexes?pattern=^k.*ṭ').get_data(as_text=True)
+        assert f'of {len(expected)} reflexes' in html
+
+    def test_invalid_pattern(self):
+        assert self.client.get('/query?type=reflexes&pattern=(').status_code == 400
+        assert self.client.get('/reflexes?pattern=' + 'a' * 201).status_code == 400
+
+    def test_backtracking_patterns_are_refused(self):
+        for pattern in ["((.|.)*)*Q", "(.|.)*(.|.)*Q", "(.|.)*Q", "(a+)+$", "(.*)(.*)Q"]:
+            started = time.monotonic()
+            response = self.client.get('/query', query_string={'type': 'reflexes', 'pattern': pattern})
+            assert response.status_code == 400, pattern
+            assert time.monotonic() - started < patterns.PATTERN_TIME_LIMIT, pattern
+        for pattern in ["^k.*ṭ", "k+a+", "(ab|cd)*", "a.*b"]:
+            patterns.compile_pattern(pattern)
+
+    def test_deadline_is_checked_between_small_chunks(self, monkeypatch):
+        monkeypatch.setattr(patterns, "PATTERN_TIME_LIMIT", 0)
+        index = patterns.PatternIndex(self.index.engine, self.index.build_id)
+        with pytest.raises(re.error, match="too long"):
+            index.match("zzzq")
+
+    def test_broad_pattern_is_refused(self, monkeypatch):
+        monkeypatch.setattr(patterns, "PATTERN_MATCH_LIMIT", 100)
+        index = patterns.PatternIndex(self.index.engine, self.index.build_id)
+        for _ in range(2):
+            with pytest.raises(re.error, match="more than 100 lemmas"):
+                index.match(".")
+        assert index.cache.hits == 1
+        assert len(json.loads(index.match("^k.*ṭ", clade="Munda"))) <= 100
+
+
+class TestCompression:
+    """Test gzip/brotli negotiation and precompressed static files."""
+
+    def setup_method(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+    def test_html_is_gzipped_when_accepted(self):
+        plain = self.client.get('/languages')
+        response = self.client.get('/languages', headers={'Accept-Encoding': 'gzip'})
+        assert response.headers.get('Content-Encoding') == 'gzip'
+        assert gzip.decompress(response.data) == plain.data
+        assert response.headers['ETag'] != plain.headers['ETag']
+        assert 'Accept-Encoding' in response.headers.get('Vary', '')
+
+    def test_small_and_unaccepted_responses_are_untouched(self):
+        response = self.client.get('/languages', headers={'Accept-Encoding': 'identity'})
+        assert 'Content-Encoding' not in response.headers
+        response = self.client.get('/query?type=languages&lang=zzzz', headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in response.headers
+
+    def test_compressed_etag_revalidates(self):
+        etag = self.client.get('/languages', headers={'Accept-Encoding': 'gzip'}).headers['ETag']
+        response = self.client.get('/languages', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        assert response.status_code == 304
+
+    def test_precompressed_static_file(self, tmp_path, monkeypatch):
+        (tmp_path / "style.css").write_text("body { color: black; }\n" * 100)
+        precompress_directory(str(tmp_path))
+        monkeypatch.setattr(app, "static_folder", str(tmp_path))
+        response = self.client.get('/static/style.css', headers={'Accept-Encoding': 'gzip'})
+        assert response.headers.get('Content-Encoding') == 'gzip'
+        assert response.mimetype == 'text/css'
+        assert gzip.decompress(response.data) == (tmp_path / "style.css").read_bytes()
+        response.close()
+
 
 if __name__ == "__main__":
     # Run tests with pytest